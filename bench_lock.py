@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+"""Measure the lock contention between several processes and threads."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+from typing import Any, Dict, List, Tuple
+
+from storpool.spopenstack import (  # pylint: disable=wrong-import-position
+    splocked,
+)
+
+
+OPERATIONS = ("get", "add", "remove", "nested", "upgrade")
+
+DEFAULT_MIX = "get=70,add=15,remove=10,nested=3,upgrade=2"
+
+CLASSES = ("json", "journal", "atomic")
+
+
+class Config(object):
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    """The benchmark parameters."""
+
+    def __init__(
+        self,  # type: Config
+        fname,  # type: str
+        dbclass,  # type: str
+        duration,  # type: float
+        keys,  # type: int
+        mix,  # type: List[Tuple[str, int]]
+        threads,  # type: int
+        timeout,  # type: float
+    ):  # type: (...) -> None
+        self.fname = fname
+        self.dbclass = dbclass
+        self.duration = duration
+        self.keys = keys
+        self.mix = mix
+        self.threads = threads
+        self.timeout = timeout
+
+
+def parse_mix(value):
+    # type: (str) -> List[Tuple[str, int]]
+    """Parse an "op=weight,op=weight" list of operations."""
+    res = []  # type: List[Tuple[str, int]]
+    for item in value.split(","):
+        name, sep, weight = item.partition("=")
+        if not sep or name not in OPERATIONS or not weight.isdigit():
+            raise ValueError(
+                "Invalid operation weight {item!r}".format(item=item)
+            )
+        res.append((name, int(weight)))
+    if not sum(weight for _, weight in res):
+        raise ValueError("No operations to perform")
+    return res
+
+
+def open_db(cfg):
+    # type: (Config) -> splocked.SPLockedJSONDB
+    """Create a database object of the requested class."""
+    if cfg.dbclass == "journal":
+        return splocked.SPJournalJSONDB(cfg.fname, timeout=cfg.timeout)
+    return splocked.SPLockedJSONDB(
+        cfg.fname, timeout=cfg.timeout, atomic=cfg.dbclass == "atomic"
+    )
+
+
+def pick_operation(rnd, mix, total):
+    # type: (random.Random, List[Tuple[str, int]], int) -> str
+    """Choose an operation at random according to the weights."""
+    pick = rnd.randrange(total)
+    for name, weight in mix:
+        if pick < weight:
+            return name
+        pick -= weight
+    return mix[-1][0]
+
+
+def run_thread(cfg, seed, res):
+    # type: (Config, int, Dict[str, Any]) -> None
+    """Perform random operations until the time runs out."""
+    rnd = random.Random(seed)
+    total = sum(weight for _, weight in cfg.mix)
+    db = open_db(cfg)
+    deadline = splocked.monotonic() + cfg.duration
+
+    while splocked.monotonic() < deadline:
+        name = pick_operation(rnd, cfg.mix, total)
+        key = u"req-{idx}".format(idx=rnd.randrange(cfg.keys))
+
+        start = splocked.monotonic()
+        try:
+            db.acquire(shared=name in ("get", "upgrade"))
+        except splocked.SPLockedFileError:
+            res["errors"] += 1
+            res["latency"].append(splocked.monotonic() - start)
+            continue
+        res["latency"].append(splocked.monotonic() - start)
+
+        try:
+            if name == "get":
+                db.get()
+            elif name == "add":
+                db.add(key, {u"id": key, u"rights": 2})
+            elif name == "remove":
+                db.remove_keys([key])
+            elif name == "nested":
+                # Lock the file again while already holding the lock.
+                with db:
+                    if key in db.get():
+                        db.remove_keys([key])
+                    else:
+                        db.add(key, {u"id": key, u"rights": 1})
+            elif key not in db.get():
+                # Upgrade the lock and make a change.
+                db.add(key, {u"id": key, u"rights": 1})
+            res["ops"][name] += 1
+        except splocked.SPLockedFileError:
+            res["errors"] += 1
+        finally:
+            db.release()
+
+
+def run_process(args):
+    # type: (Tuple[Config, int]) -> Dict[str, Any]
+    """Run the benchmark threads in a child process."""
+    cfg, idx = args
+    results = []  # type: List[Dict[str, Any]]
+    threads = []  # type: List[threading.Thread]
+    for tidx in range(cfg.threads):
+        res = {
+            "ops": {name: 0 for name in OPERATIONS},
+            "errors": 0,
+            "latency": [],
+        }  # type: Dict[str, Any]
+        results.append(res)
+        threads.append(
+            threading.Thread(
+                target=run_thread,
+                args=(cfg, idx * cfg.threads + tidx, res),
+            )
+        )
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+
+    total = {
+        "ops": {name: 0 for name in OPERATIONS},
+        "errors": 0,
+        "latency": [],
+        "stats": splocked.stats(),
+    }  # type: Dict[str, Any]
+    for res in results:
+        for name in OPERATIONS:
+            total["ops"][name] += res["ops"][name]
+        total["errors"] += res["errors"]
+        total["latency"].extend(res["latency"])
+    return total
+
+
+def percentile(values, pct):
+    # type: (List[float], float) -> float
+    """Return the nearest-rank percentile of some sorted values."""
+    if not values:
+        return 0.0
+    rank = max(int(len(values) * pct / 100.0 + 0.5), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(cfg, procs, results):
+    # type: (Config, int, List[Dict[str, Any]]) -> Dict[str, Any]
+    """Combine the results of the child processes."""
+    ops = {name: 0 for name in OPERATIONS}
+    errors = 0
+    retries = 0
+    latency = []  # type: List[float]
+    for res in results:
+        for name in OPERATIONS:
+            ops[name] += res["ops"][name]
+        errors += res["errors"]
+        retries += res["stats"]["retries"]
+        latency.extend(res["latency"])
+    latency.sort()
+
+    done = sum(ops.values())
+    attempts = done + errors
+    return {
+        "class": cfg.dbclass,
+        "processes": procs,
+        "threads": cfg.threads,
+        "duration": cfg.duration,
+        "ops": ops,
+        "ops_per_sec": done / cfg.duration,
+        "errors": errors,
+        "error_rate": errors / float(attempts) if attempts else 0.0,
+        "retries": retries,
+        "latency_p50_ms": percentile(latency, 50) * 1000,
+        "latency_p99_ms": percentile(latency, 99) * 1000,
+        "latency_max_ms": (latency[-1] if latency else 0.0) * 1000,
+    }
+
+
+def report(summary):
+    # type: (Dict[str, Any]) -> None
+    """Display the results in a human-readable form."""
+    print(
+        "{procs} process(es) x {threads} thread(s), {cls} file, "
+        "{dur:.1f} seconds".format(
+            procs=summary["processes"],
+            threads=summary["threads"],
+            cls=summary["class"],
+            dur=summary["duration"],
+        )
+    )
+    print(
+        "operations: {ops} ({rate:.1f}/s)".format(
+            ops=", ".join(
+                "{name} {count}".format(name=name, count=count)
+                for name, count in sorted(summary["ops"].items())
+            ),
+            rate=summary["ops_per_sec"],
+        )
+    )
+    print(
+        "lock errors: {errors} ({pct:.2f}%), retries: {retries}".format(
+            errors=summary["errors"],
+            pct=summary["error_rate"] * 100,
+            retries=summary["retries"],
+        )
+    )
+    print(
+        "acquire latency: p50 {p50:.3f} ms, p99 {p99:.3f} ms, "
+        "max {pmax:.3f} ms".format(
+            p50=summary["latency_p50_ms"],
+            p99=summary["latency_p99_ms"],
+            pmax=summary["latency_max_ms"],
+        )
+    )
+
+
+def parse_args():
+    # type: () -> Tuple[argparse.Namespace, List[Tuple[str, int]]]
+    """Parse the command-line arguments."""
+    parser = argparse.ArgumentParser(prog="bench_lock", description=__doc__)
+    parser.add_argument(
+        "-c",
+        "--class",
+        dest="dbclass",
+        choices=CLASSES,
+        default="json",
+        help="the kind of database file to use",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=5.0,
+        help="how many seconds to run for",
+    )
+    parser.add_argument(
+        "-D",
+        "--directory",
+        help="where to create the database (default: /dev/shm if present)",
+    )
+    parser.add_argument(
+        "-j", "--json", action="store_true", help="output JSON results"
+    )
+    parser.add_argument(
+        "-k", "--keys", type=int, default=1000, help="the number of keys"
+    )
+    parser.add_argument(
+        "-m",
+        "--mix",
+        default=DEFAULT_MIX,
+        help="the relative weights of the operations "
+        "(default: {mix})".format(mix=DEFAULT_MIX),
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=4,
+        help="the number of processes",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="the number of threads in each process",
+    )
+    parser.add_argument(
+        "-T",
+        "--timeout",
+        type=float,
+        default=splocked.LOCK_TIMEOUT,
+        help="the lock timeout in seconds",
+    )
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.processes < 1 or args.threads < 1 or args.keys < 1:
+        parser.error("The process, thread, and key counts must be positive")
+    return args, mix
+
+
+def main():
+    # type: () -> None
+    """Main program: run the benchmark processes, report the results."""
+    args, mix = parse_args()
+    directory = args.directory
+    if directory is None and os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+
+    tempd = tempfile.mkdtemp(prefix="spopenstack-bench-", dir=directory)
+    try:
+        fname = os.path.join(tempd, "attach.json")
+        with open(fname, mode="w", encoding="UTF-8") as tempf:
+            tempf.write("{}")
+        cfg = Config(
+            fname=fname,
+            dbclass=args.dbclass,
+            duration=args.duration,
+            keys=args.keys,
+            mix=mix,
+            threads=args.threads,
+            timeout=args.timeout,
+        )
+
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(
+                run_process, [(cfg, idx) for idx in range(args.processes)]
+            )
+    finally:
+        shutil.rmtree(tempd)
+
+    summary = summarize(cfg, args.processes, results)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        report(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/python3
+"""Time the splocked file operations for databases of different sizes."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+from typing import Any, Callable, Dict, List, Optional
+
+from storpool.spopenstack import (  # pylint: disable=wrong-import-position
+    splocked,
+    spserialize,
+)
+
+
+FORMAT_VERSION = 1
+
+DEFAULT_SIZES = "10,100,1000,10000,100000"
+
+BENCHMARKS = (
+    "jsload",
+    "jsdump",
+    "changed",
+    "get_warm",
+    "get_cold",
+    "add",
+    "remove_keys",
+    "snapshot_cold",
+    "snapshot_shared",
+)
+
+CLASSES = ("json", "journal", "atomic")
+
+
+def make_data(size):
+    # type: (int) -> Dict[str, Any]
+    """Build a database that looks like the attachment requests one."""
+    return {
+        u"req-{idx:06}".format(idx=idx): {
+            u"id": u"req-{idx:06}".format(idx=idx),
+            u"volume": u"os--volume-{idx}".format(idx=idx),
+            u"volsnap": False,
+            u"rights": 2,
+        }
+        for idx in range(size)
+    }
+
+
+def measure(
+    func,  # type: Callable[[int], Any]
+    setup,  # type: Callable[[int], Any]
+    number,  # type: int
+    repeat,  # type: int
+):  # type: (...) -> List[float]
+    """Time `repeat` runs of `number` calls, return the per-call times.
+
+    The setup function is invoked before each call, and the time it
+    takes is not counted.
+    """
+    res = []  # type: List[float]
+    idx = 0
+    for _ in range(repeat):
+        elapsed = 0.0
+        for _ in range(number):
+            setup(idx)
+            start = splocked.monotonic()
+            func(idx)
+            elapsed += splocked.monotonic() - start
+            idx += 1
+        res.append(elapsed / number)
+    return res
+
+
+def nothing(_idx):
+    # type: (int) -> None
+    """Do not prepare anything."""
+
+
+def open_db(fname, dbclass, serializer):
+    # type: (str, str, spserialize.Serializer) -> splocked.SPLockedJSONDB
+    """Create a database object of the requested class."""
+    if dbclass == "journal":
+        return splocked.SPJournalJSONDB(fname, serializer=serializer)
+    return splocked.SPLockedJSONDB(
+        fname, serializer=serializer, atomic=dbclass == "atomic"
+    )
+
+
+class Bench(object):
+    """Run the benchmarks for a database of a single size."""
+
+    def __init__(self, fname, dbclass, serializer, size):
+        # type: (Bench, str, str, spserialize.Serializer, int) -> None
+        self.fname = fname
+        self.size = size
+        self.data = make_data(size)
+        for path in (fname, fname + ".lock"):
+            if os.path.exists(path):
+                os.unlink(path)
+        with open(fname, mode="wb") as dataf:
+            dataf.write(serializer.dumps(self.data))
+
+        self.db = open_db(fname, dbclass, serializer)
+        self.other = open_db(fname, dbclass, serializer)
+        self.reader = open_db(fname, dbclass, serializer)
+
+    def key(self, idx):
+        # type: (Bench, int) -> str
+        """Return a key that is not in the initial data."""
+        return u"new-{idx:06}".format(idx=idx)
+
+    def jsload(self, _idx):
+        # type: (Bench, int) -> None
+        """Read and decode the whole file."""
+        self.db.jsload()
+
+    def jsdump(self, _idx):
+        # type: (Bench, int) -> None
+        """Encode and write the whole file."""
+        self.db.jsdump(self.data)
+
+    def changed(self, _idx):
+        # type: (Bench, int) -> None
+        """Check whether the file has changed without locking it."""
+        self.db.changed()
+
+    def get(self, _idx):
+        # type: (Bench, int) -> None
+        """Lock the file and return the (possibly cached) data."""
+        self.db.get()
+
+    def modify(self, idx):
+        # type: (Bench, int) -> None
+        """Let somebody else modify the file."""
+        self.other.add(self.key(idx), idx)
+        splocked.DECODED_CACHE.clear()
+
+    def share(self, idx):
+        # type: (Bench, int) -> None
+        """Let somebody else modify the file and somebody else read it."""
+        self.other.add(self.key(idx), idx)
+        self.reader.snapshot()
+
+    def snapshot(self, _idx):
+        # type: (Bench, int) -> None
+        """Lock the file and return a (possibly shared) snapshot."""
+        self.db.snapshot()
+
+    def add(self, idx):
+        # type: (Bench, int) -> None
+        """Add a single key."""
+        self.db.add(self.key(idx), idx)
+
+    def remove_keys(self, idx):
+        # type: (Bench, int) -> None
+        """Remove a single key."""
+        self.db.remove_keys([self.key(idx)])
+
+    def run(self, name, number, repeat):
+        # type: (Bench, str, int, int) -> List[float]
+        """Run a single benchmark."""
+        setup = nothing  # type: Callable[[int], Any]
+        if name == "jsload":
+            func = self.jsload  # type: Callable[[int], Any]
+        elif name == "jsdump":
+            func = self.jsdump
+        elif name == "changed":
+            self.db.get()
+            func = self.changed
+        elif name == "get_warm":
+            self.db.get()
+            func = self.get
+        elif name == "get_cold":
+            func, setup = self.get, self.modify
+        elif name == "add":
+            func = self.add
+        elif name == "snapshot_cold":
+            func, setup = self.snapshot, self.modify
+        elif name == "snapshot_shared":
+            func, setup = self.snapshot, self.share
+        else:
+            func, setup = self.remove_keys, self.add
+        res = measure(func, setup, number, repeat)
+
+        # Put the original data back for the next benchmark.
+        self.db.jsdump(self.data)
+        return res
+
+
+def run_all(args, sizes, names):
+    # type: (argparse.Namespace, List[int], List[str]) -> Dict[str, Any]
+    """Run the benchmarks, return the results."""
+    serializer = spserialize.get_serializer(args.serializer)
+    results = []  # type: List[Dict[str, Any]]
+    tempd = tempfile.mkdtemp(prefix="spopenstack-bench-", dir=args.directory)
+    try:
+        fname = os.path.join(tempd, "attach.json")
+        for size in sizes:
+            bench = Bench(fname, args.dbclass, serializer, size)
+            number = max(1, min(args.max_number, args.budget // size))
+            for name in names:
+                times = sorted(bench.run(name, number, args.repeat))
+                results.append(
+                    {
+                        "name": name,
+                        "size": size,
+                        "number": number,
+                        "repeat": args.repeat,
+                        "min": times[0],
+                        "median": times[len(times) // 2],
+                    }
+                )
+                if not args.quiet:
+                    print(
+                        "{name:15} {size:7}: {median:12.9f} s".format(
+                            name=name, size=size, median=times[len(times) // 2]
+                        ),
+                        file=sys.stderr,
+                    )
+    finally:
+        shutil.rmtree(tempd)
+
+    return {
+        "format": {"version": FORMAT_VERSION},
+        "python": platform.python_version(),
+        "class": args.dbclass,
+        "serializer": serializer.name,
+        "results": results,
+    }
+
+
+def compare(current, baseline):
+    # type: (Dict[str, Any], Dict[str, Any]) -> None
+    """Show the ratios of the current and the baseline median times."""
+    old = {
+        (res["name"], res["size"]): res["median"]
+        for res in baseline["results"]
+    }
+    print(
+        "{name:15} {size:>7} {old:>14} {new:>14} {ratio:>7}".format(
+            name="benchmark",
+            size="size",
+            old="baseline",
+            new="current",
+            ratio="ratio",
+        )
+    )
+    for res in current["results"]:
+        before = old.get((res["name"], res["size"]))
+        ratio = (
+            "-" if not before else "{r:.2f}".format(r=res["median"] / before)
+        )
+        print(
+            "{name:15} {size:7} {old:>14} {new:14.9f} {ratio:>7}".format(
+                name=res["name"],
+                size=res["size"],
+                old="-" if before is None else "{b:.9f}".format(b=before),
+                new=res["median"],
+                ratio=ratio,
+            )
+        )
+
+
+def parse_list(value, valid=None):
+    # type: (str, Optional[List[str]]) -> List[str]
+    """Parse a comma-separated list."""
+    res = [item for item in value.split(",") if item]
+    bad = [item for item in res if valid is not None and item not in valid]
+    if bad or not res:
+        raise ValueError("Invalid list: {value!r}".format(value=value))
+    return res
+
+
+def parse_args():
+    # type: () -> argparse.Namespace
+    """Parse the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="bench_splocked", description=__doc__
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help="the benchmarks to run (default: all of them)",
+    )
+    parser.add_argument(
+        "-B",
+        "--budget",
+        type=int,
+        default=100000,
+        help="run each benchmark about budget/size times per repetition",
+    )
+    parser.add_argument(
+        "-c",
+        "--class",
+        dest="dbclass",
+        choices=CLASSES,
+        default="json",
+        help="the kind of database file to use",
+    )
+    parser.add_argument(
+        "-C",
+        "--compare",
+        help="compare the results to those stored in a JSON file",
+    )
+    parser.add_argument(
+        "-D",
+        "--directory",
+        help="where to create the database (default: /dev/shm if present)",
+    )
+    parser.add_argument(
+        "-N",
+        "--max-number",
+        type=int,
+        default=1000,
+        help="the maximum number of calls per repetition",
+    )
+    parser.add_argument(
+        "-o", "--output", help="store the JSON results into a file"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="do not report the progress",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="the number of repetitions; the median one is reported",
+    )
+    parser.add_argument(
+        "-S",
+        "--serializer",
+        default="json",
+        help="the serializer to use (json, orjson, ujson, marshal, auto)",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help="the database sizes (default: {sizes})".format(
+            sizes=DEFAULT_SIZES
+        ),
+    )
+    args = parser.parse_args()
+    if args.directory is None and os.path.isdir("/dev/shm"):
+        args.directory = "/dev/shm"
+    if args.repeat < 1 or args.max_number < 1 or args.budget < 1:
+        parser.error("The repetition and call counts must be positive")
+    return args
+
+
+def main():
+    # type: () -> None
+    """Main program: run the benchmarks, output or compare the results."""
+    args = parse_args()
+    try:
+        names = parse_list(args.benchmarks, list(BENCHMARKS))
+        sizes = [int(size) for size in parse_list(args.sizes)]
+        spserialize.get_serializer(args.serializer)
+    except ValueError as err:
+        sys.exit(str(err))
+    if any(size < 1 for size in sizes):
+        sys.exit("The database sizes must be positive")
+
+    current = run_all(args, sizes, names)
+    if args.output is not None:
+        with open(args.output, mode="w", encoding="UTF-8") as outf:
+            json.dump(current, outf, indent=2, sort_keys=True)
+            print(file=outf)
+
+    if args.compare is not None:
+        with open(args.compare, mode="r", encoding="UTF-8") as basef:
+            baseline = json.load(basef)
+        if baseline.get("format", {}).get("version") != FORMAT_VERSION:
+            sys.exit(
+                "Unsupported results format in {fname}".format(
+                    fname=args.compare
+                )
+            )
+        compare(current, baseline)
+    elif args.output is None:
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#
+# -
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+asyncio support for the locked files and the attachment database.
+
+This module uses the async/await syntax, so it may only be imported on
+Python 3.7 or later; the other modules only import it when needed.
+"""
+
+import asyncio
+import types
+import weakref
+
+from typing import Any, Callable, List, Optional, Tuple, Type
+
+from storpool import spapi
+
+from . import splocked
+from . import spattachdb
+
+
+class SPTaskLock(object):
+    """Make the tasks that lock the same object wait for each other.
+
+    The in-process locks of the SPLockedFile objects are per-thread,
+    and all the tasks run in the same thread, so they need another one.
+    A task may lock the same object several times, e.g. to upgrade
+    a shared lock to an exclusive one.
+    """
+
+    def __init__(self):
+        # type: (SPTaskLock) -> None
+        self.lock = asyncio.Lock()
+        self.owner = None  # type: Optional[asyncio.Task[Any]]
+        self.depth = 0
+
+    def release(self):
+        # type: (SPTaskLock) -> None
+        """Release one level of the lock."""
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+            self.lock.release()
+
+
+_task_locks = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Any, SPTaskLock]
+
+
+async def _retry(attempt, deadline):
+    # type: (Callable[[], bool], Optional[float]) -> bool
+    """Try something with an exponential backoff until the deadline."""
+    delay = splocked.LOCK_POLL_MIN
+    while not attempt():
+        if deadline is None:
+            await asyncio.sleep(delay)
+        else:
+            remaining = deadline - splocked.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, splocked.LOCK_POLL_MAX)
+    return True
+
+
+async def _poll(locked, shared, deadline, upgrade):
+    # type: (Any, bool, Optional[float], bool) -> bool
+    """Try to lock an object with an exponential backoff.
+
+    Only the last attempt counts as a failure in the lock statistics.
+    If `upgrade` is set, the task already holds a shared lock on
+    the object, which the attempts may drop; if they all fail, take
+    it back the same way instead of blocking the event loop.
+    """
+    if await _retry(
+        lambda: bool(locked.try_lock(shared=shared, retry=True)), deadline
+    ):
+        return True
+    if locked.try_lock(shared=shared):
+        return True
+
+    if upgrade:
+        await _retry(
+            lambda: bool(locked.try_lock(shared=True, retry=True)), None
+        )
+        locked.release()
+    return False
+
+
+async def acquire(locked, timeout=splocked.LOCK_TIMEOUT, shared=False):
+    # type: (Any, Optional[float], bool) -> None
+    """Lock an object without blocking the event loop.
+
+    The object may be anything with a try_lock(shared, retry) method,
+    e.g. an SPLockedFile, SPShardedJSONDB, or SPLockedSQLiteDB one.
+    A timeout of None means wait for as long as it takes.
+    """
+    deadline = None if timeout is None else splocked.monotonic() + timeout
+    task = asyncio.current_task()
+    tlock = _task_locks.get(locked)
+    if tlock is None:
+        tlock = SPTaskLock()
+        _task_locks[locked] = tlock
+
+    upgrade = not shared and tlock.owner is task
+    if tlock.owner is not task:
+        try:
+            await asyncio.wait_for(tlock.lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise splocked.SPLockedFileError(
+                "Could not lock {obj!r}".format(obj=locked)
+            )
+        tlock.owner = task
+    tlock.depth += 1
+
+    try:
+        if not await _poll(locked, shared, deadline, upgrade):
+            raise splocked.SPLockedFileError(
+                "Could not lock {obj!r}".format(obj=locked)
+            )
+    except BaseException:
+        tlock.release()
+        raise
+
+
+async def release(
+    locked,  # type: Any
+    etype=None,  # type: Optional[Type[BaseException]]
+    eval=None,  # type: Optional[BaseException]
+    tb=None,  # type: Optional[types.TracebackType]
+):  # type: (...) -> None
+    """Release a lock obtained by acquire()."""
+    try:
+        locked.__exit__(etype, eval, tb)
+    finally:
+        _task_locks[locked].release()
+
+
+async def _wait_readable(fd, timeout):
+    # type: (int, float) -> None
+    """Wait for a file descriptor to become readable or for a timeout."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()  # type: asyncio.Future[None]
+
+    def wake():
+        # type: () -> None
+        if not ready.done():
+            ready.set_result(None)
+
+    loop.add_reader(fd, wake)
+    try:
+        await asyncio.wait_for(ready, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+
+async def attach_many_and_wait(att, client, volumes):
+    # type: (spattachdb.AttachDB, int, List[Tuple[str, bool, int]]) -> None
+    """Attach several volumes or snapshots, wait for them to show up."""
+    loop = asyncio.get_running_loop()
+    devpaths = await loop.run_in_executor(
+        None, att._attach_many_request, client, volumes
+    )
+    with spattachdb.DeviceWaiter(devpaths, root=att._device_root) as waiter:
+        while True:
+            delay = waiter.poll()
+            if delay is None:
+                att._devices_missing(waiter)
+                return
+            if waiter.watcher is not None:
+                await _wait_readable(waiter.watcher.fileno(), delay)
+                waiter.watcher.drain()
+            else:
+                await asyncio.sleep(delay)
+
+
+async def attach_and_wait(att, client, volume, volsnap, rights):
+    # type: (spattachdb.AttachDB, int, str, bool, int) -> None
+    """Attach a volume or snapshot, wait for it to show up."""
+    await attach_many_and_wait(att, client, [(volume, volsnap, rights)])
+
+
+async def detach_and_wait(att, client, volume, volsnap):
+    # type: (spattachdb.AttachDB, int, str, bool) -> None
+    """Detach a volume or snapshot, retrying for a while if it is open."""
+    loop = asyncio.get_running_loop()
+    count = 10
+    while True:
+        try:
+            await loop.run_in_executor(
+                None, att._detach_request, client, volume, volsnap, count == 0
+            )
+            break
+        except spapi.ApiError as err:
+            if att._detach_busy(err):
+                assert count > 0
+                await asyncio.sleep(0.2)
+                count -= 1
+            else:
+                raise
+
+
+async def sync(att, req_id, detached):
+    # type: (spattachdb.AttachDB, str, Optional[str]) -> None
+    """Do what AttachDB.sync() does without blocking the event loop.
+
+    The StorPool API queries are run in the loop's default executor,
+    while the attachment database is only accessed in the loop's thread.
+    """
+    assert att._ourId is not None and att._ourId != -1
+    loop = asyncio.get_running_loop()
+
+    async with att.shared():
+        plan = await loop.run_in_executor(
+            None, att._sync_plan, req_id, detached, dict(att.get())
+        )
+        if plan is None or not (
+            plan.attach or plan.remove or plan.detach is not None
+        ):
+            return
+
+        lock_gen = att.lock_generation()
+        async with att:
+            if att.lock_generation() != lock_gen:
+                plan = await loop.run_in_executor(
+                    None, att._sync_plan, req_id, detached, dict(att.get())
+                )
+                if plan is None:
+                    return
+
+            if plan.attach:
+                try:
+                    await attach_many_and_wait(att, att._ourId, plan.attach)
+                except spapi.ApiError as err:
+                    if not att._attach_missing(err):
+                        raise
+                    # Some of the volumes were deleted since we last looked.
+                    plan = await loop.run_in_executor(
+                        None, att._sync_plan, req_id, detached, dict(att.get())
+                    )
+                    if plan is None:
+                        return
+                    if plan.attach:
+                        await attach_many_and_wait(
+                            att, att._ourId, plan.attach
+                        )
+
+            if plan.remove:
+                att.remove_keys(plan.remove)
+
+            if plan.detach is not None:
+                await detach_and_wait(
+                    att, att._ourId, plan.detach[0], plan.detach[1]
+                )
@@ -22,12 +22,28 @@ Helper routines for the StorPool drivers in the OpenStack codebase.
 
 import collections
 import os
-import time
+import threading
 
 try:
     import logging
+    import types
 
-    from typing import Dict, List, Optional, Text, Tuple, TypedDict
+    from typing import (
+        Any,
+        Awaitable,
+        Callable,
+        Coroutine,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Set,
+        Text,
+        Tuple,
+        Type,
+        TypedDict,
+        Union,
+    )
 
     Attach = TypedDict(
         "Attach",
@@ -40,30 +56,189 @@ try:
             "remove_on_detach": bool,
         },
     )
+
+    AttachStorage = Union[
+        "splocked.SPLockedJSONDB",
+        "splocked.SPShardedJSONDB",
+        "spsqlitedb.SPLockedSQLiteDB",
+    ]
+    SharedLock = Union["splocked.SPSharedLock", "spsqlitedb.SPSQLiteLock"]
+    TransactionLock = Union[
+        "splocked.SPTransaction", "spsqlitedb.SPSQLiteLock"
+    ]
 except ImportError:
     pass
 
 from storpool import spconfig, spapi
 
+from . import spgreen
 from . import splocked
+from . import spsqlitedb
+from . import spwatch
 
 
 LOCKFILE = "/var/spool/openstack-storpool/openstack-attach.json"
+SQLITE_DBFILE = "/var/spool/openstack-storpool/openstack-attach.sqlite"
+
+BACKENDS = ("json", "atomic", "journal", "sharded", "sqlite")
+
+# What AttachDB.sync() needs to do: attach some (volume, volsnap, rights)
+# tuples, forget some stale requests, and maybe detach a (volume, volsnap).
+SyncPlan = collections.namedtuple("SyncPlan", ["attach", "remove", "detach"])
+
+# Check whether up to this many volumes or snapshots exist by querying
+# the StorPool API for each one instead of fetching the full lists.
+EXISTS_QUERY_MAX = 8
+
+# Where the attached StorPool volumes show up.
+DEVICE_ROOT = "/dev/storpool"
+
+# How long to wait for the attached devices to show up, and how often
+# to look for them: the interval starts small and doubles up to the max.
+DEVICE_TIMEOUT = 10.0
+DEVICE_POLL_MIN = 0.02
+DEVICE_POLL_MAX = 0.25
+
+# The parts of a StorPool attachment description that sync() looks at.
+Attached = collections.namedtuple(
+    "Attached", ["volume", "client", "snapshot", "rights"]
+)
+
 
+class DeviceWaiter(object):
+    """Keep track of several devices that should show up soon.
+
+    If `root` is specified and inotify(7) is available, watch that
+    directory so that the waiting may stop as soon as a new device
+    shows up there; the devices are still looked for periodically.
+    """
+
+    def __init__(self, devpaths, timeout=DEVICE_TIMEOUT, root=None):
+        # type: (DeviceWaiter, Iterable[str], float, Optional[str]) -> None
+        self.pending = list(devpaths)
+        self.timeout = timeout
+        self.watcher = None  # type: Optional[spwatch.SPDirWatcher]
+        if root is not None and self.pending:
+            self.watcher = spwatch.dir_watcher(root)
+        self._deadline = splocked.monotonic() + timeout
+        self._interval = DEVICE_POLL_MIN
+
+    def __enter__(self):
+        # type: (DeviceWaiter) -> DeviceWaiter
+        return self
+
+    def __exit__(self, etype, eval, tb):
+        # type: (DeviceWaiter, Any, Any, Any) -> None
+        self.close()
+
+    def close(self):
+        # type: (DeviceWaiter) -> None
+        """Stop watching the devices directory."""
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def poll(self):
+        # type: (DeviceWaiter) -> Optional[float]
+        """Look for the devices that have not shown up yet.
+
+        Return the number of seconds to sleep before looking again or
+        None if all the devices are there or the time ran out; in the
+        latter case, the missing devices are left in `pending`.
+        """
+        self.pending = [
+            path for path in self.pending if not os.path.exists(path)
+        ]
+        remaining = self._deadline - splocked.monotonic()
+        if not self.pending or remaining <= 0:
+            return None
+        delay = min(self._interval, remaining)
+        self._interval = min(self._interval * 2, DEVICE_POLL_MAX)
+        return delay
 
-class AttachDB(splocked.SPLockedJSONDB):
+    def wait(self):
+        # type: (DeviceWaiter) -> List[str]
+        """Wait for the devices to show up, return the missing ones."""
+        while True:
+            delay = self.poll()
+            if delay is None:
+                return self.pending
+            if self.watcher is not None:
+                self.watcher.wait(delay)
+            else:
+                spgreen.sleep(delay)
+
+
+class AttachDB(object):
     def __init__(
         self,  # type: AttachDB
         log,  # type: logging.Logger
-        fname=LOCKFILE,  # type: str
+        fname=None,  # type: Optional[str]
         override_config=None,  # type: Optional[Dict[str, str]]
+        backend="json",  # type: str
+        inventory_ttl=None,  # type: Optional[float]
+        device_root=DEVICE_ROOT,  # type: str
+        legacy_fname=None,  # type: Optional[str]
     ):  # type: (...) -> None
-        super(AttachDB, self).__init__(fname)
+        """Initialize an attachment database object.
+
+        The `backend` parameter selects the way the attachment requests
+        are stored: "json" for the traditional JSON file, "atomic" for
+        a JSON file that is replaced on each write so that the readers
+        need not lock it, "journal" for an append-only SPJournalJSONDB
+        file, "sharded" for several SPShardedJSONDB files next to
+        the JSON one, or "sqlite" for an SQLite database. All the
+        processes that use the same file must use the same backend.
+
+        The "atomic" and "journal" backends read a JSON file written by
+        the "json" one as it is. The "sharded" and "sqlite" ones do not
+        use it; if `legacy_fname` is specified, the first time the
+        requests are accessed, any found in that JSON file are moved
+        into the new storage. Only pass it once all the processes on
+        the host have been switched to the new backend: the ones still
+        using the JSON file will no longer see the moved requests.
+
+        The `inventory_ttl` parameter specifies for how many seconds
+        the lists of StorPool volumes, snapshots, and attachments may
+        be reused by subsequent sync() calls; if not specified, it is
+        taken from the SP_OPENSTACK_INVENTORY_TTL configuration
+        setting, and it defaults to 0, i.e. no caching at all.
+        The attachments list is fetched again if the devices that show
+        up in `device_root` do not match it, since other processes may
+        have attached or detached volumes in the meantime.
+
+        The `device_root` parameter specifies the directory where
+        the attached volumes show up.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(
+                "Invalid AttachDB backend {backend}".format(backend=backend)
+            )
+        if fname is None:
+            fname = SQLITE_DBFILE if backend == "sqlite" else LOCKFILE
+        if backend not in ("sharded", "sqlite"):
+            legacy_fname = None
+
+        if backend == "journal":
+            self._db = splocked.SPJournalJSONDB(fname)  # type: AttachStorage
+        elif backend == "sharded":
+            self._db = splocked.SPShardedJSONDB(fname)
+        elif backend == "sqlite":
+            self._db = spsqlitedb.SPLockedSQLiteDB(fname)
+        else:
+            self._db = splocked.SPLockedJSONDB(
+                fname, atomic=backend == "atomic"
+            )
+        self._legacy_fname = legacy_fname
         self._api = None  # type: Optional[spapi.Api]
         self._config = None  # type: Optional[spconfig.SPConfig]
         self._ourId = None  # type: Optional[int]
         self._override_config = override_config
         self._volume_prefix = None  # type: Optional[str]
+        self._inventory_ttl = inventory_ttl
+        self._inventory = {}  # type: Dict[str, Tuple[float, Any]]
+        self._inventory_lock = threading.Lock()
+        self._device_root = device_root
         self.LOG = log
 
     def config(self):
@@ -93,6 +268,63 @@ class AttachDB(splocked.SPLockedJSONDB):
             self._volume_prefix = cfg.get("SP_OPENSTACK_VOLUME_PREFIX", "os")
         return self._volume_prefix
 
+    def inventoryTTL(self):
+        # type: (AttachDB) -> float
+        if self._inventory_ttl is None:
+            cfg = self.config()
+            self._inventory_ttl = float(
+                cfg.get("SP_OPENSTACK_INVENTORY_TTL", "0")
+            )
+        return self._inventory_ttl
+
+    def _inventory_get(self, what):
+        # type: (AttachDB, str) -> Any
+        """Return the result of a recent API query, if there is one."""
+        with self._inventory_lock:
+            entry = self._inventory.get(what)
+        if (
+            entry is None
+            or splocked.monotonic() - entry[0] >= self.inventoryTTL()
+        ):
+            return None
+        return entry[1]
+
+    def _cached(self, what, fetch):
+        # type: (AttachDB, str, Callable[[], Any]) -> Any
+        """Return the result of a recent API query or run it again."""
+        value = self._inventory_get(what)
+        if value is None:
+            now = splocked.monotonic()
+            value = fetch()
+            with self._inventory_lock:
+                self._inventory[what] = (now, value)
+        return value
+
+    def _inventory_attached(self, client, volume, volsnap, rights):
+        # type: (AttachDB, int, str, bool, Optional[str]) -> None
+        """Record a volumesReassign() call in the cached attachments list.
+
+        If `rights` is None, the volume was detached from the client.
+        """
+        with self._inventory_lock:
+            entry = self._inventory.get("attachments")
+            if entry is None:
+                return
+            atts = [
+                att
+                for att in entry[1]
+                if att.volume != volume or att.client != client
+            ]
+            if rights is not None:
+                atts.append(Attached(volume, client, volsnap, rights))
+            self._inventory["attachments"] = (entry[0], atts)
+
+    def invalidateInventory(self):
+        # type: (AttachDB) -> None
+        """Forget the cached StorPool volumes, snapshots, and attachments."""
+        with self._inventory_lock:
+            self._inventory.clear()
+
     def volumeName(self, id):
         # type: (AttachDB, str) -> str
         return "{pfx}--volume-{id}".format(pfx=self.volumePrefix(), id=id)
@@ -112,168 +344,496 @@ class AttachDB(splocked.SPLockedJSONDB):
             id=id,
         )
 
-    # TODO: cache at least the API attachments data
+    def _storage(self):
+        # type: (AttachDB) -> AttachStorage
+        """Return the object that actually stores the attachment requests.
+
+        The first time, move the requests from the legacy JSON file.
+        """
+        if self._legacy_fname is not None:
+            self._import_legacy(self._legacy_fname)
+            self._legacy_fname = None
+        return self._db
+
+    def _import_legacy(self, fname):
+        # type: (AttachDB, str) -> None
+        """Move the requests from a JSON file into the storage.
+
+        Lock the JSON file first so that any process still using
+        the "json" backend waits for the requests to be moved.
+        The ones already in the storage are not overwritten.
+        """
+        if not os.path.exists(fname):
+            return
+
+        legacy = splocked.SPLockedJSONDB(fname)
+        with legacy:
+            data = legacy.get()
+            if not data:
+                return
+
+            with self._db:
+                current = self._db.get()
+                self._db.add_many(
+                    {
+                        key: value
+                        for key, value in data.items()
+                        if key not in current
+                    }
+                )
+            moved = list(data)
+            legacy.remove_keys(moved)
+        self.LOG.info(
+            "StorPool: moved {count} attachment request(s) from "
+            "{fname}".format(count=len(moved), fname=fname)
+        )
+
+    def acquire(self, timeout=-1.0, shared=False):
+        # type: (AttachDB, Optional[float], bool) -> None
+        self._storage().acquire(timeout=timeout, shared=shared)
+
+    def try_lock(self, shared=False, retry=False):
+        # type: (AttachDB, bool, bool) -> bool
+        return self._storage().try_lock(shared=shared, retry=retry)
+
+    def release(self):
+        # type: (AttachDB) -> None
+        self._storage().release()
+
+    def close(self):
+        # type: (AttachDB) -> None
+        self._db.close()
+
+    def stats(self):
+        # type: (AttachDB) -> Dict[str, Any]
+        return self._storage().stats()
+
+    def lock_generation(self):
+        # type: (AttachDB) -> int
+        return self._storage().lock_generation()
+
+    def shared(self):
+        # type: (AttachDB) -> SharedLock
+        return self._storage().shared()
+
+    def transaction(self):
+        # type: (AttachDB) -> TransactionLock
+        return self._storage().transaction()
+
+    def __enter__(self):
+        # type: (AttachDB) -> None
+        self._storage().__enter__()
+
+    def __exit__(
+        self,  # type: AttachDB
+        etype,  # type: Optional[Type[splocked.TExc]]
+        eval,  # type: Optional[splocked.TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._storage().__exit__(etype, eval, tb)
+
+    def __aenter__(self):
+        # type: (AttachDB) -> Awaitable[None]
+        return self._storage().__aenter__()
+
+    def __aexit__(
+        self,  # type: AttachDB
+        etype,  # type: Optional[Type[splocked.TExc]]
+        eval,  # type: Optional[splocked.TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        return self._storage().__aexit__(etype, eval, tb)
+
+    def get(self):
+        # type: (AttachDB) -> Dict[Text, Any]
+        return self._storage().get()
+
+    def snapshot(self):
+        # type: (AttachDB) -> splocked.SPSnapshot
+        return self._storage().snapshot()
+
+    def update_many(self, items, removed=()):
+        # type: (AttachDB, Dict[Text, Any], Iterable[Text]) -> None
+        self._storage().update_many(items, removed)
+
+    def add(self, key, val):
+        # type: (AttachDB, Text, Any) -> None
+        self._storage().add(key, val)
+
+    def add_many(self, items):
+        # type: (AttachDB, Dict[Text, Any]) -> None
+        self._storage().add_many(items)
+
+    def remove(self, key):
+        # type: (AttachDB, Text) -> None
+        self._storage().remove(key)
+
+    def remove_keys(self, keys):
+        # type: (AttachDB, Iterable[Text]) -> None
+        self._storage().remove_keys(keys)
+
+    def _attachments_stale(
+        self,  # type: AttachDB
+        attached,  # type: List[Attached]
+        requests,  # type: Dict[Text, Attach]
+        detached,  # type: Optional[str]
+    ):  # type: (...) -> bool
+        """Check whether other processes attached or detached volumes.
+
+        The cached attachments list only knows about the volumesReassign()
+        calls made through this object. Make sure that the devices of
+        the requested volumes that it shows as attached to this host are
+        still there, and that the one to detach is there if it shows it.
+        """
+        ours = {att.volume for att in attached if att.client == self._ourId}
+        names = {
+            req["volume"] for req in requests.values() if req["volume"] in ours
+        }
+        if detached is not None:
+            names.add(detached)
+        return any(
+            os.path.exists(os.path.join(self._device_root, name))
+            != (name in ours)
+            for name in names
+        )
+
     def _get_attachments_data(
         self,  # type: AttachDB
-    ):  # type: (...) -> Tuple[Dict[Text, Attach], List[spapi.AttachmentDesc]]
-        pfx = self.volumePrefix()
-        attached = [
-            att
-            for att in self.api().attachmentsList()
-            if att.volume.startswith(pfx)
+        requests=None,  # type: Optional[Dict[Text, Attach]]
+        detached=None,  # type: Optional[str]
+    ):  # type: (...) -> Tuple[Dict[Text, Attach], List[Attached]]
+        def fetch():
+            # type: () -> List[Attached]
+            pfx = self.volumePrefix()
+            return [
+                Attached(att.volume, att.client, att.snapshot, att.rights)
+                for att in self.api().attachmentsList()
+                if att.volume.startswith(pfx)
+            ]
+
+        if requests is None:
+            requests = self.get()
+        cached = self._inventory_get("attachments")
+        if cached is not None and self._attachments_stale(
+            cached, requests, detached
+        ):
+            with self._inventory_lock:
+                self._inventory.pop("attachments", None)
+        return (requests, self._cached("attachments", fetch))
+
+    def _existing(self, names, volsnap):
+        # type: (AttachDB, List[str], bool) -> Set[str]
+        """Return those of the volumes or snapshots that actually exist.
+
+        For a few names, ask the StorPool API about each of them;
+        otherwise fetch the list of all the volumes or snapshots.
+        """
+        what = "snapshots" if volsnap else "volumes"
+        found = set()  # type: Set[str]
+        cached = self._inventory_get(what)
+        if cached is not None:
+            found = {name for name in names if name in cached}
+            # The rest may have been created since we last looked.
+            names = [name for name in names if name not in found]
+        if not names:
+            return found
+
+        api = self.api()
+        if len(names) <= EXISTS_QUERY_MAX:
+            query = api.snapshotList if volsnap else api.volumeList
+            for name in names:
+                try:
+                    query(name)
+                except spapi.ApiError as err:
+                    if err.name != "objectDoesNotExist":
+                        raise
+                    continue
+                found.add(name)
+            return found
+
+        now = splocked.monotonic()
+        objects = api.snapshotsList() if volsnap else api.volumesList()
+        all_names = {obj.name for obj in objects}
+        with self._inventory_lock:
+            self._inventory[what] = (now, all_names)
+        return found | {name for name in names if name in all_names}
+
+    def _sync_plan(
+        self,  # type: AttachDB
+        req_id,  # type: str
+        detached,  # type: Optional[str]
+        requests=None,  # type: Optional[Dict[Text, Attach]]
+    ):  # type: (...) -> Optional[SyncPlan]
+        """Figure out what needs to be attached, forgotten, or detached.
+
+        If `requests` is specified, it is used instead of the contents
+        of the attachment database, so that this method may be invoked
+        in a thread that does not hold the lock.
+        """
+        (attach_req_d, apiatt) = self._get_attachments_data(requests, detached)
+
+        attach = attach_req_d.get(req_id, None)
+        if attach is None:
+            if detached is not None:
+                # Ach, let's just hope for the best...
+                self.LOG.warn(
+                    "StorPoolDriver._attach_sync() invoked for detaching "
+                    "for unknown request {req}, ignored".format(req=req_id)
+                )
+                return None
+            raise Exception(
+                "StorPoolDriver._attach_sync() invoked for unknown "
+                "request {req}".format(req=req_id)
+            )
+
+        # OK, let's first see what *should be* attached
+        vols = {}  # type: Dict[str, Attach]
+        if detached is None:
+            attach_req = list(attach_req_d.values())
+        else:
+            # Detaching this particular volume in this request?
+            attach_req = [
+                att
+                for att in attach_req_d.values()
+                if att["volume"] != detached or att["id"] != req_id
+            ]
+        vol_to_reqs = collections.defaultdict(list)
+        for att in attach_req:
+            vname = att["volume"]
+            vol_to_reqs[vname].append(att["id"])
+            if vname not in vols or vols[vname]["rights"] < att["rights"]:
+                vols[vname] = {
+                    "volume": vname,
+                    "type": "n/a",
+                    "id": "n/a",
+                    "rights": att["rights"],
+                    "volsnap": att.get("volsnap", False),
+                    "remove_on_detach": att.get("remove_on_detach", False),
+                }
+
+        # OK, let's see what *is* attached
+        apiatt = [att for att in apiatt if att.client == self._ourId]
+        attached = {
+            att.volume: {
+                "volume": att.volume,
+                "type": "n/a",
+                "id": "n/a",
+                "rights": 2 if att.rights == "rw" else 1,
+                "volsnap": att.snapshot,
+                "remove_on_detach": False,
+            }
+            for att in apiatt
+        }  # type: Dict[str, Attach]
+
+        # Right, do we need to do anything now?
+        wanted = [
+            v
+            for v in vols.values()
+            if v["volume"] not in attached
+            or attached[v["volume"]]["rights"] < v["rights"]
         ]
-        return (self.get(), attached)
+        all_vols = self._existing(
+            [v["volume"] for v in wanted if not v["volsnap"]], False
+        )
+        all_sns = self._existing(
+            [v["volume"] for v in wanted if v["volsnap"]], True
+        )
+        to_attach = []  # type: List[Tuple[str, bool, int]]
+        vols_to_remove = []
+        for v in wanted:
+            n = v["volume"]
+            volsnap = v["volsnap"]
+            if n not in (all_sns if volsnap else all_vols):
+                vols_to_remove.append(n)
+                continue
+            to_attach.append((n, volsnap, v["rights"]))
+
+        # Clean up stale volume assignments
+        reqs_to_remove = []  # type: List[str]
+        for vname in vols_to_remove:
+            reqs_to_remove.extend(vol_to_reqs[vname])
+
+        # Finally, are we trying to detach anything?
+        to_detach = None  # type: Optional[Tuple[str, bool]]
+        if detached in attached:
+            to_detach = (detached, attached[detached]["volsnap"])
+
+        return SyncPlan(
+            attach=to_attach, remove=reqs_to_remove, detach=to_detach
+        )
 
     def sync(self, req_id, detached):
         # type: (AttachDB, str, Optional[str]) -> None
         assert self._ourId is not None and self._ourId != -1
 
-        with self:
-            (attach_req_d, apiatt) = self._get_attachments_data()
+        # Only lock the attachment database exclusively if there is
+        # actually something to do.
+        with self.shared():
+            plan = self._sync_plan(req_id, detached)
+            if plan is None or not (
+                plan.attach or plan.remove or plan.detach is not None
+            ):
+                return
+
+            lock_gen = self.lock_generation()
+            with self:
+                if self.lock_generation() != lock_gen:
+                    # The lock was dropped while upgrading it, look again.
+                    plan = self._sync_plan(req_id, detached)
+                    if plan is None:
+                        return
+
+                if plan.attach:
+                    try:
+                        self._attach_many_and_wait(
+                            client=self._ourId, volumes=plan.attach
+                        )
+                    except spapi.ApiError as err:
+                        if not self._attach_missing(err):
+                            raise
+                        # Some of the volumes were deleted since we last
+                        # looked; the inventory was invalidated, so look
+                        # again and forget about them.
+                        plan = self._sync_plan(req_id, detached)
+                        if plan is None:
+                            return
+                        if plan.attach:
+                            self._attach_many_and_wait(
+                                client=self._ourId, volumes=plan.attach
+                            )
 
-            attach = attach_req_d.get(req_id, None)
-            if attach is None:
-                if detached is not None:
-                    # Ach, let's just hope for the best...
-                    self.LOG.warn(
-                        "StorPoolDriver._attach_sync() invoked for detaching "
-                        "for unknown request {req}, ignored".format(req=req_id)
+                if plan.remove:
+                    self.remove_keys(plan.remove)
+
+                if plan.detach is not None:
+                    self._detach_and_wait(
+                        client=self._ourId,
+                        volume=plan.detach[0],
+                        volsnap=plan.detach[1],
                     )
-                    return
-                raise Exception(
-                    "StorPoolDriver._attach_sync() invoked for unknown "
-                    "request {req}".format(req=req_id)
-                )
 
-            # OK, let's first see what *should be* attached
-            vols = {}  # type: Dict[str, Attach]
-            if detached is None:
-                attach_req = list(attach_req_d.values())
+    def sync_async(self, req_id, detached):
+        # type: (AttachDB, str, Optional[str]) -> Coroutine[Any, Any, None]
+        """Return a coroutine that does what sync() does.
+
+        The coroutine does not block the event loop while waiting for
+        the lock, the StorPool API, or the attached devices to appear.
+        This method is only available on Python 3.7 or later.
+        """
+        res = splocked.async_support().sync(self, req_id, detached)
+        assert isinstance(res, Coroutine)
+        return res
+
+    def _attach_many_request(self, client, volumes):
+        # type: (AttachDB, int, List[Tuple[str, bool, int]]) -> List[str]
+        """Ask for several volumes or snapshots to be attached at once.
+
+        The `volumes` list contains (volume, volsnap, rights) tuples;
+        a single volumesReassign() request is sent for all of them.
+        Return the paths to the devices that should show up.
+        """
+        reqs = []  # type: List[Dict[str, Any]]
+        modes = []  # type: List[str]
+        for (volume, volsnap, rights) in volumes:
+            if volsnap:
+                if rights > 1:
+                    raise spapi.ApiError(
+                        "StorPool: cannot attach a snapshot in read/write mode"
+                    )
+                reqs.append({"snapshot": volume, "ro": [client]})
+                modes.append("ro")
             else:
-                # Detaching this particular volume in this request?
-                attach_req = [
-                    att
-                    for att in attach_req_d.values()
-                    if att["volume"] != detached or att["id"] != req_id
-                ]
-            vol_to_reqs = collections.defaultdict(list)
-            for att in attach_req:
-                vname = att["volume"]
-                vol_to_reqs[vname].append(att["id"])
-                if vname not in vols or vols[vname]["rights"] < att["rights"]:
-                    vols[vname] = {
-                        "volume": vname,
-                        "type": "n/a",
-                        "id": "n/a",
-                        "rights": att["rights"],
-                        "volsnap": att.get("volsnap", False),
-                        "remove_on_detach": att.get("remove_on_detach", False),
-                    }
+                mode = "rw" if rights == 2 else "ro"
+                reqs.append({"volume": volume, mode: [client]})
+                modes.append(mode)
+        try:
+            self.api().volumesReassign(json=reqs)
+        except spapi.ApiError:
+            self.invalidateInventory()
+            raise
+        for (volume, volsnap, _), mode in zip(volumes, modes):
+            self._inventory_attached(client, volume, volsnap, mode)
+        return [
+            os.path.join(self._device_root, volume)
+            for (volume, _, _) in volumes
+        ]
 
-            # OK, let's see what *is* attached
-            apiatt = [att for att in apiatt if att.client == self._ourId]
-            attached = {
-                att.volume: {
-                    "volume": att.volume,
-                    "type": "n/a",
-                    "id": "n/a",
-                    "rights": 2 if att.rights == "rw" else 1,
-                    "volsnap": att.snapshot,
-                    "remove_on_detach": False,
-                }
-                for att in apiatt
-            }  # type: Dict[str, Attach]
-
-            # Right, do we need to do anything now?
-            all_vols = {v.name: True for v in self.api().volumesList()}
-            all_sns = {s.name: True for s in self.api().snapshotsList()}
-            vols_to_remove = []
-            for v in vols.values():
-                n = v["volume"]
-                if n in attached and attached[n]["rights"] >= v["rights"]:
-                    continue
-                volsnap = v["volsnap"]
-                if v["volume"] not in (all_sns if volsnap else all_vols):
-                    vols_to_remove.append(v["volume"])
-                    continue
-                self._attach_and_wait(
-                    client=self._ourId,
-                    volume=n,
-                    volsnap=volsnap,
-                    rights=v["rights"],
-                )
+    def _attach_request(self, client, volume, volsnap, rights):
+        # type: (AttachDB, int, str, bool, int) -> str
+        """Ask for a volume or snapshot to be attached, return its path."""
+        paths = self._attach_many_request(client, [(volume, volsnap, rights)])
+        return paths[0]
 
-            # Clean up stale volume assignments
-            if vols_to_remove:
-                reqs_to_remove = []
-                for vname in vols_to_remove:
-                    reqs_to_remove.extend(vol_to_reqs[vname])
-                if reqs_to_remove:
-                    self.remove_keys(reqs_to_remove)
-
-            # Finally, are we trying to detach anything?
-            if detached in attached:
-                self._detach_and_wait(
-                    client=self._ourId,
-                    volume=detached,
-                    volsnap=attached[detached]["volsnap"],
+    def _devices_missing(self, waiter):
+        # type: (AttachDB, DeviceWaiter) -> List[str]
+        """Complain about any devices that did not show up in time."""
+        if waiter.pending:
+            self.LOG.warn(
+                "StorPool: the {paths} device(s) did not show up within "
+                "{timeout} seconds".format(
+                    paths=", ".join(waiter.pending), timeout=waiter.timeout
                 )
+            )
+        return waiter.pending
+
+    def _wait_for_devices(self, devpaths):
+        # type: (AttachDB, List[str]) -> List[str]
+        """Wait for the devices to show up, return the missing ones."""
+        with DeviceWaiter(devpaths, root=self._device_root) as waiter:
+            waiter.wait()
+            return self._devices_missing(waiter)
+
+    def _attach_many_and_wait(self, client, volumes):
+        # type: (AttachDB, int, List[Tuple[str, bool, int]]) -> None
+        self._wait_for_devices(self._attach_many_request(client, volumes))
 
     def _attach_and_wait(self, client, volume, volsnap, rights):
         # type: (AttachDB, int, str, bool, int) -> None
-        if volsnap:
-            if rights > 1:
-                raise spapi.ApiError(
-                    "StorPool: cannot attach a snapshot in read/write mode"
-                )
-            self.api().volumesReassign(
-                json=[{"snapshot": volume, "ro": [client]}]
-            )
-        else:
-            mode = "rw" if rights == 2 else "ro"
+        self._attach_many_and_wait(client, [(volume, volsnap, rights)])
+
+    def _detach_request(self, client, volume, volsnap, force):
+        # type: (AttachDB, int, str, bool, bool) -> None
+        """Ask for a volume or snapshot to be detached."""
+        try:
             self.api().volumesReassign(
-                json=[{"volume": volume, mode: [client]}]
+                json=[
+                    {
+                        "snapshot" if volsnap else "volume": volume,
+                        "detach": [client],
+                        "force": force,
+                    }
+                ]
             )
-        devpath = "/dev/storpool/" + volume
-        for i in range(10):
-            if os.path.exists(devpath):
-                break
-            time.sleep(1)
+        except spapi.ApiError:
+            self.invalidateInventory()
+            raise
+        self._inventory_attached(client, volume, volsnap, None)
+
+    @staticmethod
+    def _attach_missing(err):
+        # type: (spapi.ApiError) -> bool
+        """Check whether a volume or snapshot to attach does not exist."""
+        return err.name == "objectDoesNotExist"
+
+    @staticmethod
+    def _detach_busy(err):
+        # type: (spapi.ApiError) -> bool
+        """Check whether the volume could not be detached since it is open."""
+        return (
+            err.name in ("busy", "invalidParam") and "is open at" in err.desc
+        )
 
     def _detach_and_wait(self, client, volume, volsnap):
         # type: (AttachDB, int, str, bool) -> None
         count = 10
         while True:
             try:
-                force = count == 0
-                if volsnap:
-                    self.api().volumesReassign(
-                        json=[
-                            {
-                                "snapshot": volume,
-                                "detach": [client],
-                                "force": force,
-                            }
-                        ]
-                    )
-                else:
-                    self.api().volumesReassign(
-                        json=[
-                            {
-                                "volume": volume,
-                                "detach": [client],
-                                "force": force,
-                            }
-                        ]
-                    )
+                self._detach_request(client, volume, volsnap, count == 0)
                 break
             except spapi.ApiError as e:
-                if (
-                    e.name in ("busy", "invalidParam")
-                    and "is open at" in e.desc
-                ):
+                if self._detach_busy(e):
                     assert count > 0
-                    time.sleep(0.2)
+                    spgreen.sleep(0.2)
                     count -= 1
                 else:
                     raise
@@ -0,0 +1,185 @@
+#
+# -
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Cooperate with the eventlet or gevent green threads if needed.
+
+The OpenStack services usually run under eventlet, so waiting for
+a lock or a device by blocking the whole OS thread would stall all
+the other green threads. In the cooperative mode the waits yield to
+the hub instead, and the in-process locks are owned by green threads.
+"""
+
+import importlib
+import select
+import sys
+import threading
+import time
+
+try:
+    from typing import Any, Union
+except ImportError:
+    pass
+
+
+AUTO = "auto"
+NATIVE = "native"
+EVENTLET = "eventlet"
+GEVENT = "gevent"
+
+MODES = (AUTO, NATIVE, EVENTLET, GEVENT)
+
+_mode = AUTO
+
+
+def _patched(modname, funcname, arg):
+    # type: (str, str, str) -> bool
+    """Check whether a green threads library has been loaded and applied."""
+    mod = sys.modules.get(modname)
+    if mod is None:
+        return False
+    return bool(getattr(mod, funcname)(arg))
+
+
+def detect():
+    # type: () -> str
+    """Figure out whether the threading module has been monkey-patched."""
+    if _patched("eventlet.patcher", "is_monkey_patched", "thread"):
+        return EVENTLET
+    if _patched("gevent.monkey", "is_module_patched", "threading"):
+        return GEVENT
+    return NATIVE
+
+
+def set_mode(mode):
+    # type: (str) -> None
+    """Select the cooperative mode explicitly or go back to auto-detection.
+
+    This should be done at startup, before any locks are created.
+    """
+    global _mode
+    if mode not in MODES:
+        raise ValueError("Invalid green threads mode {m!r}".format(m=mode))
+    _mode = mode
+
+
+def mode():
+    # type: () -> str
+    """Return the mode in effect: NATIVE, EVENTLET, or GEVENT."""
+    return detect() if _mode == AUTO else _mode
+
+
+def cooperative():
+    # type: () -> bool
+    """Check whether we should yield to a green threads hub."""
+    return mode() != NATIVE
+
+
+def sleep(seconds):
+    # type: (float) -> None
+    """Sleep, letting the other green threads run if needed."""
+    active = mode()
+    if active == NATIVE:
+        time.sleep(seconds)
+    else:
+        importlib.import_module(active).sleep(seconds)
+
+
+def wait_readable(fd, timeout):
+    # type: (int, float) -> bool
+    """Wait for a file descriptor to become readable, return False on timeout.
+
+    In the cooperative mode, let the other green threads run meanwhile.
+    """
+    active = mode()
+    if active == NATIVE:
+        # select(2) cannot handle file descriptors above FD_SETSIZE.
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+
+    if active == EVENTLET:
+        selector = importlib.import_module("eventlet.green.select")
+    else:
+        selector = importlib.import_module("gevent.select")
+    return bool(selector.select([fd], [], [], timeout)[0])
+
+
+def current():
+    # type: () -> Any
+    """Return an object that identifies the current (green) thread."""
+    if cooperative():
+        return importlib.import_module("greenlet").getcurrent()
+    return threading.current_thread()
+
+
+class SPGreenRLock(object):
+    """A reentrant lock owned by a green thread, not by an OS thread."""
+
+    def __init__(self, sem):
+        # type: (SPGreenRLock, Any) -> None
+        self._sem = sem
+        self._owner = None  # type: Any
+        self._count = 0
+
+    def acquire(self, blocking=True, timeout=-1.0):
+        # type: (SPGreenRLock, bool, float) -> bool
+        me = current()
+        if self._owner is me:
+            self._count += 1
+            return True
+
+        if not blocking:
+            ok = self._sem.acquire(False)
+        else:
+            ok = self._sem.acquire(True, None if timeout < 0 else timeout)
+        if not ok:
+            return False
+        self._owner = me
+        self._count = 1
+        return True
+
+    def release(self):
+        # type: (SPGreenRLock) -> None
+        if self._owner is not current():
+            raise RuntimeError("Cannot release an unowned lock")
+        self._count -= 1
+        if self._count == 0:
+            self._owner = None
+            self._sem.release()
+
+    def __enter__(self):
+        # type: (SPGreenRLock) -> bool
+        return self.acquire()
+
+    def __exit__(self, etype, eval, tb):
+        # type: (SPGreenRLock, Any, Any, Any) -> None
+        self.release()
+
+
+def rlock():
+    # type: () -> Union[threading.RLock, SPGreenRLock]
+    """Create a reentrant lock suitable for the current mode."""
+    active = mode()
+    if active == EVENTLET:
+        sem = importlib.import_module("eventlet.semaphore").Semaphore(1)
+    elif active == GEVENT:
+        sem = importlib.import_module("gevent.lock").Semaphore(1)
+    else:
+        return threading.RLock()
+    return SPGreenRLock(sem)
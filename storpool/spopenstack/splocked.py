@@ -20,172 +20,1160 @@
 A trivial JSON key/value store protected by a lockfile.
 """
 
+import bisect
+import collections
 import errno
 import fcntl
-import json
+import importlib
+import io
+import itertools
 import os
-import posix
+import sys
 import threading
 import time
+import zlib
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2.x
+    from collections import Mapping  # type: ignore
 
 try:
     import types
 
-    from typing import Any, Dict, Iterable, Optional, Text, Type, TypeVar
+    from typing import (
+        Any,
+        Awaitable,
+        Callable,
+        Dict,
+        Iterable,
+        Iterator,
+        List,
+        Optional,
+        Set,
+        Text,
+        Tuple,
+        Type,
+        TypeVar,
+        Union,
+    )
+
+    CallSite = Tuple[str, int, str]
+    CacheEntry = Tuple[Tuple[int, ...], "SPSnapshot"]
 
     TExc = TypeVar("TExc", bound=BaseException)
 except ImportError:
     pass
 
+from . import spgreen
+from . import spserialize
+from . import spwatch
+
+
+# How long to wait for the lock by default, and how often to retry.
+LOCK_TIMEOUT = 10.0
+LOCK_POLL_MIN = 0.001
+LOCK_POLL_MAX = 0.05
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2.x
+    monotonic = time.time
+
+# The header of the SPJournalJSONDB file format, followed by a generation
+# number that changes whenever the journal is compacted.
+JOURNAL_MAGIC = b"SPJOURNAL 1 "
+JOURNAL_HEADER_LEN = len(JOURNAL_MAGIC) + 17
+
+# Do not bother compacting journals shorter than this many bytes.
+JOURNAL_COMPACT_MIN = 65536
+
+# The default number of files an SPShardedJSONDB store is split into.
+SHARD_COUNT = 8
+
+# The default limit on the total size of the files whose snapshots are
+# kept in the process-wide DECODED_CACHE; 0 disables the cache.
+DECODED_CACHE_BYTES = 16 * 1024 * 1024
 
-rlock = threading.RLock()
+# The upper bounds of the lock wait and hold time histogram buckets:
+# 1 ms, 2 ms, 4 ms, ..., about 16 s, and one more for anything longer.
+STATS_BUCKETS = [0.001 * 2 ** idx for idx in range(15)]
+
+# One in-process lock per file, so that threads working on different
+# files do not serialize against each other.
+_path_locks = (
+    {}
+)  # type: Dict[str, Union[threading.RLock, spgreen.SPGreenRLock]]
+_path_locks_lock = threading.Lock()
 
 
 class SPLockedFileError(Exception):
     """An error that occurred while locking the file."""
 
 
+def path_lock(fname):
+    # type: (str) -> Union[threading.RLock, spgreen.SPGreenRLock]
+    """Return the in-process lock that protects the specified file."""
+    path = os.path.abspath(fname)
+    with _path_locks_lock:
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = spgreen.rlock()
+            _path_locks[path] = lock
+        return lock
+
+
+class SPLockStats(object):
+    """Lock contention and hold time counters.
+
+    The wait and hold time histograms count the times that fall into
+    each of the STATS_BUCKETS intervals, plus one more for longer ones.
+    """
+
+    def __init__(self):
+        # type: (SPLockStats) -> None
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.failed = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_hist = [0] * (len(STATS_BUCKETS) + 1)
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.hold_hist = [0] * (len(STATS_BUCKETS) + 1)
+        self.hold_max_site = None  # type: Optional[CallSite]
+
+    def record_wait(self, elapsed, acquired):
+        # type: (SPLockStats, float, bool) -> None
+        """Count an attempt to obtain the lock that took `elapsed` seconds."""
+        with self._lock:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.failed += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+            self.wait_hist[bisect.bisect_left(STATS_BUCKETS, elapsed)] += 1
+
+    def record_retry(self):
+        # type: (SPLockStats) -> None
+        """Count a failed non-blocking attempt to obtain the lock."""
+        with self._lock:
+            self.retries += 1
+
+    def record_hold(self, elapsed, site):
+        # type: (SPLockStats, float, Optional[CallSite]) -> None
+        """Count a lock held for `elapsed` seconds, obtained at `site`."""
+        with self._lock:
+            self.hold_total += elapsed
+            if elapsed > self.hold_max or self.hold_max_site is None:
+                self.hold_max = max(self.hold_max, elapsed)
+                self.hold_max_site = site
+            self.hold_hist[bisect.bisect_left(STATS_BUCKETS, elapsed)] += 1
+
+    def add(self, other):
+        # type: (SPLockStats, SPLockStats) -> None
+        """Add the counters of another object to ours."""
+        with other._lock:
+            with self._lock:
+                self.acquired += other.acquired
+                self.failed += other.failed
+                self.retries += other.retries
+                self.wait_total += other.wait_total
+                self.wait_max = max(self.wait_max, other.wait_max)
+                self.hold_total += other.hold_total
+                if other.hold_max > self.hold_max or (
+                    self.hold_max_site is None
+                ):
+                    self.hold_max = max(self.hold_max, other.hold_max)
+                    self.hold_max_site = other.hold_max_site
+                for idx, count in enumerate(other.wait_hist):
+                    self.wait_hist[idx] += count
+                for idx, count in enumerate(other.hold_hist):
+                    self.hold_hist[idx] += count
+
+    def as_dict(self):
+        # type: (SPLockStats) -> Dict[str, Any]
+        """Return a snapshot of the counters."""
+        with self._lock:
+            site = self.hold_max_site
+            return {
+                "acquired": self.acquired,
+                "failed": self.failed,
+                "retries": self.retries,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+                "wait_hist": list(self.wait_hist),
+                "hold_total": self.hold_total,
+                "hold_max": self.hold_max,
+                "hold_hist": list(self.hold_hist),
+                "hold_max_site": (
+                    None
+                    if site is None
+                    else "{fname}:{line} in {func}".format(
+                        fname=site[0], line=site[1], func=site[2]
+                    )
+                ),
+            }
+
+
+# The statistics for all the locks obtained by this process.
+LOCK_STATS = SPLockStats()
+
+
+def stats():
+    # type: () -> Dict[str, Any]
+    """Return the statistics for all the locks obtained by this process."""
+    return LOCK_STATS.as_dict()
+
+
+class SPDecodedCache(object):
+    """The snapshots of the files recently read.
+
+    The SPLockedJSONDB objects for the same file share the snapshots
+    returned by their snapshot() methods, so that only the first one
+    to look at a new version of the file needs to decode and freeze it.
+    The snapshots cannot be modified, so they are shared as they are.
+    The entries are keyed by the file's path and spwatch.file_id(), and
+    the least recently used ones are dropped when the total size of
+    the files exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        # type: (SPDecodedCache, int) -> None
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = (
+            collections.OrderedDict()
+        )  # type: collections.OrderedDict[str, CacheEntry]
+        self._bytes = 0
+
+    def get(
+        self,  # type: SPDecodedCache
+        path,  # type: str
+        file_id,  # type: Tuple[int, ...]
+    ):  # type: (...) -> Optional[SPSnapshot]
+        """Return the snapshot if the file has not changed since."""
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None or entry[0] != file_id:
+                if entry is not None:
+                    self._bytes -= entry[0][2]
+                self.misses += 1
+                return None
+
+            # Mark it as the most recently used one.
+            self._entries[path] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(
+        self,  # type: SPDecodedCache
+        path,  # type: str
+        file_id,  # type: Tuple[int, ...]
+        snap,  # type: SPSnapshot
+    ):  # type: (...) -> None
+        """Remember the snapshot of a file's contents."""
+        size = file_id[2]
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[0][2]
+            if size > self.max_bytes:
+                return
+
+            self._entries[path] = (file_id, snap)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (dropped, _) = self._entries.popitem(last=False)
+                self._bytes -= dropped[2]
+
+    def clear(self):
+        # type: (SPDecodedCache) -> None
+        """Forget about all the files."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# The snapshots of the files used by all the SPLockedJSONDB objects.
+DECODED_CACHE = SPDecodedCache(DECODED_CACHE_BYTES)
+
+
+def call_site():
+    # type: () -> CallSite
+    """Return the file, line, and function of our first outside caller."""
+    package = __name__.rpartition(".")[0] + "."
+    frame = sys._getframe(1)
+    while frame.f_back is not None and frame.f_globals.get(
+        "__name__", ""
+    ).startswith(package):
+        frame = frame.f_back
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def async_support():
+    # type: () -> Any
+    """Import the spasync module; it only works on Python 3.7 or later.
+
+    The module is imported dynamically so that Python 2.x never needs
+    to parse its async/await syntax.
+    """
+    return importlib.import_module(__name__.rpartition(".")[0] + ".spasync")
+
+
+def _retry(
+    attempt,  # type: Callable[[], bool]
+    timeout,  # type: Optional[float]
+    on_retry=None,  # type: Optional[Callable[[], None]]
+):  # type: (...) -> bool
+    """Retry a non-blocking operation with an exponential backoff.
+
+    A timeout of None means keep trying for as long as it takes.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    delay = LOCK_POLL_MIN
+    while not attempt():
+        if deadline is None:
+            wait = delay
+        else:
+            wait = min(delay, deadline - monotonic())
+            if wait <= 0:
+                return False
+        if on_retry is not None:
+            on_retry()
+        spgreen.sleep(wait)
+        delay = min(delay * 2, LOCK_POLL_MAX)
+    return True
+
+
+def acquire_thread_lock(
+    lock,  # type: Union[threading.RLock, spgreen.SPGreenRLock]
+    timeout,  # type: Optional[float]
+):  # type: (...) -> bool
+    """Acquire a thread lock, waiting for at most `timeout` seconds."""
+    if timeout is None:
+        lock.acquire()
+        return True
+    if sys.version_info[0] >= 3:
+        return lock.acquire(True, timeout)
+    return _retry(lambda: lock.acquire(False), timeout)
+
+
+def _try_flock(fd, operation):
+    # type: (int, int) -> bool
+    """Try to lock a file without blocking."""
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except IOError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+
+def _flock(fd, operation, timeout, on_retry=None):
+    # type: (int, int, Optional[float], Optional[Callable[[], None]]) -> bool
+    """Lock a file, waiting for at most `timeout` seconds.
+
+    A timeout of None means block in the kernel until the lock is
+    released by its current holder, unless the other green threads
+    should be allowed to run in the meantime.
+    """
+    if timeout is None and not spgreen.cooperative():
+        fcntl.flock(fd, operation)
+        return True
+    return _retry(lambda: _try_flock(fd, operation), timeout, on_retry)
+
+
+def _read_fd(fd, offset=0):
+    # type: (int, int) -> bytearray
+    """Read a file from `offset` on into a single buffer sized by fstat(2)."""
+    size = max(os.fstat(fd).st_size - offset, 0)
+    contents = bytearray(size)
+    view = memoryview(contents)
+    pos = 0
+
+    os.lseek(fd, offset, os.SEEK_SET)
+    with io.FileIO(fd, "r", closefd=False) as reader:
+        while pos < size:
+            count = reader.readinto(view[pos:])
+            if not count:
+                break
+            pos += count
+
+        # Somebody must have modified the file without locking it.
+        if pos < size:
+            return contents[:pos]
+        rest = reader.read()
+        if rest:
+            return contents + rest
+
+    return contents
+
+
+def _write_fd(fd, contents):
+    # type: (int, bytes) -> None
+    """Write the whole buffer out, avoiding copies on partial writes."""
+    view = memoryview(contents)
+    pos = 0
+    while pos < len(contents):
+        pos += os.write(fd, view[pos:])
+
+
+def _copy_owner(fd, st):
+    # type: (int, os.stat_result) -> None
+    """Give a new file the owner and group of the one it stands in for.
+
+    Only a privileged process may give a file away to another user;
+    the group is still set, so that the group members keep their access.
+    """
+    try:
+        os.fchown(fd, st.st_uid, st.st_gid)
+    except OSError as err:
+        if err.errno != errno.EPERM:
+            raise
+        os.fchown(fd, -1, st.st_gid)
+
+
+def _fsync_dir(path):
+    # type: (str) -> None
+    """Make sure a file created or renamed in a directory stays there."""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError as err:
+        # Some filesystems cannot sync directories at all.
+        if err.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(fd)
+
+
 class SPLockedFile(object):
-    def __init__(self, fname):
-        # type: (SPLockedFile, str) -> None
+    def __init__(
+        self,  # type: SPLockedFile
+        fname,  # type: str
+        timeout=LOCK_TIMEOUT,  # type: Optional[float]
+        serializer=spserialize.JSON,  # type: spserialize.Serializer
+        inotify=False,  # type: bool
+        persistent=False,  # type: bool
+        atomic=False,  # type: bool
+        allowed=(),  # type: Iterable[spserialize.Serializer]
+    ):  # type: (...) -> None
+        """Initialize a locked file object.
+
+        The file is written using `serializer`; besides JSON, only
+        the formats of `serializer` and of the `allowed` serializers
+        are recognized when reading it, e.g. while switching the file
+        to another one.
+
+        If `inotify` is set, use inotify(7) if available to find out
+        whether the file has changed instead of examining it every time.
+
+        If `persistent` is set, keep the file open between the times it
+        is locked until close() is invoked, and only open it again if
+        the path refers to another file by then.
+
+        If `atomic` is set, the file is never modified in place: a new
+        version is written to a temporary file and renamed over it, and
+        the writers lock a separate `fname`.lock file instead. A shared
+        lock does not lock anything then; it only keeps the version of
+        the file that was current at the time open until it is released.
+        All the processes that use the file must agree on this setting.
+        The writers need write access to the directory that holds the file;
+        the new versions and the lock file get the mode, group, and,
+        if the writer is allowed to set it, the owner of the file.
+        """
         self._fname = fname
+        self._timeout = timeout
+        self._serializer = serializer
+        self._allowed = tuple(allowed)
+        self._rlock = path_lock(fname)
         self._fd = None  # type: Optional[int]
-        self._last = None  # type: Optional[posix.stat_result]
+        self._atomic = atomic
+        self._lockname = fname + ".lock" if atomic else fname
+        self._lfd = None  # type: Optional[int]
+        self._persistent = persistent
+        self._pfd = None  # type: Optional[int]
+        self._pfd_id = (0, 0)
+        self._pfd_pid = 0
+        self._watch = spwatch.watcher(fname, inotify)
+        self._fresh_gen = 0
         self._count = 0
+        self._mode = None  # type: Optional[int]
+        self._dropped = False
+        self._lock_gen = 0
+        self._owner = None  # type: Any
+        self._stats = SPLockStats()
+        self._held_since = 0.0
+        self._held_site = None  # type: Optional[CallSite]
 
     def changed(self):
         # type: (SPLockedFile) -> bool
-        last = self._last
-        try:
-            st = os.stat(self._fname)
-        except OSError:
-            if last is not None:
-                self._last = None
-                return True
-            else:
-                return False
-        if last is None:
+        """Check whether the file changed since we last read or wrote it.
+
+        Once the file has been found unchanged (or read or written)
+        while locked, nobody else can modify it until the lock is
+        released, so do not look at it again until then.
+        """
+        if self._fresh():
+            return False
+        if self._watch.changed(self._fd):
             return True
+        if self._count > 0:
+            self._fresh_gen = self._lock_gen
+        return False
 
-        assert isinstance(st, posix.stat_result)
-        assert isinstance(last, posix.stat_result)
-        return (
-            st.st_ino != last.st_ino
-            or st.st_mtime != last.st_mtime
-            or st.st_size != last.st_size
-        )
+    def _fresh(self):
+        # type: (SPLockedFile) -> bool
+        """Check whether the file was examined since it was last locked."""
+        return self._count > 0 and self._fresh_gen == self._lock_gen
+
+    def _mark(self, written):
+        # type: (SPLockedFile, bool) -> None
+        """Note that the file was just read or written while locked."""
+        self._watch.mark(written, self._fd)
+        self._fresh_gen = self._lock_gen
+
+    def _open(self):
+        # type: (SPLockedFile) -> int
+        """Open the file to lock or reuse the descriptor kept open."""
+        if not self._persistent:
+            return self._open_lockfile()
+
+        if self._pfd is not None and self._pfd_pid != os.getpid():
+            # Do not share the open file description (and the lock on it)
+            # with the parent process.
+            self.close()
+        if self._pfd is None:
+            fd = self._open_lockfile()
+            st = os.fstat(fd)
+            self._pfd = fd
+            self._pfd_id = (st.st_dev, st.st_ino)
+            self._pfd_pid = os.getpid()
+        return self._pfd
 
-    def _open_and_lock(self):
-        # type: (SPLockedFile) -> Optional[int]
-        """Try to open the file and lock it."""
-        locked = False
-        f = os.open(self._fname, os.O_RDWR, 0o600)
+    def _open_lockfile(self):
+        # type: (SPLockedFile) -> int
+        """Open the file to lock, create a missing lock file if needed."""
         try:
-            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            locked = True
-            return f
-        except IOError as err:
-            if err.errno == errno.EAGAIN:
-                return None
+            return os.open(self._lockname, os.O_RDWR, 0o600)
+        except OSError as err:
+            if not self._atomic or err.errno != errno.ENOENT:
+                raise
+
+        # Let the same users and groups lock it as can read the data.
+        st = os.stat(self._fname)
+        mode = st.st_mode & 0o666
+        try:
+            fd = os.open(
+                self._lockname, os.O_RDWR | os.O_CREAT | os.O_EXCL, mode
+            )
+        except OSError as err:
+            # Somebody else created it in the meantime.
+            if err.errno != errno.EEXIST:
+                raise
+            return os.open(self._lockname, os.O_RDWR, 0o600)
+
+        try:
+            _copy_owner(fd, st)
+            os.fchmod(fd, mode)
+        except Exception:
+            # Do not leave a lock file that the others may not open.
+            os.unlink(self._lockname)
+            os.close(fd)
             raise
-        finally:
+        return fd
+
+    def _done(self, fd):
+        # type: (SPLockedFile, int) -> None
+        """Unlock the file and close it unless it should be kept open."""
+        if self._persistent:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.close(fd)
+
+    def _replaced(self):
+        # type: (SPLockedFile) -> bool
+        """Check whether the path now refers to another file."""
+        try:
+            st = os.stat(self._lockname)
+        except OSError:
+            return True
+        return (st.st_dev, st.st_ino) != self._pfd_id
+
+    def _lock_fd(self, operation, timeout):
+        # type: (SPLockedFile, int, Optional[float]) -> bool
+        """Open the file and lock it, waiting for at most `timeout` seconds."""
+        if self._atomic and operation == fcntl.LOCK_SH:
+            # Hold on to the current version, whatever the writers do.
+            self._fd = os.open(self._fname, os.O_RDONLY)
+            self._mode = operation
+            return True
+
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            f = self._open()
+            try:
+                locked = _flock(
+                    f,
+                    operation,
+                    None
+                    if deadline is None
+                    else max(deadline - monotonic(), 0),
+                    self._record_retry,
+                )
+            except Exception:
+                self._done(f)
+                raise
+
             if not locked:
-                os.close(f)
+                self._done(f)
+                return False
+            if not self._persistent or not self._replaced():
+                break
 
-    def __enter__(self):
+            # Somebody replaced or removed the file before we locked it.
+            # A shared lock may still be held in atomic mode, so do not
+            # go through close().
+            self._done(f)
+            os.close(f)
+            self._pfd = None
+
+        if self._atomic:
+            try:
+                self._fd = os.open(self._fname, os.O_RDONLY)
+            except Exception:
+                self._done(f)
+                raise
+            self._lfd = f
+        else:
+            self._fd = f
+        self._mode = operation
+        return True
+
+    def _upgrade(self, timeout, retry=False):
+        # type: (SPLockedFile, Optional[float], bool) -> bool
+        """Convert a shared lock into an exclusive one.
+
+        The conversion is not atomic: flock(2) drops the shared lock
+        before trying to obtain the exclusive one, so another process may
+        modify the file in the meantime; see lock_generation().
+
+        If `retry` is set, the caller will try again, so a failed attempt
+        does not wait to take the shared lock back; the next _acquire()
+        that does not upgrade the lock does that.
+        """
+        assert self._fd is not None
+        if self._atomic:
+            # Nobody else may write it now, so look at the latest version.
+            old = self._fd
+            if not self._lock_fd(fcntl.LOCK_EX, timeout):
+                return False
+            os.close(old)
+            self._relocked()
+            return True
+
+        if _flock(self._fd, fcntl.LOCK_EX, timeout, self._record_retry):
+            self._mode = fcntl.LOCK_EX
+            self._dropped = False
+            self._relocked()
+            return True
+
+        # A failed conversion leaves the file unlocked; restore the shared
+        # lock that the outer levels expect to hold.
+        if retry or self._dropped:
+            self._dropped = True
+            return False
+        _flock(self._fd, fcntl.LOCK_SH, None)
+        self._relocked()
+        return False
+
+    def _restore(self, timeout):
+        # type: (SPLockedFile, Optional[float]) -> bool
+        """Take back the lock dropped by a failed upgrade."""
+        assert self._fd is not None and self._mode is not None
+        if not _flock(self._fd, self._mode, timeout, self._record_retry):
+            return False
+        self._dropped = False
+        self._relocked()
+        return True
+
+    def _relocked(self):
         # type: (SPLockedFile) -> None
-        rlock.acquire()
-        self._count += 1
+        """Bump the lock generation if the file changed while unlocked."""
+        if self._watch.changed(self._fd):
+            self._lock_gen += 1
 
-        if self._count > 1:
-            assert self._fd is not None
-            return
+    def _acquire(self, timeout, operation=fcntl.LOCK_EX, retry=False):
+        # type: (SPLockedFile, Optional[float], int, bool) -> bool
+        """Obtain the thread and file locks, possibly recursively."""
+        start = monotonic()
+        deadline = None if timeout is None else start + timeout
+        if not acquire_thread_lock(self._rlock, timeout):
+            self._record_wait(start, False, retry)
+            return False
 
-        assert self._fd is None
-        f = None
         try:
-            for x in range(100):
-                f = self._open_and_lock()
-                if f is not None:
-                    break
-                time.sleep(0.1)
+            remaining = (
+                None if deadline is None else max(deadline - monotonic(), 0)
+            )
+            if self._count > 0:
+                assert self._fd is not None
+                if operation == fcntl.LOCK_EX and self._mode != fcntl.LOCK_EX:
+                    upgraded = self._upgrade(remaining, retry)
+                    self._record_wait(start, upgraded, retry)
+                    if not upgraded:
+                        self._rlock.release()
+                        return False
+                elif self._dropped and not self._restore(remaining):
+                    self._record_wait(start, False, retry)
+                    self._rlock.release()
+                    return False
             else:
-                raise SPLockedFileError(
-                    "Could not lock the {f} file".format(f=self._fname)
-                )
+                assert self._fd is None
+                locked = self._lock_fd(operation, remaining)
+                self._record_wait(start, locked, retry)
+                if not locked:
+                    self._rlock.release()
+                    return False
+                self._lock_gen += 1
+                self._held_since = monotonic()
+                self._held_site = call_site()
         except Exception:
-            if f is not None:
-                os.close(f)
-
-            self._count -= 1
-            rlock.release()
+            self._rlock.release()
             raise
 
-        assert f is not None
-        self._fd = f
+        if self._count == 0:
+            self._owner = spgreen.current()
+        self._count += 1
+        return True
 
-    def __exit__(
-        self,  # type: SPLockedFile
-        etype,  # type: Optional[Type[TExc]]
-        eval,  # type: Optional[TExc]
-        tb,  # type: Optional[types.TracebackType]
-    ):  # type: (...) -> None
+    def _release(self):
+        # type: (SPLockedFile) -> None
+        """Release one level of the thread and file locks."""
         if self._count > 1:
             self._count -= 1
-            rlock.release()
+            self._rlock.release()
             return
 
         assert self._fd is not None
-        os.close(self._fd)
+        if self._atomic:
+            os.close(self._fd)
+            if self._lfd is not None:
+                self._done(self._lfd)
+                self._lfd = None
+        else:
+            self._done(self._fd)
         self._fd = None
+        self._mode = None
+        self._dropped = False
+        self._owner = None
 
-        # If no exceptions have been raised, update the stat(2) cache
-        if etype is None:
-            try:
-                self._last = os.stat(self._fname)
-            except OSError:
-                self._last = None
+        held = monotonic() - self._held_since
+        self._stats.record_hold(held, self._held_site)
+        LOCK_STATS.record_hold(held, self._held_site)
 
         self._count -= 1
-        rlock.release()
+        self._rlock.release()
+
+    def close(self):
+        # type: (SPLockedFile) -> None
+        """Close the file descriptor kept open in persistent mode."""
+        if self._pfd is not None:
+            assert self._count == 0 or self._pfd_pid != os.getpid()
+            os.close(self._pfd)
+            self._pfd = None
+
+    def __del__(self):
+        # type: (SPLockedFile) -> None
+        if getattr(self, "_pfd", None) is not None:
+            self.close()
+
+    def _record_wait(self, start, acquired, retry=False):
+        # type: (SPLockedFile, float, bool, bool) -> None
+        """Update the statistics after trying to obtain the lock.
+
+        If `retry` is set, a failed attempt is counted as a retry.
+        """
+        if retry and not acquired:
+            self._record_retry()
+            return
+        elapsed = monotonic() - start
+        self._stats.record_wait(elapsed, acquired)
+        LOCK_STATS.record_wait(elapsed, acquired)
+
+    def _record_retry(self):
+        # type: (SPLockedFile) -> None
+        """Update the statistics when the file is locked by somebody else."""
+        self._stats.record_retry()
+        LOCK_STATS.record_retry()
+
+    def stats(self):
+        # type: (SPLockedFile) -> Dict[str, Any]
+        """Return the lock statistics for this object.
+
+        See the module-level stats() function for the ones for all
+        the locks obtained by this process.
+        """
+        return self._stats.as_dict()
+
+    def lock_generation(self):
+        # type: (SPLockedFile) -> int
+        """Return a counter bumped whenever the lock is obtained.
+
+        Upgrading a shared lock may release it for a while; the counter
+        is also bumped if the file was modified in the meantime, so
+        callers that have read the file before upgrading should check
+        whether this value changed.
+        """
+        return self._lock_gen
+
+    def _owned(self):
+        # type: (SPLockedFile) -> bool
+        """Check whether the current thread holds the lock."""
+        return self._count > 0 and self._owner is spgreen.current()
+
+    def acquire(self, timeout=-1.0, shared=False):
+        # type: (SPLockedFile, Optional[float], bool) -> None
+        """Lock the file, waiting for at most `timeout` seconds.
+
+        A negative timeout means use the one passed to the constructor;
+        None means wait until the lock is released, however long it takes.
+        An exclusive lock requested while holding a shared one upgrades
+        it until the outermost level is released.
+        """
+        if timeout is not None and timeout < 0:
+            timeout = self._timeout
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not self._acquire(timeout, operation):
+            raise SPLockedFileError(
+                "Could not lock the {f} file".format(f=self._fname)
+            )
+
+    def try_lock(self, shared=False, retry=False):
+        # type: (SPLockedFile, bool, bool) -> bool
+        """Try to lock the file once, do not wait if it is already locked.
+
+        If `retry` is set, the caller will poll until the lock is obtained
+        or give up by invoking try_lock() once more without it: a failed
+        attempt is counted as a retry and not as a failure, and a shared
+        lock being upgraded is not waited for; it is taken back by
+        the next try_lock(shared=True) call.
+        """
+        return self._acquire(
+            0, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, retry
+        )
+
+    def release(self):
+        # type: (SPLockedFile) -> None
+        """Release a lock obtained by acquire() or try_lock()."""
+        self._release()
+
+    def shared(self):
+        # type: (SPLockedFile) -> SPSharedLock
+        """Return a context manager that holds a shared lock on the file."""
+        return SPSharedLock(self)
+
+    def __enter__(self):
+        # type: (SPLockedFile) -> None
+        self.acquire()
+
+    def __exit__(
+        self,  # type: SPLockedFile
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._release()
+
+    def __aenter__(self):
+        # type: (SPLockedFile) -> Awaitable[None]
+        """Lock the file exclusively without blocking the event loop."""
+        res = async_support().acquire(self, self._timeout)
+        assert isinstance(res, Awaitable)
+        return res
+
+    def __aexit__(
+        self,  # type: SPLockedFile
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        res = async_support().release(self, etype, eval, tb)
+        assert isinstance(res, Awaitable)
+        return res
 
     def jsload(self):
         # type: (SPLockedFile) -> Any
-        with self:
+        with self.shared():
             assert self._fd is not None
-            os.lseek(self._fd, 0, os.SEEK_SET)
-            contents = b""
-            while True:
-                chunk = os.read(self._fd, 8192)
-                if not chunk:
-                    break
-                contents += chunk
-
-            return json.loads(contents)
+            contents = _read_fd(self._fd)
+            self._mark(False)
+            return spserialize.detect(
+                contents, self._serializer, self._allowed
+            ).loads(contents)
 
     def jsdump(self, obj):
         # type: (SPLockedFile, Any) -> None
         with self:
             assert self._fd is not None
-            contents = json.dumps(obj).encode("UTF-8")
+            contents = self._serializer.dumps(obj)
+
+            if self._atomic:
+                self._replace(contents)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.ftruncate(self._fd, 0)
+                _write_fd(self._fd, contents)
+            self._mark(True)
+
+    def _replace(self, contents):
+        # type: (SPLockedFile, bytes) -> None
+        """Write a new version of the file, rename it over the old one."""
+        assert self._fd is not None
+        st = os.fstat(self._fd)
+        mode = st.st_mode & 0o7777
+        tempname = "{fname}.tmp.{pid}.{tid}".format(
+            fname=self._fname,
+            pid=os.getpid(),
+            tid=threading.current_thread().ident,
+        )
+        # Nobody else may be writing it, since we hold the lock.
+        fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            try:
+                # Changing the owner may reset the set-user-ID bits.
+                _copy_owner(fd, st)
+                os.fchmod(fd, mode)
+                _write_fd(fd, contents)
+                # Do not let a crash leave an empty file behind.
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(tempname, self._fname)
+        except Exception:
+            os.unlink(tempname)
+            raise
+        _fsync_dir(self._fname)
+
+        fd = os.open(self._fname, os.O_RDONLY)
+        os.close(self._fd)
+        self._fd = fd
+
+
+class SPSharedLock(object):
+    """Hold a shared lock on an SPLockedFile object."""
+
+    def __init__(self, locked):
+        # type: (SPSharedLock, Union[SPLockedFile, SPShardedJSONDB]) -> None
+        self._locked = locked
+
+    def __enter__(self):
+        # type: (SPSharedLock) -> None
+        self._locked.acquire(shared=True)
+
+    def __exit__(
+        self,  # type: SPSharedLock
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._locked.__exit__(etype, eval, tb)
 
-            os.lseek(self._fd, 0, os.SEEK_SET)
-            os.ftruncate(self._fd, 0)
-            while contents:
-                written = os.write(self._fd, contents)
-                contents = contents[written:]
+    def __aenter__(self):
+        # type: (SPSharedLock) -> Awaitable[None]
+        """Obtain a shared lock without blocking the event loop."""
+        res = async_support().acquire(
+            self._locked, self._locked._timeout, shared=True
+        )
+        assert isinstance(res, Awaitable)
+        return res
+
+    def __aexit__(
+        self,  # type: SPSharedLock
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        res = async_support().release(self._locked, etype, eval, tb)
+        assert isinstance(res, Awaitable)
+        return res
+
+
+class SPTransaction(object):
+    """Group several changes to an SPLockedJSONDB object into one write."""
+
+    def __init__(self, db):
+        # type: (SPTransaction, Union[SPLockedJSONDB, SPShardedJSONDB]) -> None
+        self._db = db
+
+    def __enter__(self):
+        # type: (SPTransaction) -> None
+        self._db._begin()
+
+    def __exit__(
+        self,  # type: SPTransaction
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._db._end(etype, eval, tb)
+
+
+def freeze(value):
+    # type: (Any) -> Any
+    """Return a read-only version of a decoded JSON value."""
+    if isinstance(value, dict):
+        return SPFrozenDict({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    # type: (Any) -> Any
+    """Return a modifiable deep copy of a frozen value."""
+    if isinstance(value, SPFrozenDict):
+        return {key: thaw(item) for key, item in value._items.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class SPFrozenDict(Mapping):  # type: ignore
+    """A dictionary that cannot be modified."""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        # type: (SPFrozenDict, Dict[Text, Any]) -> None
+        self._items = items
+
+    def __getitem__(self, key):
+        # type: (SPFrozenDict, Text) -> Any
+        return self._items[key]
+
+    def __iter__(self):
+        # type: (SPFrozenDict) -> Iterator[Text]
+        return iter(self._items)
+
+    def __len__(self):
+        # type: (SPFrozenDict) -> int
+        return len(self._items)
+
+    def __repr__(self):
+        # type: (SPFrozenDict) -> str
+        return "{name}({items!r})".format(
+            name=type(self).__name__, items=self._items
+        )
+
+
+# The SPSnapshot objects may be shared between the database objects, so
+# number them all in the same sequence.
+_SNAPSHOT_GENERATIONS = itertools.count(1)
+
+
+class SPSnapshot(SPFrozenDict):
+    """A read-only copy of a database's contents at some point in time.
+
+    The `generation` counter is unique within the process and grows
+    whenever the database changes, so two snapshots with the same
+    generation have the same contents.
+    """
+
+    __slots__ = ("generation",)
+
+    def __init__(self, items, generation):
+        # type: (SPSnapshot, Dict[Text, Any], int) -> None
+        super(SPSnapshot, self).__init__(items)
+        self.generation = generation
+
+
+def _snapshot(
+    data,  # type: Dict[Text, Any]
+    snap,  # type: Optional[SPSnapshot]
+    dirty,  # type: Optional[Set[Text]]
+):  # type: (...) -> SPSnapshot
+    """Build a new snapshot, only freezing the records that changed.
+
+    A `dirty` value of None means that any of the records may have
+    changed since the `snap` snapshot was built.
+    """
+    if snap is None or dirty is None:
+        items = {key: freeze(val) for key, val in data.items()}
+    else:
+        items = dict(snap._items)
+        for key in dirty:
+            if key in data:
+                items[key] = freeze(data[key])
+            else:
+                items.pop(key, None)
+    return SPSnapshot(items, next(_SNAPSHOT_GENERATIONS))
+
+
+class SPPendingChange(object):
+    """A change queued for a group commit."""
+
+    def __init__(self, updated, removed):
+        # type: (SPPendingChange, Dict[Text, Any], List[Text]) -> None
+        self.updated = updated
+        self.removed = removed
+        self.done = False
+        self.error = None  # type: Optional[Exception]
 
 
 class SPLockedJSONDB(SPLockedFile):
-    def __init__(self, fname):
-        # type: (SPLockedJSONDB, str) -> None
-        super(SPLockedJSONDB, self).__init__(fname)
+    def __init__(
+        self,  # type: SPLockedJSONDB
+        fname,  # type: str
+        timeout=LOCK_TIMEOUT,  # type: Optional[float]
+        group_commit=False,  # type: bool
+        group_window=0.0,  # type: float
+        serializer=spserialize.JSON,  # type: spserialize.Serializer
+        inotify=False,  # type: bool
+        persistent=False,  # type: bool
+        atomic=False,  # type: bool
+        allowed=(),  # type: Iterable[spserialize.Serializer]
+    ):  # type: (...) -> None
+        """Initialize a locked JSON database object.
+
+        If `group_commit` is set, changes made by several threads at
+        the same time are written out together: the first thread to
+        come along waits `group_window` seconds, locks the file, writes
+        out all the changes queued until then, and syncs the file to
+        disk, while the others wait for it to finish.
+        """
+        super(SPLockedJSONDB, self).__init__(
+            fname,
+            timeout=timeout,
+            serializer=serializer,
+            inotify=inotify,
+            persistent=persistent,
+            atomic=atomic,
+            allowed=allowed,
+        )
         self._data = None  # type: Optional[Dict[Text, Any]]
+        self._txn_depth = 0
+        self._txn_updated = {}  # type: Dict[Text, Any]
+        self._txn_removed = set()  # type: Set[Text]
+        self._group_commit = group_commit
+        self._group_window = group_window
+        self._group_cond = threading.Condition(threading.Lock())
+        self._group_queue = []  # type: List[SPPendingChange]
+        self._group_leader = False
+        self._snap = None  # type: Optional[SPSnapshot]
+        self._snap_dirty = None  # type: Optional[Set[Text]]
 
     def get(self):
         # type: (SPLockedJSONDB) -> Dict[Text, Any]
-        with self:
-            if self._data is None or self.changed():
+        with self.shared():
+            # Nobody else can modify the file during our transaction.
+            if self._txn_depth == 0 and (self._data is None or self.changed()):
                 try:
                     self._data = self.jsload()
                 except IOError as e:
@@ -194,16 +1182,203 @@ class SPLockedJSONDB(SPLockedFile):
                         self._data = {}
                     else:
                         raise
+                self._touch()
 
             assert self._data is not None
             return self._data
 
-    def add(self, key, val):
-        # type: (SPLockedJSONDB, Text, Any) -> None
+    def _touch(self, keys=None):
+        # type: (SPLockedJSONDB, Optional[Iterable[Text]]) -> None
+        """Note that some (by default all) of the cached records changed."""
+        if keys is None or self._snap_dirty is None:
+            self._snap_dirty = None
+        else:
+            self._snap_dirty.update(keys)
+
+    def snapshot(self):
+        # type: (SPLockedJSONDB) -> SPSnapshot
+        """Return a read-only copy of the data that is safe to hold on to.
+
+        Unlike the dictionary returned by get(), the snapshot and its
+        records cannot be modified, so it may be shared without copying.
+        A new one is only built after the data changes, and it reuses
+        the frozen records that did not. The snapshots of the file as
+        it was just read are shared with the other objects in
+        the DECODED_CACHE.
+        """
+        with self.shared():
+            path = os.path.abspath(self._fname)
+            fid = None  # type: Optional[Tuple[int, ...]]
+            decoded = False
+            if self._txn_depth == 0 and DECODED_CACHE.max_bytes > 0:
+                assert self._fd is not None
+                fid = spwatch.file_id(path, self._fd)
+                snap = DECODED_CACHE.get(path, fid)
+                if snap is not None:
+                    return snap
+                decoded = self._data is None or self.changed()
+
+            data = self.get()
+            if self._snap is None or self._snap_dirty != set():
+                # Only share a snapshot of the data as it was just read;
+                # nobody could have modified the records since.
+                share = decoded and self._snap_dirty is None
+                self._snap = _snapshot(data, self._snap, self._snap_dirty)
+                self._snap_dirty = set()
+                if share and fid is not None:
+                    DECODED_CACHE.put(path, fid, self._snap)
+            return self._snap
+
+    def _store(
+        self,  # type: SPLockedJSONDB
+        data,  # type: Dict[Text, Any]
+        updated,  # type: Dict[Text, Any]
+        removed,  # type: List[Text]
+    ):  # type: (...) -> None
+        """Write the modified data out; `updated` and `removed` are hints."""
+        self.jsdump(data)
+
+    def _begin(self):
+        # type: (SPLockedJSONDB) -> None
+        """Lock the file and start a (possibly nested) transaction."""
+        self.acquire()
+        if self._txn_depth == 0:
+            try:
+                self.get()
+            except Exception:
+                self.release()
+                raise
+            self._txn_updated = {}
+            self._txn_removed = set()
+        self._txn_depth += 1
+
+    def _end(
+        self,  # type: SPLockedJSONDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        """Write out the accumulated changes when the outermost one ends."""
+        try:
+            self._txn_depth -= 1
+            if self._txn_depth > 0:
+                return
+
+            updated, removed = self._txn_updated, self._txn_removed
+            self._txn_updated, self._txn_removed = {}, set()
+            if etype is not None:
+                # Forget about the changes made so far.
+                self._data = None
+                self._touch()
+            elif updated or removed:
+                assert self._data is not None
+                self._store(self._data, updated, sorted(removed))
+        finally:
+            self.__exit__(etype, eval, tb)
+
+    def transaction(self):
+        # type: (SPLockedJSONDB) -> SPTransaction
+        """Return a context manager that only writes the file once.
+
+        The file is locked exclusively until the outermost transaction
+        ends; it is only written to if something actually changed and
+        no exception was raised.
+        """
+        return SPTransaction(self)
+
+    def _group_apply(self, updated, removed):
+        # type: (SPLockedJSONDB, Dict[Text, Any], List[Text]) -> None
+        """Queue a change, wait for it or for our turn to write it out."""
+        change = SPPendingChange(updated, removed)
+        with self._group_cond:
+            self._group_queue.append(change)
+            while not change.done and self._group_leader:
+                self._group_cond.wait()
+            if not change.done:
+                self._group_leader = True
+
+        if not change.done:
+            # Nobody was writing anything out, so it is our turn.
+            batch = []  # type: List[SPPendingChange]
+            try:
+                if self._group_window > 0:
+                    spgreen.sleep(self._group_window)
+                with self:
+                    with self.transaction():
+                        with self._group_cond:
+                            batch, self._group_queue = self._group_queue, []
+                        for pending in batch:
+                            self._apply(pending.updated, pending.removed)
+                    # Make the whole batch durable with a single sync.
+                    self._sync()
+            except Exception as err:
+                if not batch:
+                    with self._group_cond:
+                        self._group_queue.remove(change)
+                    batch = [change]
+                for pending in batch:
+                    pending.error = err
+            finally:
+                with self._group_cond:
+                    for pending in batch:
+                        pending.done = True
+                    self._group_leader = False
+                    self._group_cond.notify_all()
+
+        if change.error is not None:
+            raise change.error
+
+    def _sync(self):
+        # type: (SPLockedJSONDB) -> None
+        """Make sure the changes written out so far reach the disk."""
+        # The atomic mode syncs the new file before renaming it.
+        if not self._atomic:
+            assert self._fd is not None
+            os.fsync(self._fd)
+
+    def _apply(self, updated, removed):
+        # type: (SPLockedJSONDB, Dict[Text, Any], Iterable[Text]) -> None
+        """Modify the data, write it out unless in a transaction."""
+        if self._group_commit and not self._owned():
+            self._group_apply(updated, list(removed))
+            return
+
         with self:
             d = self.get()
-            d[key] = val
-            self.jsdump(d)
+            gone = []  # type: List[Text]
+            for key in removed:
+                if key in d and key not in updated:
+                    del d[key]
+                    gone.append(key)
+            d.update(updated)
+            if not updated and not gone:
+                return
+            self._touch(gone)
+            self._touch(updated)
+
+            if self._txn_depth == 0:
+                self._store(d, updated, gone)
+                return
+
+            for key in gone:
+                self._txn_updated.pop(key, None)
+                self._txn_removed.add(key)
+            self._txn_removed.difference_update(updated)
+            self._txn_updated.update(updated)
+
+    def add(self, key, val):
+        # type: (SPLockedJSONDB, Text, Any) -> None
+        self._apply({key: val}, [])
+
+    def add_many(self, items):
+        # type: (SPLockedJSONDB, Dict[Text, Any]) -> None
+        """Add or replace several keys with a single write."""
+        self._apply(dict(items), [])
+
+    def update_many(self, items, removed=()):
+        # type: (SPLockedJSONDB, Dict[Text, Any], Iterable[Text]) -> None
+        """Add or replace some keys and remove others with a single write."""
+        self._apply(dict(items), removed)
 
     def remove(self, key):
         # type: (SPLockedJSONDB, Text) -> None
@@ -211,12 +1386,640 @@ class SPLockedJSONDB(SPLockedFile):
 
     def remove_keys(self, keys):
         # type: (SPLockedJSONDB, Iterable[Text]) -> None
+        keys = list(keys)
+        if self._group_commit and not self._owned():
+            # Queue the removal with the other threads' changes; nothing
+            # is written out if none of the keys are there.
+            self._apply({}, keys)
+            return
+
+        with self.shared():
+            if not any(key in self.get() for key in keys):
+                return
+
+            self._apply({}, keys)
+
+
+def _journal_header(gen):
+    # type: (int) -> bytes
+    """Build the header of a journal file with the specified generation."""
+    return JOURNAL_MAGIC + "{gen:016x}\n".format(gen=gen).encode("us-ascii")
+
+
+def _parse_journal_header(contents):
+    # type: (bytearray) -> Optional[int]
+    """Return the generation of a journal file, None for plain JSON."""
+    header = bytes(contents[:JOURNAL_HEADER_LEN])
+    if len(header) < JOURNAL_HEADER_LEN or not header.startswith(
+        JOURNAL_MAGIC
+    ):
+        return None
+    start = len(JOURNAL_MAGIC)
+    try:
+        return int(header[start:].decode("us-ascii"), 16)
+    except ValueError:
+        return None
+
+
+class SPJournalJSONDB(SPLockedJSONDB):
+    """A JSON key/value store that appends changes to a journal.
+
+    The file starts with a header and a snapshot of the data, followed
+    by one JSON record per line for each change. Writes only append
+    a record; the file is compacted into a new snapshot once the records
+    grow longer than the snapshot itself (and at least `compact_min`
+    bytes). Readers only parse the records added since their last look.
+
+    A plain JSON file is read as the initial snapshot and converted on
+    the first write, so all the processes that use the file must be
+    switched to this class at the same time.
+    """
+
+    def __init__(
+        self,  # type: SPJournalJSONDB
+        fname,  # type: str
+        timeout=LOCK_TIMEOUT,  # type: Optional[float]
+        compact_min=JOURNAL_COMPACT_MIN,  # type: int
+        group_commit=False,  # type: bool
+        group_window=0.0,  # type: float
+        serializer=spserialize.JSON,  # type: spserialize.Serializer
+        inotify=False,  # type: bool
+        persistent=False,  # type: bool
+        allowed=(),  # type: Iterable[spserialize.Serializer]
+    ):  # type: (...) -> None
+        if not serializer.is_json:
+            raise ValueError(
+                "The {name} serializer cannot be used for a journal".format(
+                    name=serializer.name
+                )
+            )
+        super(SPJournalJSONDB, self).__init__(
+            fname,
+            timeout=timeout,
+            group_commit=group_commit,
+            group_window=group_window,
+            serializer=serializer,
+            inotify=inotify,
+            persistent=persistent,
+            allowed=allowed,
+        )
+        self._compact_min = compact_min
+        self._jgen = None  # type: Optional[int]
+        self._jino = None  # type: Optional[int]
+        self._jsnap = 0
+        self._jpos = 0
+
+    def _replay(self, contents, pos, offset):
+        # type: (SPJournalJSONDB, bytearray, int, int) -> None
+        """Apply the complete records in a buffer read from `offset`."""
+        assert self._data is not None
+        while True:
+            end = contents.find(b"\n", pos)
+            if end == -1:
+                # A partially written record; ignore it for the present.
+                break
+            record = self._serializer.loads(contents[pos:end])
+            for key in record.get("del", []):
+                self._data.pop(key, None)
+            self._data.update(record.get("set", {}))
+            self._touch(record.get("del", []))
+            self._touch(record.get("set", {}))
+            pos = end + 1
+        self._jpos = offset + pos
+
+    def _load_all(self):
+        # type: (SPJournalJSONDB) -> None
+        """Read the snapshot and replay all the records."""
+        assert self._fd is not None
+        st = os.fstat(self._fd)
+        contents = _read_fd(self._fd)
+        self._mark(False)
+        self._touch()
+        gen = _parse_journal_header(contents)
+        if gen is None:
+            ser = spserialize.detect(contents, self._serializer, self._allowed)
+            self._data = ser.loads(contents)
+            self._jgen = None
+            self._jsnap = self._jpos = len(contents)
+            return
+
+        end = contents.find(b"\n", JOURNAL_HEADER_LEN)
+        if end == -1:
+            raise ValueError(
+                "Truncated journal snapshot in {f}".format(f=self._fname)
+            )
+        self._data = self._serializer.loads(contents[JOURNAL_HEADER_LEN:end])
+        self._jgen = gen
+        self._jino = st.st_ino
+        self._jsnap = end + 1
+        self._replay(contents, end + 1, 0)
+
+    def _refresh(self):
+        # type: (SPJournalJSONDB) -> None
+        """Bring the cached data up to date with the file."""
+        assert self._fd is not None
+        if self._data is not None and not self.changed():
+            return
+
+        if self._data is not None and self._jgen is not None:
+            st = os.fstat(self._fd)
+            if st.st_ino == self._jino and st.st_size >= self._jpos:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                header = bytearray(os.read(self._fd, JOURNAL_HEADER_LEN))
+                if _parse_journal_header(header) == self._jgen:
+                    if st.st_size > self._jpos:
+                        self._replay(
+                            _read_fd(self._fd, self._jpos), 0, self._jpos
+                        )
+                    self._mark(False)
+                    return
+
+        self._load_all()
+
+    def _compact(self, data):
+        # type: (SPJournalJSONDB, Dict[Text, Any]) -> None
+        """Replace the contents of the file with a single snapshot."""
+        assert self._fd is not None
+        gen = 1 if self._jgen is None else self._jgen + 1
+        contents = _journal_header(gen) + self._serializer.dumps(data) + b"\n"
+
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.ftruncate(self._fd, 0)
+        _write_fd(self._fd, contents)
+        self._mark(True)
+        self._jgen = gen
+        self._jino = os.fstat(self._fd).st_ino
+        self._jsnap = self._jpos = len(contents)
+
+    def _store(
+        self,  # type: SPJournalJSONDB
+        data,  # type: Dict[Text, Any]
+        updated,  # type: Dict[Text, Any]
+        removed,  # type: List[Text]
+    ):  # type: (...) -> None
+        """Append a record, compact the journal if it grew too long."""
+        assert self._fd is not None
+        if self._jgen is None or self._jpos - self._jsnap > max(
+            self._compact_min, self._jsnap
+        ):
+            self._compact(data)
+            return
+
+        record = {}  # type: Dict[Text, Any]
+        if updated:
+            record["set"] = updated
+        if removed:
+            record["del"] = removed
+        contents = self._serializer.dumps(record) + b"\n"
+
+        if os.fstat(self._fd).st_size != self._jpos:
+            # Drop a partial record left over by a writer that crashed.
+            os.ftruncate(self._fd, self._jpos)
+        os.lseek(self._fd, self._jpos, os.SEEK_SET)
+        _write_fd(self._fd, contents)
+        self._mark(True)
+        self._jpos += len(contents)
+
+    def get(self):
+        # type: (SPJournalJSONDB) -> Dict[Text, Any]
+        with self.shared():
+            if self._txn_depth == 0:
+                self._refresh()
+            assert self._data is not None
+            return self._data
+
+    def compact(self):
+        # type: (SPJournalJSONDB) -> None
+        """Rewrite the journal as a single snapshot right now."""
         with self:
-            d = self.get()
-            changed = False
-            for key in keys:
-                if key in d:
-                    del d[key]
-                    changed = True
-            if changed:
-                self.jsdump(d)
+            self._compact(self.get())
+
+
+def _shard_index(key, count):
+    # type: (Text, int) -> int
+    """Pick the shard that a key is stored in."""
+    data = key if isinstance(key, bytes) else key.encode("UTF-8")
+    return (zlib.crc32(data) & 0xFFFFFFFF) % count
+
+
+def _create_file(fname, contents, mode):
+    # type: (str, bytes, int) -> None
+    """Atomically create a file with the specified contents if missing."""
+    if os.path.exists(fname):
+        return
+
+    tempname = "{fname}.tmp.{pid}.{tid}".format(
+        fname=fname, pid=os.getpid(), tid=threading.current_thread().ident
+    )
+    fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        try:
+            os.fchmod(fd, mode)
+            _write_fd(fd, contents)
+        finally:
+            os.close(fd)
+
+        try:
+            os.link(tempname, fname)
+        except OSError as err:
+            # Somebody else created it in the meantime.
+            if err.errno != errno.EEXIST:
+                raise
+    finally:
+        os.unlink(tempname)
+
+
+class SPShardedJSONDB(object):
+    """A JSON key/value store split into several separately locked files.
+
+    Each key is hashed into one of `shards` files named `<fname>.<index>`,
+    each one an SPLockedJSONDB (or `shard_class`) object with its own
+    lock, so that changes to unrelated keys do not wait for each other.
+    Operations on the whole store, e.g. get(), transaction(), or locking
+    the object itself, lock all the shards in order.
+
+    Missing shard files are created empty, with the permissions of
+    the `fname` file if it exists; the `fname` file itself is not used.
+    """
+
+    def __init__(
+        self,  # type: SPShardedJSONDB
+        fname,  # type: str
+        shards=SHARD_COUNT,  # type: int
+        timeout=LOCK_TIMEOUT,  # type: Optional[float]
+        shard_class=SPLockedJSONDB,  # type: Type[SPLockedJSONDB]
+        serializer=spserialize.JSON,  # type: spserialize.Serializer
+        inotify=False,  # type: bool
+        persistent=False,  # type: bool
+        allowed=(),  # type: Iterable[spserialize.Serializer]
+    ):  # type: (...) -> None
+        if shards < 1:
+            raise ValueError(
+                "Invalid shard count {shards}".format(shards=shards)
+            )
+        self._fname = fname
+        self._timeout = timeout
+        self._serializer = serializer
+        self._shards = [
+            shard_class(
+                "{fname}.{idx}".format(fname=fname, idx=idx),
+                timeout=timeout,
+                serializer=serializer,
+                inotify=inotify,
+                persistent=persistent,
+                allowed=allowed,
+            )
+            for idx in range(shards)
+        ]
+        self._created = False
+        self._snap = None  # type: Optional[SPSnapshot]
+        self._snap_gens = ()  # type: Tuple[int, ...]
+
+    def _create_shards(self):
+        # type: (SPShardedJSONDB) -> None
+        """Create any missing shard files."""
+        if self._created:
+            return
+
+        try:
+            mode = os.stat(self._fname).st_mode & 0o666
+        except OSError:
+            mode = 0o600
+        empty = self._serializer.dumps({})
+        for shard in self._shards:
+            _create_file(shard._fname, empty, mode)
+        self._created = True
+
+    def _group(self, keys):
+        # type: (SPShardedJSONDB, Iterable[Text]) -> Dict[int, List[Text]]
+        """Split a list of keys by shard."""
+        res = {}  # type: Dict[int, List[Text]]
+        for key in keys:
+            res.setdefault(_shard_index(key, len(self._shards)), []).append(
+                key
+            )
+        return res
+
+    def _upgrade(self, indices, timeout, retry=False):
+        # type: (SPShardedJSONDB, List[int], Optional[float], bool) -> bool
+        """Convert the shared locks on some shards into exclusive ones.
+
+        Doing that one shard at a time could deadlock with another
+        process upgrading other shards, so drop the locks on all the
+        shards held by this thread and take them again in order.
+        If `retry` is set, a failed attempt leaves them to be taken
+        back by the shards' next _acquire() calls.
+        """
+        held = [shard for shard in self._shards if shard._owned()]
+        old = [shard._mode for shard in held]
+        new = [
+            fcntl.LOCK_EX if idx in indices else shard._mode
+            for idx, shard in enumerate(self._shards)
+            if shard._owned()
+        ]
+
+        def relock(modes, timeout):
+            # type: (List[Optional[int]], Optional[float]) -> bool
+            """Drop all the file locks, take them again in order."""
+            deadline = None if timeout is None else monotonic() + timeout
+            for shard in held:
+                assert shard._fd is not None
+                fcntl.flock(shard._fd, fcntl.LOCK_UN)
+            for shard, mode in zip(held, modes):
+                assert shard._fd is not None and mode is not None
+                remaining = (
+                    None
+                    if deadline is None
+                    else max(deadline - monotonic(), 0)
+                )
+                if not _flock(shard._fd, mode, remaining):
+                    return False
+            return True
+
+        if relock(new, timeout):
+            for shard, mode in zip(held, new):
+                shard._mode = mode
+                shard._dropped = False
+                shard._relocked()
+            return True
+
+        if retry or any(shard._dropped for shard in held):
+            for shard in held:
+                assert shard._fd is not None
+                fcntl.flock(shard._fd, fcntl.LOCK_UN)
+                shard._dropped = True
+            return False
+
+        # Nobody can hold on to a lock forever while waiting for
+        # the ones we hold, since everyone takes them in order.
+        relock(old, None)
+        for shard in held:
+            shard._relocked()
+        return False
+
+    def _acquire(
+        self,  # type: SPShardedJSONDB
+        indices,  # type: List[int]
+        timeout,  # type: Optional[float]
+        operation=fcntl.LOCK_EX,  # type: int
+        retry=False,  # type: bool
+    ):  # type: (...) -> bool
+        """Lock some of the shards in order; all or nothing."""
+        self._create_shards()
+        deadline = None if timeout is None else monotonic() + timeout
+
+        def remaining():
+            # type: () -> Optional[float]
+            """How long to wait for the next lock."""
+            return None if deadline is None else max(deadline - monotonic(), 0)
+
+        upgrade = [
+            idx
+            for idx in indices
+            if operation == fcntl.LOCK_EX
+            and self._shards[idx]._owned()
+            and self._shards[idx]._mode != fcntl.LOCK_EX
+        ]
+        if upgrade and not self._upgrade(upgrade, remaining(), retry):
+            return False
+
+        locked = []  # type: List[int]
+        try:
+            for idx in indices:
+                if not self._shards[idx]._acquire(
+                    remaining(), operation, retry
+                ):
+                    break
+                locked.append(idx)
+        finally:
+            if len(locked) != len(indices):
+                self._release(locked)
+        return len(locked) == len(indices)
+
+    def _release(self, indices):
+        # type: (SPShardedJSONDB, List[int]) -> None
+        """Release one level of the locks on some of the shards."""
+        for idx in reversed(indices):
+            self._shards[idx]._release()
+
+    def _lock(self, indices):
+        # type: (SPShardedJSONDB, List[int]) -> None
+        """Lock some of the shards exclusively or raise an error."""
+        if not self._acquire(indices, self._timeout):
+            raise SPLockedFileError(
+                "Could not lock the {f} shards".format(f=self._fname)
+            )
+
+    def acquire(self, timeout=-1.0, shared=False):
+        # type: (SPShardedJSONDB, Optional[float], bool) -> None
+        """Lock all the shards, waiting for at most `timeout` seconds."""
+        if timeout is not None and timeout < 0:
+            timeout = self._timeout
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not self._acquire(
+            list(range(len(self._shards))), timeout, operation
+        ):
+            raise SPLockedFileError(
+                "Could not lock the {f} shards".format(f=self._fname)
+            )
+
+    def try_lock(self, shared=False, retry=False):
+        # type: (SPShardedJSONDB, bool, bool) -> bool
+        """Try to lock all the shards, do not wait if any of them is locked.
+
+        See SPLockedFile.try_lock() for the meaning of `retry`.
+        """
+        return self._acquire(
+            list(range(len(self._shards))),
+            0,
+            fcntl.LOCK_SH if shared else fcntl.LOCK_EX,
+            retry,
+        )
+
+    def release(self):
+        # type: (SPShardedJSONDB) -> None
+        """Release a lock obtained by acquire() or try_lock()."""
+        self._release(list(range(len(self._shards))))
+
+    def close(self):
+        # type: (SPShardedJSONDB) -> None
+        """Close the file descriptors kept open in persistent mode."""
+        for shard in self._shards:
+            shard.close()
+
+    def stats(self):
+        # type: (SPShardedJSONDB) -> Dict[str, Any]
+        """Return the combined lock statistics for all the shards."""
+        total = SPLockStats()
+        for shard in self._shards:
+            total.add(shard._stats)
+        return total.as_dict()
+
+    def lock_generation(self):
+        # type: (SPShardedJSONDB) -> int
+        """Return a counter bumped whenever any shard lock is obtained.
+
+        As with SPLockedFile.lock_generation(), upgrading the locks also
+        bumps it if any of the shards was modified in the meantime.
+        """
+        return sum(shard.lock_generation() for shard in self._shards)
+
+    def shared(self):
+        # type: (SPShardedJSONDB) -> SPSharedLock
+        """Return a context manager that holds shared locks on all shards."""
+        return SPSharedLock(self)
+
+    def __enter__(self):
+        # type: (SPShardedJSONDB) -> None
+        self.acquire()
+
+    def __exit__(
+        self,  # type: SPShardedJSONDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._release(list(range(len(self._shards))))
+
+    def __aenter__(self):
+        # type: (SPShardedJSONDB) -> Awaitable[None]
+        """Lock all the shards without blocking the event loop."""
+        res = async_support().acquire(self, self._timeout)
+        assert isinstance(res, Awaitable)
+        return res
+
+    def __aexit__(
+        self,  # type: SPShardedJSONDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        res = async_support().release(self, etype, eval, tb)
+        assert isinstance(res, Awaitable)
+        return res
+
+    def _begin(self):
+        # type: (SPShardedJSONDB) -> None
+        """Lock all the shards and start a transaction on each of them."""
+        self.acquire()
+        started = []  # type: List[SPLockedJSONDB]
+        try:
+            for shard in self._shards:
+                shard._begin()
+                started.append(shard)
+        except Exception as err:
+            for shard in reversed(started):
+                shard._end(type(err), err, None)
+            self.release()
+            raise
+
+    def _end(
+        self,  # type: SPShardedJSONDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        """End the transactions on all the shards, writing them out."""
+        error = None  # type: Optional[Exception]
+        try:
+            for shard in self._shards:
+                if error is None:
+                    try:
+                        shard._end(etype, eval, tb)
+                    except Exception as err:
+                        error = err
+                else:
+                    # Discard the changes to the rest of the shards.
+                    shard._end(type(error), error, None)
+        finally:
+            self.__exit__(etype, eval, tb)
+        if error is not None:
+            raise error
+
+    def transaction(self):
+        # type: (SPShardedJSONDB) -> SPTransaction
+        """Return a context manager that writes each shard at most once.
+
+        All the shards are locked exclusively until the outermost
+        transaction ends. The changes to the shards are written out
+        one after the other, so a crash in the middle may leave only
+        some of them on disk.
+        """
+        return SPTransaction(self)
+
+    def get(self):
+        # type: (SPShardedJSONDB) -> Dict[Text, Any]
+        """Return a new dictionary with the contents of all the shards."""
+        with self.shared():
+            res = {}  # type: Dict[Text, Any]
+            for shard in self._shards:
+                res.update(shard.get())
+            return res
+
+    def snapshot(self):
+        # type: (SPShardedJSONDB) -> SPSnapshot
+        """Return a read-only copy of the contents of all the shards.
+
+        The frozen records are shared with the shards' own snapshots.
+        """
+        with self.shared():
+            snaps = [shard.snapshot() for shard in self._shards]
+            gens = tuple(snap.generation for snap in snaps)
+            if self._snap is None or gens != self._snap_gens:
+                items = {}  # type: Dict[Text, Any]
+                for snap in snaps:
+                    items.update(snap._items)
+                # Only ever goes up, since the shards' generations do.
+                self._snap = SPSnapshot(items, sum(gens))
+                self._snap_gens = gens
+            return self._snap
+
+    def update_many(self, items, removed=()):
+        # type: (SPShardedJSONDB, Dict[Text, Any], Iterable[Text]) -> None
+        """Add or replace some keys and remove others.
+
+        Only the affected shards are locked and written to.
+        """
+        items = dict(items)
+        removed = list(removed)
+        set_groups = self._group(items)
+        del_groups = self._group(removed)
+        indices = sorted(set(set_groups) | set(del_groups))
+        if not indices:
+            return
+
+        self._lock(indices)
+        try:
+            for idx in indices:
+                self._shards[idx].update_many(
+                    {key: items[key] for key in set_groups.get(idx, [])},
+                    del_groups.get(idx, []),
+                )
+        finally:
+            self._release(indices)
+
+    def add(self, key, val):
+        # type: (SPShardedJSONDB, Text, Any) -> None
+        self.update_many({key: val})
+
+    def add_many(self, items):
+        # type: (SPShardedJSONDB, Dict[Text, Any]) -> None
+        """Add or replace several keys, writing each shard at most once."""
+        self.update_many(items)
+
+    def remove(self, key):
+        # type: (SPShardedJSONDB, Text) -> None
+        self.remove_keys([key])
+
+    def remove_keys(self, keys):
+        # type: (SPShardedJSONDB, Iterable[Text]) -> None
+        """Remove some keys, only locking the shards that contain them."""
+        self._create_shards()
+        present = [
+            key
+            for idx, group in self._group(keys).items()
+            for key in group
+            if key in self._shards[idx].get()
+        ]
+        if present:
+            self.update_many({}, present)
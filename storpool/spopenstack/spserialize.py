@@ -0,0 +1,214 @@
+#
+# -
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Convert the data stored in the locked files to bytes and back.
+"""
+
+import abc
+import json
+import marshal
+import sys
+
+try:
+    from typing import Any, Dict, Iterable, List, Optional, Union
+
+    Buffer = Union[bytes, bytearray]
+except ImportError:
+    pass
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import ujson  # type: ignore
+except ImportError:
+    ujson = None  # type: ignore
+
+
+try:
+    _ABC = abc.ABC
+except AttributeError:
+    # Python 2.x
+    _ABC = abc.ABCMeta("_ABC", (object,), {})  # type: ignore
+
+
+class Serializer(_ABC):
+    """The base class for the serializers.
+
+    A serializer with a non-empty `magic` prefix is recognized when
+    loading a file if it is allowed to; anything else is assumed to be
+    JSON. Serializers
+    that produce JSON never output a newline character, so they may
+    also be used for the SPJournalJSONDB records.
+    """
+
+    name = "base"
+    magic = b""
+    is_json = False
+
+    @abc.abstractmethod
+    def dumps(self, obj):
+        # type: (Serializer, Any) -> bytes
+        """Encode an object."""
+
+    @abc.abstractmethod
+    def loads(self, contents):
+        # type: (Serializer, Buffer) -> Any
+        """Decode an object."""
+
+
+class JSONSerializer(Serializer):
+    """Use the json module from the Python standard library."""
+
+    name = "json"
+    is_json = True
+
+    def dumps(self, obj):
+        # type: (JSONSerializer, Any) -> bytes
+        return json.dumps(obj).encode("UTF-8")
+
+    def loads(self, contents):
+        # type: (JSONSerializer, Buffer) -> Any
+        if sys.version_info[0] < 3:
+            # Python 2.x's json module only accepts strings.
+            return json.loads(bytes(contents))
+        return json.loads(contents)
+
+
+class OrjsonSerializer(Serializer):
+    """Use the orjson library if it is installed."""
+
+    name = "orjson"
+    is_json = True
+
+    def dumps(self, obj):
+        # type: (OrjsonSerializer, Any) -> bytes
+        res = orjson.dumps(obj)
+        assert isinstance(res, bytes)
+        return res
+
+    def loads(self, contents):
+        # type: (OrjsonSerializer, Buffer) -> Any
+        return orjson.loads(contents)
+
+
+class UJSONSerializer(Serializer):
+    """Use the ujson library if it is installed."""
+
+    name = "ujson"
+    is_json = True
+
+    def dumps(self, obj):
+        # type: (UJSONSerializer, Any) -> bytes
+        res = ujson.dumps(obj)
+        assert isinstance(res, str)
+        return res.encode("UTF-8")
+
+    def loads(self, contents):
+        # type: (UJSONSerializer, Buffer) -> Any
+        return ujson.loads(bytes(contents))
+
+
+class MarshalSerializer(Serializer):
+    """Use version 2 of the marshal format, readable by Python 2 and 3.
+
+    This format is faster to parse than JSON, but the marshal module
+    is not hardened against malicious data, so it should only be used
+    for files that untrusted users cannot modify. The stored values
+    should still be JSON-compatible, and text strings should always
+    be Unicode ones.
+    """
+
+    name = "marshal"
+    magic = b"\x00spm2\n"
+
+    def dumps(self, obj):
+        # type: (MarshalSerializer, Any) -> bytes
+        return self.magic + marshal.dumps(obj, 2)
+
+    def loads(self, contents):
+        # type: (MarshalSerializer, Buffer) -> Any
+        start = len(self.magic)
+        return marshal.loads(bytes(contents[start:]))
+
+
+JSON = JSONSerializer()
+MARSHAL = MarshalSerializer()
+
+SERIALIZERS = {
+    ser.name: ser for ser in (JSON, MARSHAL)
+}  # type: Dict[str, Serializer]
+if orjson is not None:
+    SERIALIZERS["orjson"] = OrjsonSerializer()
+if ujson is not None:
+    SERIALIZERS["ujson"] = UJSONSerializer()
+
+_MAGIC = [
+    ser for ser in SERIALIZERS.values() if ser.magic
+]  # type: List[Serializer]
+
+
+def fastest_json():
+    # type: () -> Serializer
+    """Return the fastest JSON serializer available."""
+    for name in ("orjson", "ujson"):
+        ser = SERIALIZERS.get(name)
+        if ser is not None:
+            return ser
+    return JSON
+
+
+def get_serializer(name):
+    # type: (str) -> Serializer
+    """Return a serializer by name; "auto" means the fastest JSON one."""
+    if name == "auto":
+        return fastest_json()
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown or unavailable serializer {name}".format(name=name)
+        )
+
+
+def detect(contents, default=None, allowed=()):
+    # type: (Buffer, Optional[Serializer], Iterable[Serializer]) -> Serializer
+    """Figure out which serializer can decode the contents of a file.
+
+    Data that starts with a known prefix is only decoded if it was
+    written by the default serializer or one of the `allowed` ones;
+    a ValueError is raised otherwise, so that e.g. the marshal module
+    never parses a file that its reader did not expect to be trusted.
+    Anything else is treated as JSON and decoded by the default
+    serializer if it is a JSON one, or by the fastest JSON serializer
+    available otherwise.
+    """
+    for ser in _MAGIC:
+        if contents.startswith(ser.magic):
+            if ser is not default and ser not in allowed:
+                raise ValueError(
+                    "The data is in the {name} format, which is not "
+                    "allowed here".format(name=ser.name)
+                )
+            return ser
+    if default is not None and default.is_json:
+        return default
+    return fastest_json()
@@ -0,0 +1,468 @@
+#
+# -
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+A key/value store with the SPLockedJSONDB interface, kept in SQLite.
+"""
+
+import json
+import sqlite3
+
+try:
+    import types
+
+    from typing import (
+        Any,
+        Awaitable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Set,
+        Text,
+        Type,
+        TypeVar,
+    )
+
+    TExc = TypeVar("TExc", bound=BaseException)
+except ImportError:
+    pass
+
+from . import spgreen
+from . import splocked
+
+
+# The busy timeout to use when asked to wait indefinitely, in seconds.
+_FOREVER = 86400 * 24
+
+# The errors that mean that somebody else is using the database.
+_BUSY_MESSAGES = (
+    "database is locked",
+    "database is busy",
+    "database table is locked",
+)
+
+
+def _busy(err):
+    # type: (sqlite3.OperationalError) -> bool
+    """Check whether an SQLite error only means that we should wait."""
+    return str(err).lower() in _BUSY_MESSAGES
+
+
+class SPSQLiteLock(object):
+    """Hold a lock on an SPLockedSQLiteDB object."""
+
+    def __init__(self, db, shared):
+        # type: (SPSQLiteLock, SPLockedSQLiteDB, bool) -> None
+        self._db = db
+        self._shared = shared
+
+    def __enter__(self):
+        # type: (SPSQLiteLock) -> None
+        self._db.acquire(shared=self._shared)
+
+    def __exit__(
+        self,  # type: SPSQLiteLock
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._db.__exit__(etype, eval, tb)
+
+    def __aenter__(self):
+        # type: (SPSQLiteLock) -> Awaitable[None]
+        """Start a transaction without blocking the event loop."""
+        res = splocked.async_support().acquire(
+            self._db, self._db._timeout, shared=self._shared
+        )
+        assert isinstance(res, Awaitable)
+        return res
+
+    def __aexit__(
+        self,  # type: SPSQLiteLock
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        res = splocked.async_support().release(self._db, etype, eval, tb)
+        assert isinstance(res, Awaitable)
+        return res
+
+
+class SPLockedSQLiteDB(object):
+    """A key/value store kept in an SQLite database in WAL mode.
+
+    The locking semantics are the same as those of SPLockedJSONDB:
+    a shared lock is a read transaction, so readers never block each
+    other or the writer, and an exclusive lock is an immediate write
+    transaction that is committed when the outermost level is released.
+    Upgrading a shared lock commits the read transaction first, so
+    the lock_generation() counter changes if another connection
+    modified the database in the meantime.
+    """
+
+    def __init__(self, fname, timeout=splocked.LOCK_TIMEOUT):
+        # type: (SPLockedSQLiteDB, str, Optional[float]) -> None
+        self._fname = fname
+        self._timeout = timeout
+        self._rlock = splocked.path_lock(fname)
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self._count = 0
+        self._shared = False
+        self._lock_gen = 0
+        self._failed = False
+        self._data = None  # type: Optional[Dict[Text, Any]]
+        self._data_version = None  # type: Optional[int]
+        self._snap = None  # type: Optional[splocked.SPSnapshot]
+        self._snap_dirty = None  # type: Optional[Set[Text]]
+        self._stats = splocked.SPLockStats()
+        self._held_since = 0.0
+        self._held_site = None  # type: Optional[splocked.CallSite]
+
+    def _connect(self):
+        # type: (SPLockedSQLiteDB) -> sqlite3.Connection
+        """Open the database, create the table if needed."""
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self._fname, isolation_level=None, check_same_thread=False
+            )
+            try:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS attach "
+                    "(key TEXT PRIMARY KEY NOT NULL, value TEXT NOT NULL)"
+                )
+            except Exception:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _try_begin(self, shared):
+        # type: (SPLockedSQLiteDB, bool) -> bool
+        """Start a transaction, waiting at most for the busy timeout.
+
+        Return False if the database is still in use by somebody else;
+        raise an exception on any other error.
+        """
+        conn = self._connect()
+        try:
+            if shared:
+                conn.execute("BEGIN DEFERRED")
+                # Actually start the read transaction.
+                conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as err:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass
+            if not _busy(err):
+                raise
+            return False
+        return True
+
+    def _begin(self, shared, timeout):
+        # type: (SPLockedSQLiteDB, bool, Optional[float]) -> bool
+        """Start a read or write transaction."""
+        conn = self._connect()
+        if spgreen.cooperative():
+            # SQLite would wait for the database in a blocking C call;
+            # poll it instead to let the other green threads run.
+            conn.execute("PRAGMA busy_timeout = 0")
+            ok = splocked._retry(lambda: self._try_begin(shared), timeout)
+        else:
+            busy = _FOREVER if timeout is None else timeout
+            conn.execute(
+                "PRAGMA busy_timeout = {ms}".format(ms=int(busy * 1000))
+            )
+            ok = self._try_begin(shared)
+        if not ok:
+            return False
+
+        self._shared = shared
+        return True
+
+    def _version(self):
+        # type: (SPLockedSQLiteDB) -> int
+        """Return the counter bumped by the commits of other connections."""
+        res = self._connect().execute("PRAGMA data_version").fetchone()[0]
+        assert isinstance(res, int)
+        return res
+
+    def _acquire(self, timeout, shared, retry=False):
+        # type: (SPLockedSQLiteDB, Optional[float], bool, bool) -> bool
+        """Obtain the thread lock and start a transaction if needed."""
+        start = splocked.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if not splocked.acquire_thread_lock(self._rlock, timeout):
+            self._record_wait(start, False, retry)
+            return False
+
+        try:
+            remaining = (
+                None
+                if deadline is None
+                else max(deadline - splocked.monotonic(), 0)
+            )
+            if self._count == 0:
+                self._failed = False
+                ok = self._begin(shared, remaining)
+                self._record_wait(start, ok, retry)
+                if ok:
+                    self._lock_gen += 1
+                    self._held_since = splocked.monotonic()
+                    self._held_site = splocked.call_site()
+            elif self._shared and not shared:
+                # Upgrade: let go of the read snapshot, start writing.
+                version = self._version()
+                self._connect().execute("COMMIT")
+                ok = self._begin(False, remaining)
+                self._record_wait(start, ok, retry)
+                if not ok:
+                    self._begin(True, None)
+                if self._version() != version:
+                    self._lock_gen += 1
+            else:
+                ok = True
+        except Exception:
+            self._rlock.release()
+            raise
+
+        if not ok:
+            self._rlock.release()
+            return False
+        self._count += 1
+        return True
+
+    def _release(self, success):
+        # type: (SPLockedSQLiteDB, bool) -> None
+        """Release one level of the lock, end the transaction if needed."""
+        try:
+            if not success:
+                self._failed = True
+            if self._count == 1:
+                assert self._conn is not None
+                if self._failed:
+                    self._conn.execute("ROLLBACK")
+                    self._data = None
+                    self._snap_dirty = None
+                else:
+                    self._conn.execute("COMMIT")
+
+                held = splocked.monotonic() - self._held_since
+                self._stats.record_hold(held, self._held_site)
+                splocked.LOCK_STATS.record_hold(held, self._held_site)
+        finally:
+            self._count -= 1
+            self._rlock.release()
+
+    def _record_wait(self, start, acquired, retry=False):
+        # type: (SPLockedSQLiteDB, float, bool, bool) -> None
+        """Update the statistics after trying to start a transaction.
+
+        If `retry` is set, a failed attempt is counted as a retry.
+        """
+        if retry and not acquired:
+            self._stats.record_retry()
+            splocked.LOCK_STATS.record_retry()
+            return
+        elapsed = splocked.monotonic() - start
+        self._stats.record_wait(elapsed, acquired)
+        splocked.LOCK_STATS.record_wait(elapsed, acquired)
+
+    def stats(self):
+        # type: (SPLockedSQLiteDB) -> Dict[str, Any]
+        """Return the lock statistics for this object.
+
+        SQLite waits for busy databases internally, so the retries are
+        only the failed try_lock() attempts of the callers that poll.
+        """
+        return self._stats.as_dict()
+
+    def acquire(self, timeout=-1.0, shared=False):
+        # type: (SPLockedSQLiteDB, Optional[float], bool) -> None
+        """Lock the database, waiting for at most `timeout` seconds."""
+        if timeout is not None and timeout < 0:
+            timeout = self._timeout
+        if not self._acquire(timeout, shared):
+            raise splocked.SPLockedFileError(
+                "Could not lock the {f} database".format(f=self._fname)
+            )
+
+    def try_lock(self, shared=False, retry=False):
+        # type: (SPLockedSQLiteDB, bool, bool) -> bool
+        """Try to lock the database, do not wait if it is already locked.
+
+        If `retry` is set, a failed attempt is counted as a retry and not
+        as a failure; see SPLockedFile.try_lock(). In WAL mode, taking
+        a read transaction back after a failed upgrade never waits.
+        """
+        return self._acquire(0, shared, retry)
+
+    def release(self):
+        # type: (SPLockedSQLiteDB) -> None
+        """Release a lock obtained by acquire() or try_lock()."""
+        self._release(True)
+
+    def lock_generation(self):
+        # type: (SPLockedSQLiteDB) -> int
+        """Return a counter bumped whenever the lock is obtained.
+
+        Upgrading a shared lock also bumps it if somebody else modified
+        the database in the meantime.
+        """
+        return self._lock_gen
+
+    def shared(self):
+        # type: (SPLockedSQLiteDB) -> SPSQLiteLock
+        """Return a context manager that holds a read transaction."""
+        return SPSQLiteLock(self, True)
+
+    def transaction(self):
+        # type: (SPLockedSQLiteDB) -> SPSQLiteLock
+        """Return a context manager that commits all the changes at once."""
+        return SPSQLiteLock(self, False)
+
+    def __enter__(self):
+        # type: (SPLockedSQLiteDB) -> None
+        self.acquire()
+
+    def __exit__(
+        self,  # type: SPLockedSQLiteDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> None
+        self._release(etype is None)
+
+    def __aenter__(self):
+        # type: (SPLockedSQLiteDB) -> Awaitable[None]
+        """Start a write transaction without blocking the event loop."""
+        res = splocked.async_support().acquire(self, self._timeout)
+        assert isinstance(res, Awaitable)
+        return res
+
+    def __aexit__(
+        self,  # type: SPLockedSQLiteDB
+        etype,  # type: Optional[Type[TExc]]
+        eval,  # type: Optional[TExc]
+        tb,  # type: Optional[types.TracebackType]
+    ):  # type: (...) -> Awaitable[None]
+        res = splocked.async_support().release(self, etype, eval, tb)
+        assert isinstance(res, Awaitable)
+        return res
+
+    def close(self):
+        # type: (SPLockedSQLiteDB) -> None
+        """Close the database connection."""
+        with self._rlock:
+            assert self._count == 0
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._data = None
+
+    def get(self):
+        # type: (SPLockedSQLiteDB) -> Dict[Text, Any]
+        with self.shared():
+            conn = self._connect()
+            version = self._version()
+            if self._data is None or version != self._data_version:
+                self._data = {
+                    key: json.loads(value)
+                    for key, value in conn.execute(
+                        "SELECT key, value FROM attach"
+                    )
+                }
+                self._data_version = version
+                self._snap_dirty = None
+
+            return self._data
+
+    def snapshot(self):
+        # type: (SPLockedSQLiteDB) -> splocked.SPSnapshot
+        """Return a read-only copy of the data that is safe to hold on to."""
+        with self.shared():
+            data = self.get()
+            if self._snap is None or self._snap_dirty != set():
+                self._snap = splocked._snapshot(
+                    data, self._snap, self._snap_dirty
+                )
+                self._snap_dirty = set()
+            return self._snap
+
+    def lookup(self, key, default=None):
+        # type: (SPLockedSQLiteDB, Text, Any) -> Any
+        """Look a single key up without loading the whole database."""
+        with self.shared():
+            row = (
+                self._connect()
+                .execute("SELECT value FROM attach WHERE key = ?", (key,))
+                .fetchone()
+            )
+            return default if row is None else json.loads(row[0])
+
+    def update_many(self, items, removed=()):
+        # type: (SPLockedSQLiteDB, Dict[Text, Any], Iterable[Text]) -> None
+        """Add or replace some keys and remove others."""
+        items = dict(items)
+        gone = [key for key in removed if key not in items]
+        with self:
+            d = self.get()
+            conn = self._connect()
+            if gone:
+                conn.executemany(
+                    "DELETE FROM attach WHERE key = ?",
+                    [(key,) for key in gone],
+                )
+                for key in gone:
+                    d.pop(key, None)
+                if self._snap_dirty is not None:
+                    self._snap_dirty.update(gone)
+            if items:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO attach (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(val)) for key, val in items.items()],
+                )
+                d.update(items)
+                if self._snap_dirty is not None:
+                    self._snap_dirty.update(items)
+
+    def add(self, key, val):
+        # type: (SPLockedSQLiteDB, Text, Any) -> None
+        self.update_many({key: val})
+
+    def add_many(self, items):
+        # type: (SPLockedSQLiteDB, Dict[Text, Any]) -> None
+        """Add or replace several keys."""
+        self.update_many(items)
+
+    def remove(self, key):
+        # type: (SPLockedSQLiteDB, Text) -> None
+        self.remove_keys([key])
+
+    def remove_keys(self, keys):
+        # type: (SPLockedSQLiteDB, Iterable[Text]) -> None
+        keys = list(keys)
+        with self.shared():
+            if not any(key in self.get() for key in keys):
+                return
+
+            self.update_many({}, keys)
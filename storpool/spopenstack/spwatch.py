@@ -0,0 +1,383 @@
+#
+# -
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Detect changes to the files protected by the SPLockedFile locks.
+"""
+
+import abc
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import threading
+
+from . import spgreen
+
+try:
+    from typing import Any, Dict, Optional, Tuple
+except ImportError:
+    pass
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+
+# The file may have been replaced or removed; watch the path anew.
+REWATCH_MASK = IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+# Something new has shown up in a watched directory.
+DIR_MASK = IN_CREATE | IN_MOVED_TO
+
+# struct inotify_event without the name that follows it.
+_EVENT = struct.Struct("iIII")
+
+# The number of in-process writes to each file, for the stat(2) fallback.
+_generations = {}  # type: Dict[str, int]
+_generations_lock = threading.Lock()
+
+_inotify = None  # type: Optional[SPInotify]
+_inotify_failed = False
+_inotify_lock = threading.Lock()
+
+
+def _fsencode(path):
+    # type: (str) -> bytes
+    """Convert a path to bytes for passing to the C library."""
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+
+def _ns(st, field):
+    # type: (Any, str) -> int
+    """Return a stat(2) timestamp in nanoseconds if possible."""
+    res = getattr(st, "st_" + field + "_ns", None)
+    if res is None:  # Python 2.x
+        return int(getattr(st, "st_" + field) * 1000000000)
+    assert isinstance(res, int)
+    return res
+
+
+def file_id(path, fd=None):
+    # type: (str, Optional[int]) -> Tuple[int, ...]
+    """Identify the current contents of a file as well as possible.
+
+    Look at the file's inode, size, and nanosecond timestamps, and also
+    at the number of times it was written to by this process, since
+    the modification time may not change if it is written twice within
+    a single clock tick. If `fd` is specified, examine it instead of
+    looking the path up again.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path) if fd is None else os.fstat(fd)
+    return (
+        st.st_dev,
+        st.st_ino,
+        st.st_size,
+        _ns(st, "mtime"),
+        _ns(st, "ctime"),
+        _generations.get(path, 0),
+    )
+
+
+class SPInotify(object):
+    """A process-wide inotify(7) instance watching some files.
+
+    Each watched file has a generation counter bumped whenever
+    an event is received for it. The events are only processed when
+    somebody asks for a generation, so the callers should hold a lock
+    that prevents the file from being modified at that time.
+    """
+
+    def __init__(self, libc):
+        # type: (SPInotify, Any) -> None
+        self._libc = libc
+        self._lock = threading.Lock()
+        self._fd = -1
+        self._pid = -1
+        self._wds = {}  # type: Dict[str, int]
+        self._paths = {}  # type: Dict[int, str]
+        self._gens = {}  # type: Dict[str, int]
+
+    def _reset(self):
+        # type: (SPInotify) -> None
+        """Create a new inotify instance at startup or after a fork."""
+        if self._fd != -1:
+            os.close(self._fd)
+            self._fd = -1
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        if fd == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._fd = fd
+        self._pid = os.getpid()
+        self._wds = {}
+        self._paths = {}
+        # Anything may have happened while nobody was watching.
+        for path in self._gens:
+            self._gens[path] += 1
+
+    def _unwatch(self, path, wd, remove):
+        # type: (SPInotify, str, int, bool) -> None
+        """Forget about a watch, remove it from the kernel if needed."""
+        del self._wds[path]
+        del self._paths[wd]
+        if remove:
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _drain(self):
+        # type: (SPInotify) -> None
+        """Process all the pending events without blocking."""
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return
+                raise
+
+            pos = 0
+            while pos + _EVENT.size <= len(buf):
+                wd, mask, _, length = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    for path in self._gens:
+                        self._gens[path] += 1
+                    continue
+
+                watched = self._paths.get(wd)
+                if watched is None:
+                    continue
+                self._gens[watched] += 1
+                if mask & REWATCH_MASK:
+                    self._unwatch(watched, wd, not mask & IN_IGNORED)
+
+    def generation(self, path):
+        # type: (SPInotify, str) -> Optional[int]
+        """Return the path's change counter, None if it cannot be watched."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._drain()
+
+            if path not in self._wds:
+                wd = self._libc.inotify_add_watch(
+                    self._fd, _fsencode(path), WATCH_MASK
+                )
+                if wd == -1:
+                    return None
+                old = self._paths.get(wd)
+                if old is not None and old != path:
+                    # A hard link to a file we are already watching.
+                    return None
+                self._wds[path] = wd
+                self._paths[wd] = path
+
+            return self._gens.setdefault(path, 0)
+
+
+def _load_libc():
+    # type: () -> Any
+    """Load the C library to get at the inotify(7) functions."""
+    return ctypes.CDLL(
+        ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+    )
+
+
+def get_inotify():
+    # type: () -> Optional[SPInotify]
+    """Return the process-wide SPInotify object, None if not supported."""
+    global _inotify, _inotify_failed
+    with _inotify_lock:
+        if _inotify is None and not _inotify_failed:
+            try:
+                inotify = SPInotify(_load_libc())
+                with inotify._lock:
+                    inotify._reset()
+                _inotify = inotify
+            except (AttributeError, OSError):
+                _inotify_failed = True
+        return _inotify
+
+
+class SPDirWatcher(object):
+    """Wait for new entries to show up in a directory.
+
+    Unlike SPInotify, this uses a separate inotify(7) instance that
+    the callers may wait on.
+    """
+
+    def __init__(self, libc, path):
+        # type: (SPDirWatcher, Any, str) -> None
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)  # type: int
+        if self._fd == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self._fd, _fsencode(path), DIR_MASK) == -1:
+            err = ctypes.get_errno()
+            self.close()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        # type: (SPDirWatcher) -> int
+        """Return the inotify file descriptor to wait on."""
+        return self._fd
+
+    def drain(self):
+        # type: (SPDirWatcher) -> bool
+        """Discard the pending events, return whether there were any."""
+        res = False
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return res
+                raise
+            res = res or bool(buf)
+
+    def wait(self, timeout):
+        # type: (SPDirWatcher, float) -> bool
+        """Wait for something to show up, return False on timeout."""
+        if not spgreen.wait_readable(self._fd, timeout):
+            return False
+        return self.drain()
+
+    def close(self):
+        # type: (SPDirWatcher) -> None
+        """Stop watching the directory."""
+        if self._fd != -1:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def dir_watcher(path):
+    # type: (str) -> Optional[SPDirWatcher]
+    """Watch a directory, return None if inotify(7) cannot be used."""
+    try:
+        return SPDirWatcher(_load_libc(), path)
+    except (AttributeError, OSError):
+        return None
+
+
+try:
+    _ABC = abc.ABC
+except AttributeError:
+    # Python 2.x
+    _ABC = abc.ABCMeta("_ABC", (object,), {})  # type: ignore
+
+
+class SPFileWatcher(_ABC):
+    """Tell whether a file has changed since it was last read or written."""
+
+    def __init__(self, fname):
+        # type: (SPFileWatcher, str) -> None
+        self._path = os.path.abspath(fname)
+
+    @abc.abstractmethod
+    def changed(self, fd=None):
+        # type: (SPFileWatcher, Optional[int]) -> bool
+        """Check whether the file has changed since the last mark() call.
+
+        If `fd` is specified, it is a descriptor for the file opened
+        (and locked) by the caller, so the watcher may examine it
+        instead of looking up the path again.
+        """
+
+    @abc.abstractmethod
+    def mark(self, written, fd=None):
+        # type: (SPFileWatcher, bool, Optional[int]) -> None
+        """Note that we have just read or written the file."""
+
+
+class SPStatWatcher(SPFileWatcher):
+    """Compare the file_id() values of the file."""
+
+    def __init__(self, fname):
+        # type: (SPStatWatcher, str) -> None
+        super(SPStatWatcher, self).__init__(fname)
+        self._last = None  # type: Optional[Tuple[int, ...]]
+
+    def changed(self, fd=None):
+        # type: (SPStatWatcher, Optional[int]) -> bool
+        if self._last is None:
+            return True
+        try:
+            return file_id(self._path, fd) != self._last
+        except OSError:
+            return True
+
+    def mark(self, written, fd=None):
+        # type: (SPStatWatcher, bool, Optional[int]) -> None
+        if written:
+            with _generations_lock:
+                _generations[self._path] = _generations.get(self._path, 0) + 1
+        try:
+            self._last = file_id(self._path, fd)
+        except OSError:
+            self._last = None
+
+
+class SPInotifyWatcher(SPFileWatcher):
+    """Only consider the file changed if inotify(7) says so."""
+
+    def __init__(self, fname, inotify):
+        # type: (SPInotifyWatcher, str, SPInotify) -> None
+        super(SPInotifyWatcher, self).__init__(fname)
+        self._inotify = inotify
+        self._gen = None  # type: Optional[int]
+
+    def changed(self, fd=None):
+        # type: (SPInotifyWatcher, Optional[int]) -> bool
+        if self._gen is None:
+            return True
+        return self._inotify.generation(self._path) != self._gen
+
+    def mark(self, written, fd=None):
+        # type: (SPInotifyWatcher, bool, Optional[int]) -> None
+        self._gen = self._inotify.generation(self._path)
+
+
+def watcher(fname, inotify=False):
+    # type: (str, bool) -> SPFileWatcher
+    """Return a change detector for a file.
+
+    If `inotify` is set and inotify(7) is available, the file is
+    only considered changed if the kernel reports any events for it;
+    otherwise its stat(2) data is examined every time. The inotify
+    watcher must not be used for files on network filesystems, since
+    it only sees the changes made by processes on this host.
+    """
+    if inotify:
+        instance = get_inotify()
+        if instance is not None:
+            return SPInotifyWatcher(fname, instance)
+    return SPStatWatcher(fname)
@@ -53,7 +53,9 @@ class Api(object):
     def fromConfig(cls, cfg: Optional[spconfig.SPConfig] = None) -> Api: ...
 
     def attachmentsList(self) -> List[AttachmentDesc]: ...
+    def snapshotList(self, snapshotName: str) -> List[SnapshotSummary]: ...
     def snapshotsList(self) -> List[SnapshotSummary]: ...
+    def volumeList(self, volumeName: str) -> List[VolumeSummary]: ...
     def volumesList(self) -> List[VolumeSummary]: ...
     def volumesReassign(self, json: List[AttachmentDescDict]) -> None: ...
 
@@ -0,0 +1,30 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Configure the test collection."""
+
+import sys
+
+try:
+    from typing import List
+except ImportError:
+    pass
+
+
+collect_ignore = []  # type: List[str]
+if sys.version_info < (3, 7):
+    # The async/await syntax cannot even be parsed.
+    collect_ignore.append("test_spasync.py")
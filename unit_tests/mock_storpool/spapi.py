@@ -80,6 +80,23 @@ class AttachmentDesc(object):
         self.rights = rights
 
 
+def _find(objects, name):
+    # type: (List[Any], str) -> List[Any]
+    """Look for a volume or snapshot, complain if it is not there."""
+    found = [obj for obj in objects if obj.name == name]
+    if not found:
+        raise ApiError(
+            404,
+            {
+                "error": {
+                    "name": "objectDoesNotExist",
+                    "descr": "{name} does not exist".format(name=name),
+                }
+            },
+        )
+    return found
+
+
 class Api(object):
     """Mock the API bindings class."""
 
@@ -116,6 +133,16 @@ class Api(object):
         """Return the list of attachments specified by the test."""
         return list(self.attachments)
 
+    def volumeList(self, volumeName):  # pylint: disable=invalid-name
+        # type: (Api, str) -> List[VolumeSummary]
+        """Return a single volume specified by the test."""
+        return _find(self.volumes, volumeName)
+
+    def snapshotList(self, snapshotName):  # pylint: disable=invalid-name
+        # type: (Api, str) -> List[SnapshotSummary]
+        """Return a single snapshot specified by the test."""
+        return _find(self.snapshots, snapshotName)
+
     def volumesList(self):  # pylint: disable=invalid-name
         # type: (Api) -> List[VolumeSummary]
         """Return the list of volumes specified by the test."""
@@ -0,0 +1,267 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test the storpool.spopenstack.spasync module."""
+
+import asyncio
+import fcntl
+import json
+import os
+import sys
+
+from typing import List
+from unittest import mock
+
+import pytest
+
+from . import sp_test_import
+from . import utils
+
+sys.meta_path.insert(0, sp_test_import.SPTestModuleFinder)  # type: ignore
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from storpool import spapi  # noqa: E402 pylint: disable=no-name-in-module
+
+from storpool.spopenstack import spasync  # noqa: E402
+from storpool.spopenstack import spattachdb  # noqa: E402
+from storpool.spopenstack import splocked  # noqa: E402
+
+
+@utils.with_tempdir
+def test_lock(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Wait for the locks without blocking the event loop."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    jdb = splocked.SPLockedJSONDB(str(tempf))
+    other = splocked.SPLockedJSONDB(str(tempf), timeout=0.05)
+    events = []  # type: List[str]
+
+    async def hold(name, locked, delay):
+        # type: (str, splocked.SPLockedJSONDB, float) -> None
+        """Lock the file for a while."""
+        async with locked:
+            events.append(name + " locked")
+            await asyncio.sleep(delay)
+            events.append(name + " done")
+
+    async def tick():
+        # type: () -> None
+        """Make sure the event loop keeps running."""
+        for _ in range(5):
+            events.append("tick")
+            await asyncio.sleep(0.02)
+
+    async def main():
+        # type: () -> None
+        """Run the tests."""
+        await asyncio.gather(hold("first", jdb, 0.1), tick())
+        assert events.count("tick") == 5
+        assert events.index("tick", 2) < events.index("first done")
+
+        # Two tasks locking the same object wait for each other.
+        del events[:]
+        await asyncio.gather(hold("a", jdb, 0.05), hold("b", jdb, 0.05))
+        assert events == ["a locked", "a done", "b locked", "b done"]
+
+        # Another object times out.
+        async with jdb.shared():
+            async with other.shared():
+                events.append("both shared")
+            with pytest.raises(splocked.SPLockedFileError):
+                async with other:
+                    pass
+
+            # Upgrade the lock.
+            async with jdb:
+                jdb.add(u"a", 1)
+        assert other.get() == {u"a": 1}
+
+    asyncio.run(main())
+
+
+@utils.with_tempdir
+def test_upgrade(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Give up upgrading a lock without blocking the event loop."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    jdb = splocked.SPLockedJSONDB(str(tempf), timeout=0.1)
+    fd = os.open(str(tempf), os.O_RDONLY)
+    check_fd = os.open(str(tempf), os.O_RDONLY)
+    events = []  # type: List[str]
+
+    def other(operation, name):
+        # type: (int, str) -> None
+        """Let another process lock or unlock the file."""
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        events.append(name)
+
+    async def tick():
+        # type: () -> None
+        """Make sure the event loop keeps running."""
+        for _ in range(10):
+            events.append("tick")
+            await asyncio.sleep(0.02)
+
+    async def main():
+        # type: () -> None
+        """Run the tests."""
+        ticks = asyncio.ensure_future(tick())
+        loop = asyncio.get_running_loop()
+        async with jdb.shared():
+            # The other process gets in while we are trying to upgrade.
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            loop.call_later(0.03, other, fcntl.LOCK_EX, "other locked")
+            loop.call_later(0.2, other, fcntl.LOCK_UN, "other done")
+            with pytest.raises(splocked.SPLockedFileError):
+                async with jdb:
+                    pass
+            events.append("failed")
+
+            # We hold the shared lock again.
+            with pytest.raises(OSError):
+                fcntl.flock(check_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            stats = jdb.stats()
+            assert (stats["acquired"], stats["failed"]) == (1, 1)
+            assert stats["retries"] > 2
+
+            async with jdb:
+                jdb.add(u"a", 1)
+        await ticks
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(check_fd)
+        os.close(fd)
+    assert events.index("other locked") < events.index("other done")
+    assert events.index("other done") < events.index("failed")
+    assert events[: events.index("failed")].count("tick") >= 5
+    assert jdb.get() == {u"a": 1}
+
+
+@utils.with_tempdir
+def test_sync(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Attach some volumes without blocking the event loop."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(
+        json.dumps(
+            {
+                req: {
+                    "id": req,
+                    "volume": "os-vol-" + req,
+                    "volsnap": False,
+                    "rights": 2,
+                }
+                for req in ("a", "b")
+            }
+        ),
+        encoding="UTF-8",
+    )
+
+    att = spattachdb.AttachDB(fname=str(tempf), log=mock.Mock())
+    att.config()
+    att.api().volumes = [
+        spapi.VolumeSummary("os-vol-a"),
+        spapi.VolumeSummary("os-vol-b"),
+    ]
+
+    async def main():
+        # type: () -> None
+        """Run the tests."""
+        await asyncio.gather(
+            att.sync_async("a", None), att.sync_async("b", None)
+        )
+
+    with mock.patch("os.path.exists", new=lambda path: True):
+        asyncio.run(main())
+    assert {item["volume"] for req in att.api().reassign for item in req} == {
+        "os-vol-a",
+        "os-vol-b",
+    }
+    assert sorted(att.get()) == ["a", "b"]
+
+    # A stale request is removed.
+    att.api().reassign = []
+    att.api().volumes = [spapi.VolumeSummary("os-vol-a")]
+    with mock.patch("os.path.exists", new=lambda path: True):
+        asyncio.run(att.sync_async("a", None))
+    assert att.api().reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+    assert sorted(att.get()) == ["a"]
+
+    # So is one for a volume deleted before it could be attached.
+    att.api().volumes.append(spapi.VolumeSummary("os-vol-c"))
+    att.add(u"c", {"id": "c", "volume": "os-vol-c", "rights": 2})
+
+    real_reassign = att.api().volumesReassign
+
+    def reassign(**kwargs):
+        # type: (**List[spapi.AttachmentDescDict]) -> None
+        """Delete the volume just before attaching it."""
+        raw = kwargs["json"]
+        if any(item["volume"] == "os-vol-c" for item in raw):
+            att.api().volumes.pop()
+            raise spapi.ApiError(
+                "oof", {"error": {"name": "objectDoesNotExist"}}
+            )
+        real_reassign(json=raw)
+
+    att.api().reassign = []
+    with mock.patch.object(att.api(), "volumesReassign", new=reassign):
+        with mock.patch("os.path.exists", new=lambda path: True):
+            asyncio.run(att.sync_async("c", None))
+    assert att.api().reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+    assert sorted(att.get()) == ["a"]
+
+
+@utils.with_tempdir
+def test_attach_many_and_wait(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Wait for the devices without blocking the event loop."""
+    devd = tempd / "dev"
+    devd.mkdir()
+    att = spattachdb.AttachDB(
+        fname=str(tempd / "attach.json"),
+        log=mock.Mock(spec=["warn"]),
+        device_root=str(devd),
+    )
+    att.config()
+    events = []  # type: List[str]
+
+    async def create():
+        # type: () -> None
+        """Let the device show up a bit later."""
+        await asyncio.sleep(0.05)
+        events.append("created")
+        (devd / "os-vol-a").write_text(u"", encoding="UTF-8")
+
+    async def wait():
+        # type: () -> None
+        """Attach the volume, wait for the device."""
+        await spasync.attach_many_and_wait(att, 42, [("os-vol-a", False, 2)])
+        events.append("attached")
+
+    async def main():
+        # type: () -> None
+        """Run the tests."""
+        await asyncio.gather(wait(), create())
+
+    asyncio.run(main())
+    assert events == ["created", "attached"]
+    assert att.api().reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+    assert att.LOG.warn.call_count == 0  # type: ignore
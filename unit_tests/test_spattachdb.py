@@ -15,11 +15,14 @@
 # limitations under the License.
 #
 """Test the classes in the storpool.spopenstack.spattachdb module."""
+# pylint: disable=too-many-lines
 
 from __future__ import print_function
 
+import collections
 import json as jsonmod
 import sys
+import threading
 
 try:
     from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -49,6 +52,8 @@ from storpool import spapi  # noqa: E402 pylint: disable=no-name-in-module
 from storpool import spconfig  # noqa: E402 pylint: disable=no-name-in-module
 
 from storpool.spopenstack import spattachdb  # noqa: E402
+from storpool.spopenstack import splocked  # noqa: E402
+from storpool.spopenstack import spwatch  # noqa: E402
 
 
 def with_attachdb(
@@ -72,6 +77,28 @@ def with_attachdb(
     return wrapped
 
 
+class FakeClock(object):
+    """Pretend that time only passes when somebody sleeps."""
+
+    def __init__(self):
+        # type: (FakeClock) -> None
+        self.now = 0.0
+        self.sleeps = []  # type: List[float]
+
+    def sleep(self, interval):
+        # type: (FakeClock, float) -> None
+        """No need to waste time sleeping."""
+        assert interval > 0
+        assert interval < 1
+        self.sleeps.append(interval)
+        self.now += interval
+
+    def monotonic(self):
+        # type: (FakeClock) -> float
+        """Return the current fake time."""
+        return self.now
+
+
 @with_attachdb
 def test_trivial(tempf, att):
     # type: (utils.pathlib.Path, spattachdb.AttachDB) -> None
@@ -132,6 +159,7 @@ def test_attach_and_wait(_tempf, att):
     volname = att.volumeName("beef")
     spname = "/dev/storpool/" + volname
     state = {"count": 0}
+    clock = FakeClock()
 
     def mock_exists(path):
         # type: (str) -> bool
@@ -140,31 +168,138 @@ def test_attach_and_wait(_tempf, att):
         state["count"] += 1
         return False
 
-    def mock_sleep(interval):
-        # type: (int) -> None
-        """No need to waste time sleeping."""
-        assert interval > 0
-        assert interval < 10
-
     with mock.patch("os.path.exists", new=mock_exists):
-        with mock.patch("time.sleep", new=mock_sleep):
-            att._attach_and_wait(42, volname, False, 2)
+        with mock.patch("time.sleep", new=clock.sleep):
+            with mock.patch.object(splocked, "monotonic", new=clock.monotonic):
+                att._attach_and_wait(42, volname, False, 2)
 
-    assert state["count"] == 10
+    assert state["count"] == len(clock.sleeps) + 1
+    assert max(clock.sleeps) == spattachdb.DEVICE_POLL_MAX
+    assert clock.now == pytest.approx(spattachdb.DEVICE_TIMEOUT)
     assert att.api().reassign == [[{"volume": volname, "rw": [42]}]]
+    assert att.LOG.warn.call_count == 1  # type: ignore
+    assert spname in att.LOG.warn.call_args[0][0]  # type: ignore
 
     with pytest.raises(spapi.ApiError):
         att._attach_and_wait(42, volname, True, 2)
 
-    with mock.patch("os.path.exists", new=mock_exists):
-        with mock.patch("time.sleep", new=mock_sleep):
-            att._attach_and_wait(43, volname, True, 1)
+    with mock.patch("os.path.exists", new=lambda path: True):
+        att._attach_and_wait(43, volname, True, 1)
 
-    assert state["count"] == 20
     assert att.api().reassign == [
         [{"volume": volname, "rw": [42]}],
         [{"snapshot": volname, "ro": [43]}],
     ]
+    assert att.LOG.warn.call_count == 1  # type: ignore
+
+
+@with_attachdb
+def test_attach_many_and_wait(_tempf, att):
+    # type: (utils.pathlib.Path, spattachdb.AttachDB) -> None
+    # pylint: disable=protected-access
+    """Test attaching several volumes with a single API request."""
+    polls = []  # type: List[str]
+    clock = FakeClock()
+
+    def mock_exists(path):
+        # type: (str) -> bool
+        """The snapshot shows up a bit later than the volumes."""
+        polls.append(path)
+        return not path.endswith("-snap") or len(clock.sleeps) >= 3
+
+    with mock.patch("os.path.exists", new=mock_exists):
+        with mock.patch("time.sleep", new=clock.sleep):
+            att._attach_many_and_wait(
+                42,
+                [
+                    ("os-vol-a", False, 2),
+                    ("os-vol-b", False, 1),
+                    ("os-snap", True, 1),
+                ],
+            )
+
+    assert att.api().reassign == [
+        [
+            {"volume": "os-vol-a", "rw": [42]},
+            {"volume": "os-vol-b", "ro": [42]},
+            {"snapshot": "os-snap", "ro": [42]},
+        ]
+    ]
+    assert clock.sleeps == [
+        spattachdb.DEVICE_POLL_MIN,
+        spattachdb.DEVICE_POLL_MIN * 2,
+        spattachdb.DEVICE_POLL_MIN * 4,
+    ]
+    assert att.LOG.warn.call_count == 0  # type: ignore
+    assert (
+        polls
+        == [
+            "/dev/storpool/os-vol-a",
+            "/dev/storpool/os-vol-b",
+            "/dev/storpool/os-snap",
+        ]
+        + ["/dev/storpool/os-snap"] * 3
+    )
+
+    with pytest.raises(spapi.ApiError):
+        att._attach_many_and_wait(
+            42, [("os-vol-c", False, 2), ("os-snap", True, 2)]
+        )
+    assert len(att.api().reassign) == 1
+
+
+@utils.with_tempdir
+def test_device_root(tempd):
+    # type: (utils.pathlib.Path) -> None
+    # pylint: disable=protected-access
+    """Test waiting for the devices in a directory via inotify(7)."""
+    devd = tempd / "dev"
+    log = mock.Mock(spec=["warn"])
+    att = spattachdb.AttachDB(
+        fname=str(tempd / "attach.json"), log=log, device_root=str(devd)
+    )
+    att.config()
+
+    # No such directory, keep looking for the devices.
+    clock = FakeClock()
+    with mock.patch("time.sleep", new=clock.sleep):
+        with mock.patch.object(splocked, "monotonic", new=clock.monotonic):
+            missing = att._wait_for_devices([str(devd / "os-vol-a")])
+    assert missing == [str(devd / "os-vol-a")]
+    assert clock.now == pytest.approx(spattachdb.DEVICE_TIMEOUT)
+    assert log.warn.call_count == 1
+
+    if spwatch.get_inotify() is None:
+        pytest.skip("inotify(7) is not available")
+    devd.mkdir()
+
+    def create():
+        # type: () -> None
+        """Let the devices show up a bit later, one at a time."""
+        for name in ("os-vol-a", "os-vol-b"):
+            threading.Event().wait(0.05)
+            (devd / name).write_text(u"", encoding="UTF-8")
+
+    polls = len(clock.sleeps)
+    thr = threading.Thread(target=create)
+    thr.start()
+    try:
+        # The inotify events wake us up; no need to sleep at all.
+        with mock.patch("time.sleep", new=clock.sleep):
+            att._attach_many_and_wait(
+                42, [("os-vol-a", False, 2), ("os-vol-b", False, 2)]
+            )
+    finally:
+        thr.join()
+    assert (devd / "os-vol-b").exists()
+    assert len(clock.sleeps) == polls
+    assert log.warn.call_count == 1
+    assert att.api().reassign == [
+        [
+            {"volume": "os-vol-a", "rw": [42]},
+            {"volume": "os-vol-b", "rw": [42]},
+        ]
+    ]
 
 
 @with_attachdb
@@ -277,14 +412,25 @@ def test_sync(tempf, att):
     ):  # type: (...) -> None
         """Run att.sync() in the specified environment."""
 
-        with mock.patch.object(att, "_attach_and_wait") as att_wait:
+        with mock.patch.object(att, "_attach_many_and_wait") as att_wait:
             with mock.patch.object(att, "_detach_and_wait") as det_wait:
                 att.api().volumes = volumes if volumes else []
                 att.api().snapshots = snapshots if snapshots else []
                 att.api().attachments = attachments if attachments else []
                 att.sync(args[0], args[1])
+                assert att_wait.call_count <= 1
+                att_calls = [
+                    mock.call(
+                        client=kwargs["client"],
+                        volume=volume,
+                        volsnap=volsnap,
+                        rights=rights,
+                    )
+                    for (_, kwargs) in att_wait.call_args_list
+                    for (volume, volsnap, rights) in kwargs["volumes"]
+                ]
                 assert sorted(
-                    att_wait.call_args_list, key=compare_attach  # type: ignore
+                    att_calls, key=compare_attach  # type: ignore
                 ) == sorted(
                     expected[0], key=compare_attach  # type: ignore
                 )
@@ -476,6 +622,419 @@ def test_sync(tempf, att):
     )
 
 
+@with_attachdb
+def test_sync_shared(tempf, att):
+    # type: (utils.pathlib.Path, spattachdb.AttachDB) -> None
+    """Test that sync() only locks the file exclusively if needed."""
+    # pylint: disable=protected-access
+    voldata = {
+        "a": {"id": "a", "volume": "os-vol-a", "volsnap": False, "rights": 2},
+    }
+    tempf.write_text(six.text_type(jsonmod.dumps(voldata)), encoding="UTF-8")
+    att.config()
+    att._db._timeout = 0.05
+    att.api().volumes = [spapi.VolumeSummary("os-vol-a")]
+
+    reader = splocked.SPLockedJSONDB(str(tempf))
+    with reader.shared():
+        att.api().attachments = [
+            spapi.AttachmentDesc(
+                volume="os-vol-a", client=42, snapshot=False, rights="rw"
+            ),
+        ]
+        att.sync("a", None)
+
+        att.api().attachments = []
+        with pytest.raises(splocked.SPLockedFileError):
+            att.sync("a", None)
+        assert att.api().reassign == []
+
+    with mock.patch("os.path.exists", new=lambda path: True):
+        att.sync("a", None)
+    assert att.api().reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+
+
+INVENTORY_REQUESTS = {
+    "a": {"id": "a", "volume": "os-vol-a", "volsnap": False, "rights": 2},
+    "b": {"id": "b", "volume": "os-vol-b", "volsnap": False, "rights": 2},
+}
+
+
+def inventory_attachdb(
+    tempd,  # type: utils.pathlib.Path
+    requests,  # type: Dict[str, Any]
+):
+    # type: (...) -> Tuple[spattachdb.AttachDB, Dict[str, int]]
+    """Create an AttachDB object that reuses the StorPool API lists.
+
+    The devices of the attached volumes show up in the "dev" directory
+    at once. Count the invocations of the API methods that list things.
+    """
+    devd = tempd / "dev"
+    devd.mkdir()
+    tempf = tempd / "attach.json"
+    tempf.write_text(six.text_type(jsonmod.dumps(requests)), encoding="UTF-8")
+    att = spattachdb.AttachDB(
+        fname=str(tempf),
+        log=mock.Mock(spec=["warn"]),
+        override_config=dict(
+            spconfig.get_config_dictionary(),
+            SP_OPENSTACK_INVENTORY_TTL="60",
+        ),
+        device_root=str(devd),
+    )
+    att.config()
+    assert att.inventoryTTL() == 60.0
+    api = att.api()
+    api.volumes = [spapi.VolumeSummary("os-vol-a")]
+
+    real_reassign = api.volumesReassign
+
+    def reassign(json):
+        # type: (List[spapi.AttachmentDescDict]) -> None
+        """Let the devices show up or go away at once."""
+        real_reassign(json)
+        for item in json:
+            devpath = devd / str(item.get("volume", item.get("snapshot")))
+            if "detach" in item:
+                devpath.unlink()
+            else:
+                devpath.write_text(u"", encoding="UTF-8")
+
+    setattr(api, "volumesReassign", reassign)
+
+    counts = collections.Counter()  # type: Dict[str, int]
+
+    def count(name):
+        # type: (str) -> Callable[..., List[Any]]
+        """Count the invocations of an API method."""
+        orig = getattr(api, name)
+
+        def wrapped(*args):
+            # type: (Any) -> List[Any]
+            """Count and invoke."""
+            counts[name] += 1
+            res = orig(*args)
+            assert isinstance(res, list)
+            return res
+
+        return wrapped
+
+    for name in (
+        "attachmentsList",
+        "volumeList",
+        "volumesList",
+        "snapshotList",
+        "snapshotsList",
+    ):
+        setattr(api, name, count(name))
+
+    return att, counts
+
+
+@utils.with_tempdir
+def test_inventory_cache(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that sync() reuses the StorPool API lists if allowed to."""
+    att, counts = inventory_attachdb(tempd, INVENTORY_REQUESTS)
+    api = att.api()
+
+    # Attach os-vol-a, forget about the nonexistent os-vol-b.
+    att.sync("a", None)
+    assert api.reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+    assert sorted(att.get()) == ["a"]
+    assert counts == {"attachmentsList": 1, "volumeList": 2}
+
+    # The cached attachments list was updated, nothing to do now.
+    att.sync("a", None)
+    assert len(api.reassign) == 1
+    assert counts == {"attachmentsList": 1, "volumeList": 2}
+
+
+@utils.with_tempdir
+def test_inventory_many(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test fetching the full volumes list when many are needed."""
+    att, counts = inventory_attachdb(tempd, {})
+    api = att.api()
+
+    # Many new volumes: fetch the full list once, then use it.
+    names = ["c{idx}".format(idx=idx) for idx in range(10)]
+    for name in names:
+        api.volumes.append(spapi.VolumeSummary("os-vol-" + name))
+    att.add_many(
+        {
+            name: {
+                "id": name,
+                "volume": "os-vol-" + name,
+                "volsnap": False,
+                "rights": 1,
+            }
+            for name in names
+        }
+    )
+    att.sync("c0", None)
+    assert len(api.reassign) == 1
+    assert sorted(item["volume"] for item in api.reassign[0]) == sorted(
+        "os-vol-" + name for name in names
+    )
+    assert counts == {"attachmentsList": 1, "volumesList": 1}
+    att.remove_keys(names)
+
+    # A new volume is not in the cached list, so look for it.
+    api.volumes.append(spapi.VolumeSummary("os-vol-b"))
+    att.add("b", INVENTORY_REQUESTS["b"])
+    att.sync("b", None)
+    assert api.reassign[1:] == [[{"volume": "os-vol-b", "rw": [42]}]]
+    assert counts == {
+        "attachmentsList": 1,
+        "volumeList": 1,
+        "volumesList": 1,
+    }
+
+
+@utils.with_tempdir
+def test_inventory_detach(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that detaching a volume updates the cached attachments."""
+    att, counts = inventory_attachdb(tempd, INVENTORY_REQUESTS)
+    api = att.api()
+    api.volumes.append(spapi.VolumeSummary("os-vol-b"))
+    att.sync("a", None)
+    assert len(api.reassign) == 1
+
+    att.sync("b", "os-vol-b")
+    assert api.reassign[1:] == [
+        [{"volume": "os-vol-b", "detach": [42], "force": False}]
+    ]
+    att.remove("b")
+    att.sync("a", None)
+    assert len(api.reassign) == 2
+    assert counts["attachmentsList"] == 1
+
+
+@utils.with_tempdir
+def test_inventory_failure(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that a failed StorPool API request invalidates the cache."""
+    # pylint: disable=protected-access
+    att, counts = inventory_attachdb(tempd, {"a": INVENTORY_REQUESTS["a"]})
+    api = att.api()
+    att.sync("a", None)
+    assert counts["attachmentsList"] == 1
+
+    def fail(json):
+        # type: (List[spapi.AttachmentDescDict]) -> None
+        """Refuse to do anything."""
+        raise spapi.ApiError("oof", {"error": {"name": "objectDoesNotExist"}})
+
+    with mock.patch.object(api, "volumesReassign", new=fail):
+        with pytest.raises(spapi.ApiError):
+            att._attach_request(42, "os-vol-c", False, 2)
+    att.sync("a", None)
+    assert counts["attachmentsList"] == 2
+    assert len(api.reassign) == 2
+
+
+@utils.with_tempdir
+def test_inventory_deleted(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that a volume deleted after the full list was fetched is gone."""
+    # pylint: disable=protected-access
+    att, counts = inventory_attachdb(tempd, {"a": INVENTORY_REQUESTS["a"]})
+    api = att.api()
+    att.sync("a", None)
+    api.attachments = [
+        spapi.AttachmentDesc(
+            volume="os-vol-a", client=42, snapshot=False, rights="rw"
+        ),
+    ]
+
+    names = ["os-vol-c{idx}".format(idx=idx) for idx in range(10)]
+    api.volumes.extend(
+        spapi.VolumeSummary(name) for name in names + ["os-vol-d"]
+    )
+    assert "os-vol-d" in att._existing(["os-vol-d"] + names, False)
+    assert counts["volumesList"] == 1
+    api.volumes.pop()
+    att.add("d", dict(INVENTORY_REQUESTS["b"], id="d", volume="os-vol-d"))
+    real_reassign = api.volumesReassign
+
+    def reassign(json):
+        # type: (List[spapi.AttachmentDescDict]) -> None
+        """Refuse to attach a nonexistent volume."""
+        existing = {vol.name for vol in api.volumes}
+        if any(item["volume"] not in existing for item in json):
+            raise spapi.ApiError(
+                "oof", {"error": {"name": "objectDoesNotExist"}}
+            )
+        real_reassign(json)
+
+    with mock.patch.object(api, "volumesReassign", new=reassign):
+        att.sync("d", None)
+    assert sorted(att.get()) == ["a"]
+    assert len(api.reassign) == 1
+    assert counts["attachmentsList"] == 2
+
+
+@with_attachdb
+def test_inventory_no_ttl(tempf, att):
+    # type: (utils.pathlib.Path, spattachdb.AttachDB) -> None
+    """Test that the StorPool API lists are fetched each time by default."""
+    tempf.write_text(
+        six.text_type(jsonmod.dumps({"a": INVENTORY_REQUESTS["a"]})),
+        encoding="UTF-8",
+    )
+    assert att.inventoryTTL() == 0.0
+    att.config()
+    att.api().volumes = [spapi.VolumeSummary("os-vol-a")]
+    att.api().attachments = [
+        spapi.AttachmentDesc(
+            volume="os-vol-a", client=42, snapshot=False, rights="rw"
+        ),
+    ]
+    with mock.patch.object(
+        att.api(), "attachmentsList", wraps=att.api().attachmentsList
+    ) as att_list:
+        with mock.patch.object(att.api(), "volumeList") as vol_list:
+            att.sync("a", None)
+            att.sync("a", None)
+            assert att_list.call_count == 2
+            assert vol_list.call_count == 0
+
+
+@utils.with_tempdir
+def test_inventory_stale(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that the attachments done by other processes are noticed."""
+    att, counts = inventory_attachdb(tempd, {"a": INVENTORY_REQUESTS["a"]})
+    api = att.api()
+    api.volumes.append(spapi.VolumeSummary("os-vol-b"))
+    devd = tempd / "dev"
+
+    att.sync("a", None)
+    att.sync("a", None)
+    assert counts["attachmentsList"] == 1
+    assert len(api.reassign) == 1
+
+    # Somebody else detached it; do not trust the cached list.
+    (devd / "os-vol-a").unlink()
+    att.sync("a", None)
+    assert counts["attachmentsList"] == 2
+    assert len(api.reassign) == 2
+
+    # Somebody else attached a volume; it is still detached.
+    att.add("b", INVENTORY_REQUESTS["b"])
+    api.attachments = [
+        spapi.AttachmentDesc(
+            volume=name, client=42, snapshot=False, rights="rw"
+        )
+        for name in ("os-vol-a", "os-vol-b")
+    ]
+    (devd / "os-vol-b").write_text(u"", encoding="UTF-8")
+    att.sync("b", "os-vol-b")
+    assert counts["attachmentsList"] == 3
+    assert api.reassign[2:] == [
+        [{"volume": "os-vol-b", "detach": [42], "force": False}]
+    ]
+
+
+@utils.with_tempdir
+def test_sync_backends(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test sync() with the atomic, journal, sharded, and SQLite backends."""
+    voldata = {
+        "a": {"id": "a", "volume": "os-vol-a", "volsnap": False, "rights": 2},
+    }
+    with pytest.raises(ValueError):
+        spattachdb.AttachDB(log=mock.Mock(), backend="pickle")
+
+    (tempd / "attach.atomic").write_text(u"{}", encoding="UTF-8")
+    (tempd / "attach.journal").write_text(u"{}", encoding="UTF-8")
+    for backend in ("atomic", "journal", "sharded", "sqlite"):
+        att = spattachdb.AttachDB(
+            fname=str(tempd / ("attach." + backend)),
+            log=mock.Mock(),
+            backend=backend,
+        )
+        assert att.get() == {}
+        att.add_many(voldata)
+        att.config()
+        att.api().volumes = [spapi.VolumeSummary("os-vol-a")]
+
+        with mock.patch("os.path.exists", new=lambda path: True):
+            att.sync("a", None)
+        assert att.api().reassign == [[{"volume": "os-vol-a", "rw": [42]}]]
+        assert att.get() == voldata
+        assert splocked.thaw(att.snapshot()) == voldata
+
+        att.remove("a")
+        assert att.get() == {}
+        assert not (tempd / "attach.json").exists()
+
+
+@utils.with_tempdir
+def test_import_legacy(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test moving the requests from the JSON file to a new backend."""
+    voldata = {
+        "a": {"id": "a", "volume": "os-vol-a", "volsnap": False, "rights": 2},
+        "b": {"id": "b", "volume": "os-vol-b", "volsnap": False, "rights": 2},
+    }
+    tempf = tempd / "attach.json"
+    for backend, fname in (
+        ("sharded", str(tempf)),
+        ("sqlite", None),
+    ):
+        tempf.write_text(
+            six.text_type(jsonmod.dumps(voldata)), encoding="UTF-8"
+        )
+        with mock.patch.object(
+            spattachdb, "SQLITE_DBFILE", new=str(tempd / "attach.sqlite")
+        ):
+            # Nothing is moved unless asked to.
+            unaware = spattachdb.AttachDB(
+                fname=fname, log=mock.Mock(), backend=backend
+            )
+            assert unaware.get() == {}
+            assert jsonmod.loads(tempf.read_text(encoding="UTF-8")) == voldata
+
+            log = mock.Mock(spec=["info"])
+            att, second, third = [
+                spattachdb.AttachDB(
+                    fname=fname,
+                    log=log if idx == 0 else mock.Mock(),
+                    backend=backend,
+                    legacy_fname=str(tempf),
+                )
+                for idx in range(3)
+            ]
+
+        # The requests are moved the first time they are accessed...
+        assert att.get() == voldata
+        assert "moved 2 attachment" in log.info.call_args[0][0]
+        assert jsonmod.loads(tempf.read_text(encoding="UTF-8")) == {}
+        att.remove("a")
+
+        # ...so the ones removed since are not brought back...
+        assert second.get() == {"b": voldata["b"]}
+
+        # ...and the ones already stored are not overwritten.
+        tempf.write_text(
+            six.text_type(
+                jsonmod.dumps(
+                    {"b": dict(voldata["b"], rights=1), "c": voldata["a"]}
+                )
+            ),
+            encoding="UTF-8",
+        )
+        assert third.get() == {"b": voldata["b"], "c": voldata["a"]}
+        assert jsonmod.loads(tempf.read_text(encoding="UTF-8")) == {}
+
+        for obj in (unaware, att, second, third):
+            obj.close()
+
+
 @with_attachdb
 def test_ourid_required(tempf, att):
     # type: (utils.pathlib.Path, spattachdb.AttachDB) -> None
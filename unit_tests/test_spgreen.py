@@ -0,0 +1,216 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test the storpool.spopenstack.spgreen module."""
+
+import fcntl
+import os
+import resource
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from . import utils
+from .mock_storpool import spapi, spconfig
+
+sys.modules["storpool.spapi"] = spapi
+sys.modules["storpool.spconfig"] = spconfig
+
+# pylint: disable=wrong-import-position,wrong-import-order
+if sys.version_info[0] < 3:
+    import mock  # pylint: disable=import-error
+else:
+    from unittest import mock
+
+from storpool.spopenstack import spgreen  # noqa: E402
+from storpool.spopenstack import splocked  # noqa: E402
+
+try:
+    from typing import Any, Dict, List  # noqa: E402
+except ImportError:
+    pass
+
+
+def fake_eventlet(sleeps, patched=True):
+    # type: (List[float], bool) -> Dict[str, types.ModuleType]
+    """Pretend that eventlet is loaded, with OS threads as green ones."""
+    eventlet = types.ModuleType("eventlet")
+    setattr(eventlet, "sleep", sleeps.append)
+    patcher = types.ModuleType("eventlet.patcher")
+    setattr(patcher, "is_monkey_patched", lambda name: patched)
+    semaphore = types.ModuleType("eventlet.semaphore")
+    setattr(semaphore, "Semaphore", threading.Semaphore)
+    greenlet = types.ModuleType("greenlet")
+    setattr(greenlet, "getcurrent", threading.current_thread)
+    return {
+        "eventlet": eventlet,
+        "eventlet.patcher": patcher,
+        "eventlet.semaphore": semaphore,
+        "greenlet": greenlet,
+    }
+
+
+def test_mode():
+    # type: () -> None
+    """Test the detection and selection of the cooperative mode."""
+    sleeps = []  # type: List[float]
+    assert spgreen.mode() == spgreen.NATIVE
+    assert not spgreen.cooperative()
+
+    with mock.patch.dict(sys.modules, fake_eventlet(sleeps, False)):
+        assert spgreen.mode() == spgreen.NATIVE
+    with mock.patch.dict(sys.modules, fake_eventlet(sleeps)):
+        assert spgreen.mode() == spgreen.EVENTLET
+        assert spgreen.cooperative()
+        spgreen.sleep(0.5)
+
+        spgreen.set_mode(spgreen.NATIVE)
+        try:
+            assert not spgreen.cooperative()
+            with mock.patch("time.sleep", new=sleeps.append):
+                spgreen.sleep(1.5)
+        finally:
+            spgreen.set_mode(spgreen.AUTO)
+
+    assert sleeps == [0.5, 1.5]
+    with pytest.raises(ValueError):
+        spgreen.set_mode("greenish")
+
+
+def test_rlock():
+    # type: () -> None
+    """Test the locks owned by green threads."""
+    sleeps = []  # type: List[float]
+    with mock.patch.dict(sys.modules, fake_eventlet(sleeps)):
+        lock = spgreen.rlock()
+        assert isinstance(lock, spgreen.SPGreenRLock)
+        results = []  # type: List[bool]
+
+        def other():
+            # type: () -> None
+            """Try to obtain the lock in another green thread."""
+            # These attempts fail, so there is nothing to release.
+            # pylint: disable=consider-using-with
+            results.append(lock.acquire(False))
+            results.append(lock.acquire(True, 0.01))
+            with pytest.raises(RuntimeError):
+                lock.release()
+
+        with lock as first:
+            assert first
+            with lock as second:
+                assert second
+                thr = threading.Thread(target=other)
+                thr.start()
+                thr.join()
+                assert results == [False, False]
+
+        with pytest.raises(RuntimeError):
+            lock.release()
+        with lock:
+            pass
+
+
+@utils.with_tempdir
+def test_cooperative_flock(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Make sure a lock is waited for by yielding to the hub."""
+    tempf = tempd / "green.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    sleeps = []  # type: List[float]
+    fd = os.open(str(tempf), os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        def green_sleep(interval):
+            # type: (float) -> None
+            """Let the other holder go after a while."""
+            sleeps.append(interval)
+            if len(sleeps) == 5:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            time.sleep(0.001)
+
+        with mock.patch.dict(sys.modules, fake_eventlet([])):
+            setattr(sys.modules["eventlet"], "sleep", green_sleep)
+            spgreen.set_mode(spgreen.EVENTLET)
+            try:
+                lck = splocked.SPLockedJSONDB(str(tempf), timeout=None)
+                with lck:
+                    # pylint: disable=protected-access
+                    assert lck._owned()
+                    assert isinstance(lck._rlock, spgreen.SPGreenRLock)
+            finally:
+                spgreen.set_mode(spgreen.AUTO)
+    finally:
+        os.close(fd)
+
+    assert len(sleeps) == 5
+    assert sleeps == sorted(sleeps)
+
+
+def test_wait_readable():
+    # type: () -> None
+    """Wait for a file descriptor, yielding to the hub if needed."""
+    rfd, wfd = os.pipe()
+    try:
+        assert not spgreen.wait_readable(rfd, 0.01)
+        os.write(wfd, b"x")
+        assert spgreen.wait_readable(rfd, 0.01)
+
+        selects = []  # type: List[float]
+
+        def green_select(rlist, wlist, xlist, timeout):
+            # type: (List[int], List[int], List[int], float) -> Any
+            """Record the call, pretend nothing happened."""
+            assert (rlist, wlist, xlist) == ([rfd], [], [])
+            selects.append(timeout)
+            return ([], [], [])
+
+        modules = fake_eventlet([])
+        green = types.ModuleType("eventlet.green.select")
+        setattr(green, "select", green_select)
+        modules["eventlet.green.select"] = green
+        with mock.patch.dict(sys.modules, modules):
+            assert not spgreen.wait_readable(rfd, 0.5)
+        assert selects == [0.5]
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+
+def test_wait_readable_high_fd():
+    # type: () -> None
+    """Wait for a file descriptor above the select(2) limit."""
+    high = 1100
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= high:
+        pytest.skip("Cannot open that many file descriptors")
+
+    rfd, wfd = os.pipe()
+    try:
+        os.dup2(rfd, high)
+        try:
+            assert not spgreen.wait_readable(high, 0.01)
+            os.write(wfd, b"x")
+            assert spgreen.wait_readable(high, 0.01)
+        finally:
+            os.close(high)
+    finally:
+        os.close(rfd)
+        os.close(wfd)
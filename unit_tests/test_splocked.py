@@ -17,11 +17,16 @@
 """Test the classes in the storpool.spopenstack.splocked module."""
 
 import errno
+import fcntl
 import json
+import os
+import stat
 import sys
+import threading
+import time
 
 try:
-    from typing import Text
+    from typing import Any, Callable, Dict, List, Text, Tuple
 except ImportError:
     pass
 
@@ -135,3 +140,838 @@ def test_jsondb(tempd):
     jdb.remove_keys([u"c", u"d"])
     assert jdb.get() == {u"a": u"value"}
     assert_db()
+
+
+@utils.with_tempdir
+def test_acquire(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the explicit acquire(), try_lock(), and release() methods."""
+    tempf = tempd / "lock.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    fname = str(tempf.absolute())
+
+    first = splocked.SPLockedFile(fname)
+    second = splocked.SPLockedFile(fname, timeout=0.05)
+
+    first.acquire()
+    assert not second.try_lock()
+    with pytest.raises(splocked.SPLockedFileError):
+        second.acquire()
+    with pytest.raises(splocked.SPLockedFileError):
+        with second:
+            pass
+    first.release()
+
+    assert second.try_lock()
+    assert second.try_lock()
+    assert not first.try_lock()
+    second.release()
+    second.release()
+
+    first.acquire(timeout=None)
+    with first:
+        assert not second.try_lock()
+    first.release()
+
+    with second:
+        pass
+
+
+@utils.with_tempdir
+def test_try_lock_retry(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test polling for a lock upgrade without waiting for anything."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    jdb = splocked.SPLockedJSONDB(str(tempf), timeout=0.05)
+    sdb = splocked.SPShardedJSONDB(str(tempd / "attach.json"), shards=2)
+    assert not sdb.get()
+
+    for locked, fname in (
+        (jdb, tempf),
+        (sdb, tempd / "attach.json.1"),
+    ):  # type: Tuple[Any, utils.pathlib.Path]
+        fd = os.open(str(fname), os.O_RDONLY)
+        try:
+            assert locked.try_lock(shared=True)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            assert not locked.try_lock(retry=True)
+
+            # Our shared lock was dropped, so somebody else may write.
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            assert not locked.try_lock(retry=True)
+            assert not locked.try_lock(shared=True, retry=True)
+            assert not locked.try_lock()
+
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            assert locked.try_lock(shared=True, retry=True)
+            locked.release()
+            with pytest.raises(OSError):
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked.release()
+        finally:
+            os.close(fd)
+
+    # Only the last attempt counts as a failure.
+    stats = jdb.stats()
+    assert (stats["acquired"], stats["failed"]) == (1, 1)
+    assert stats["retries"] >= 3
+
+
+@utils.with_tempdir
+def test_shared(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test shared locks and upgrading them to exclusive ones."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u'{"a": 1}', encoding="UTF-8")
+    fname = str(tempf.absolute())
+
+    first = splocked.SPLockedJSONDB(fname, timeout=0.05)
+    second = splocked.SPLockedJSONDB(fname, timeout=0.05)
+
+    with first.shared():
+        # Readers do not block each other...
+        assert first.get() == {u"a": 1}
+        assert second.get() == {u"a": 1}
+        gen = first.lock_generation()
+        with second.shared():
+            # ...but a writer has to wait for all of them.
+            with pytest.raises(splocked.SPLockedFileError):
+                first.add(u"b", 2)
+            assert first.get() == {u"a": 1}
+
+            # Removing nonexistent keys does not need an exclusive lock.
+            first.remove_keys([u"b", u"c"])
+
+        # The shared lock is upgraded when nobody else holds it.
+        first.add(u"b", 2)
+        assert not second.try_lock(shared=True)
+
+        # Nobody else modified the file in the meantime.
+        assert first.lock_generation() == gen
+
+    assert second.get() == {u"a": 1, u"b": 2}
+    assert json.loads(tempf.read_text(encoding="UTF-8")) == second.get()
+
+    real_flock = splocked._flock  # pylint: disable=protected-access
+
+    def sneak_in(fd, operation, *args):
+        # type: (int, int, Any) -> bool
+        """Modify the file while the lock is being upgraded."""
+        if operation == fcntl.LOCK_EX:
+            tempf.write_text(u'{"a": 1, "c": 3}', encoding="UTF-8")
+        return real_flock(fd, operation, *args)
+
+    with first.shared():
+        gen = first.lock_generation()
+        assert first.get() == {u"a": 1, u"b": 2}
+        with mock.patch.object(splocked, "_flock", new=sneak_in):
+            first.add(u"d", 4)
+        assert first.lock_generation() != gen
+
+    assert second.get() == {u"a": 1, u"c": 3, u"d": 4}
+
+
+@utils.with_tempdir
+def test_per_file_locks(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that threads only contend for the same file."""
+    tempf = tempd / "first.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    otherf = tempd / "second.json"
+    otherf.write_text(u"{}", encoding="UTF-8")
+
+    assert splocked.path_lock(str(tempf)) is splocked.path_lock(
+        str(tempd / "." / "first.json")
+    )
+    assert splocked.path_lock(str(tempf)) is not splocked.path_lock(
+        str(otherf)
+    )
+
+    first = splocked.SPLockedFile(str(tempf))
+    same = splocked.SPLockedFile(str(tempf))
+    other = splocked.SPLockedFile(str(otherf))
+    results = []  # type: List[bool]
+
+    def try_both():
+        # type: () -> None
+        """Try to lock both files from another thread."""
+        results.append(same.try_lock())
+        results.append(other.try_lock())
+        other.release()
+
+    with first:
+        thr = threading.Thread(target=try_both)
+        thr.start()
+        thr.join()
+
+    assert results == [False, True]
+
+
+@utils.with_tempdir
+def test_large_file(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test reading and writing a file in many chunks."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    data = {u"key-{idx}".format(idx=idx): [idx] * 10 for idx in range(5000)}
+
+    real_write = os.write
+    writes = []  # type: List[int]
+
+    def short_write(fd, contents):
+        # type: (int, memoryview) -> int
+        """Only write out a small part of the buffer."""
+        writes.append(len(contents))
+        return real_write(fd, contents[:4096])
+
+    locked = splocked.SPLockedFile(str(tempf))
+    with mock.patch("os.write", new=short_write):
+        locked.jsdump(data)
+    size = tempf.stat().st_size
+    assert size > 4096 * 10
+    assert len(writes) == (size + 4095) // 4096
+    assert writes[0] == size
+    assert writes[-1] == size % 4096 or writes[-1] == 4096
+
+    assert json.loads(tempf.read_text(encoding="UTF-8")) == data
+    assert locked.jsload() == data
+
+
+@utils.with_tempdir
+def test_journal(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the append-only SPJournalJSONDB storage format."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u'{"a": 1}', encoding="UTF-8")
+    fname = str(tempf.absolute())
+
+    writer = splocked.SPJournalJSONDB(fname, compact_min=200)
+    reader = splocked.SPJournalJSONDB(fname, compact_min=200)
+    assert writer.get() == {u"a": 1}
+
+    # The first write converts a plain JSON file into a snapshot.
+    writer.add(u"b", 2)
+    lines = tempf.read_bytes().split(b"\n")
+    assert lines[0] == splocked.JOURNAL_MAGIC + b"0000000000000001"
+    assert json.loads(lines[1].decode("UTF-8")) == {u"a": 1, u"b": 2}
+    assert lines[2:] == [b""]
+    assert reader.get() == {u"a": 1, u"b": 2}
+
+    # Further writes only append records...
+    writer.add(u"c", 3)
+    writer.remove_keys([u"a", u"x"])
+    lines = tempf.read_bytes().split(b"\n")
+    assert len(lines) == 5
+    assert json.loads(lines[2].decode("UTF-8")) == {u"set": {u"c": 3}}
+    assert json.loads(lines[3].decode("UTF-8")) == {u"del": [u"a"]}
+
+    # ...which the other instance picks up incrementally.
+    with mock.patch.object(reader, "_load_all") as load_all:
+        assert reader.get() == {u"b": 2, u"c": 3}
+        assert not load_all.called
+
+    # A partially written record is ignored and then overwritten.
+    with tempf.open(mode="ab") as tempf_obj:
+        tempf_obj.write(b'{"set": {"d"')
+    assert reader.get() == {u"b": 2, u"c": 3}
+    reader.add(u"d", 4)
+    assert writer.get() == {u"b": 2, u"c": 3, u"d": 4}
+    assert json.loads(tempf.read_bytes().split(b"\n")[4].decode("UTF-8")) == {
+        u"set": {u"d": 4}
+    }
+
+    # Enough records trigger a compaction into a new generation.
+    for idx in range(20):
+        writer.add(u"key-{idx}".format(idx=idx), idx)
+    lines = tempf.read_bytes().split(b"\n")
+    assert lines[0] > splocked.JOURNAL_MAGIC + b"0000000000000001"
+    assert len(lines) < 20
+    expected = {u"key-{idx}".format(idx=idx): idx for idx in range(20)}
+    expected.update({u"b": 2, u"c": 3, u"d": 4})
+    assert reader.get() == expected
+
+    writer.compact()
+    lines = tempf.read_bytes().split(b"\n")
+    assert lines[0].startswith(splocked.JOURNAL_MAGIC)
+    assert json.loads(lines[1].decode("UTF-8")) == expected
+    assert lines[2:] == [b""]
+    assert reader.get() == expected
+
+
+@utils.with_tempdir
+def test_transaction(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test grouping several changes into a single write."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u'{"a": 1}', encoding="UTF-8")
+
+    jdb = splocked.SPLockedJSONDB(str(tempf))
+    other = splocked.SPLockedJSONDB(str(tempf), timeout=0.01)
+
+    with mock.patch.object(jdb, "jsdump", wraps=jdb.jsdump) as jsdump:
+        with jdb.transaction():
+            jdb.add(u"b", 2)
+            jdb.add_many({u"c": 3, u"d": 4})
+            with jdb.transaction():
+                jdb.remove(u"a")
+                jdb.update_many({u"a": 5, u"e": 6}, [u"d"])
+            assert jdb.get() == {u"a": 5, u"b": 2, u"c": 3, u"e": 6}
+            assert json.loads(tempf.read_text(encoding="UTF-8")) == {u"a": 1}
+            assert not jsdump.called
+            assert not other.try_lock(shared=True)
+        assert jsdump.call_count == 1
+
+        expected = {u"a": 5, u"b": 2, u"c": 3, u"e": 6}
+        assert json.loads(tempf.read_text(encoding="UTF-8")) == expected
+        assert other.get() == expected
+
+        # Nothing changed, nothing to write.
+        with jdb.transaction():
+            jdb.remove_keys([u"x", u"y"])
+            assert jdb.get() == expected
+        assert jsdump.call_count == 1
+
+        # An exception discards the changes.
+        with pytest.raises(RuntimeError):
+            with jdb.transaction():
+                jdb.add(u"f", 7)
+                raise RuntimeError("oof")
+        assert jsdump.call_count == 1
+        assert jdb.get() == expected
+
+    # Journal files get a single record.
+    jnl = splocked.SPJournalJSONDB(str(tempf))
+    jnl.compact()
+    with jnl.transaction():
+        jnl.remove(u"a")
+        jnl.add_many({u"a": 8, u"z": 26})
+        jnl.remove_keys([u"b", u"c"])
+    lines = tempf.read_bytes().split(b"\n")
+    assert len(lines) == 4
+    assert json.loads(lines[2].decode("UTF-8")) == {
+        u"set": {u"a": 8, u"z": 26},
+        u"del": [u"b", u"c"],
+    }
+    assert splocked.SPJournalJSONDB(str(tempf)).get() == {
+        u"a": 8,
+        u"e": 6,
+        u"z": 26,
+    }
+
+
+@utils.with_tempdir
+def test_group_commit(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that concurrent changes are written out together."""
+    # pylint: disable=protected-access
+    tempf = tempd / "db.json"
+    tempf.write_text(u'{"a": 1}', encoding="UTF-8")
+    jdb = splocked.SPLockedJSONDB(str(tempf), group_commit=True)
+    errors = []  # type: List[Exception]
+
+    def add_key(idx):
+        # type: (int) -> None
+        """Add a key from another thread."""
+        try:
+            jdb.add(u"key-{idx}".format(idx=idx), idx)
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+
+    def remove_key(idx):
+        # type: (int) -> None
+        """Remove a key from another thread."""
+        try:
+            jdb.remove(u"key-{idx}".format(idx=idx))
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+
+    def run_batch(func):
+        # type: (Callable[[int], None]) -> None
+        """Queue some changes while holding the lock, then let them go."""
+        with jdb:
+            threads = [
+                threading.Thread(target=func, args=(idx,)) for idx in range(10)
+            ]
+            for thr in threads:
+                thr.start()
+            for _ in range(1000):
+                with jdb._group_cond:
+                    if len(jdb._group_queue) == len(threads):
+                        break
+                time.sleep(0.01)
+            assert len(jdb._group_queue) == len(threads)
+
+        for thr in threads:
+            thr.join()
+        assert not errors
+
+    with mock.patch.object(jdb, "jsdump", wraps=jdb.jsdump) as jsdump:
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            with jdb:
+                # Changes made while holding the lock are applied at once.
+                jdb.add(u"b", 2)
+                assert jsdump.call_count == 1
+
+            run_batch(add_key)
+            assert jsdump.call_count == 2
+            assert fsync.call_count == 1
+
+            expected = {u"key-{idx}".format(idx=idx): idx for idx in range(10)}
+            expected.update({u"a": 1, u"b": 2})
+            assert json.loads(tempf.read_text(encoding="UTF-8")) == expected
+
+            run_batch(remove_key)
+            assert jsdump.call_count == 3
+            assert fsync.call_count == 2
+
+    assert json.loads(tempf.read_text(encoding="UTF-8")) == {u"a": 1, u"b": 2}
+
+    # Errors are reported to all the waiting threads.
+    with mock.patch.object(jdb, "_store", side_effect=OSError("oof")):
+        add_key(42)
+    assert len(errors) == 1
+    assert str(errors[0]) == "oof"
+    assert not jdb._group_queue
+    assert not jdb._group_leader
+
+
+@utils.with_tempdir
+def test_sharded(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that an SPShardedJSONDB object only locks the shards it needs."""
+    # pylint: disable=protected-access
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    tempf.chmod(0o640)
+    sdb = splocked.SPShardedJSONDB(str(tempf), shards=4, timeout=0.05)
+    assert not sdb.get()
+    for idx in range(4):
+        shard_f = tempd / "attach.json.{idx}".format(idx=idx)
+        assert json.loads(shard_f.read_text(encoding="UTF-8")) == {}
+        assert shard_f.stat().st_mode & 0o777 == 0o640
+
+    keys = [u"req-{idx}".format(idx=idx) for idx in range(20)]
+    sdb.add_many({key: {u"id": key} for key in keys})
+    assert sdb.get() == {key: {u"id": key} for key in keys}
+
+    by_shard = {}  # type: Dict[int, List[Text]]
+    for idx in range(4):
+        shard_f = tempd / "attach.json.{idx}".format(idx=idx)
+        by_shard[idx] = sorted(json.loads(shard_f.read_text(encoding="UTF-8")))
+        for key in by_shard[idx]:
+            assert splocked._shard_index(key, 4) == idx
+    assert sorted(sum(by_shard.values(), [])) == sorted(keys)
+    busy, idle = [idx for idx in range(4) if by_shard[idx]][:2]
+
+    # Somebody else holds a lock on one of the shards.
+    other = splocked.SPLockedJSONDB(
+        str(tempd / "attach.json.{idx}".format(idx=busy))
+    )
+    with other:
+        sdb.remove(by_shard[idle][0])
+        sdb.add(by_shard[idle][0], 42)
+        missing = [
+            key
+            for key in (u"missing-{idx}".format(idx=idx) for idx in range(20))
+            if splocked._shard_index(key, 4) != busy
+        ]
+        sdb.remove_keys(missing)
+        with pytest.raises(splocked.SPLockedFileError):
+            sdb.remove(by_shard[busy][0])
+        with pytest.raises(splocked.SPLockedFileError):
+            sdb.get()
+        assert not sdb.try_lock(shared=True)
+    assert sdb.get()[by_shard[idle][0]] == 42
+
+    # Upgrade the shared locks while somebody else reads another shard.
+    with sdb.shared():
+        gen = sdb.lock_generation()
+        with pytest.raises(splocked.SPLockedFileError):
+            with other.shared():
+                sdb.remove_keys(by_shard[busy] + by_shard[idle])
+        assert sdb.lock_generation() == gen
+        sdb.remove_keys(by_shard[busy] + by_shard[idle])
+        assert sdb.lock_generation() == gen
+        assert not set(sdb.get()) & set(by_shard[busy] + by_shard[idle])
+
+    with pytest.raises(RuntimeError):
+        with sdb.transaction():
+            sdb.add(u"txn", 1)
+            raise RuntimeError("oops")
+    with sdb.transaction():
+        sdb.add(u"txn", 2)
+        sdb.remove(keys[-1])
+        assert not other.try_lock(shared=True)
+    res = splocked.SPShardedJSONDB(str(tempf), shards=4).get()
+    assert res[u"txn"] == 2
+    assert keys[-1] not in res
+
+
+@utils.with_tempdir
+def test_lock_stats(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the lock contention and hold time statistics."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    before = splocked.stats()
+
+    first = splocked.SPLockedJSONDB(str(tempf), timeout=0.05)
+    second = splocked.SPLockedJSONDB(str(tempf), timeout=0.05)
+    with second:
+        with pytest.raises(splocked.SPLockedFileError):
+            first.acquire()
+        time.sleep(0.01)
+
+    with first.shared():
+        with first:
+            pass
+    first.add(u"a", 1)
+
+    res = first.stats()
+    assert res["acquired"] == 3
+    assert res["failed"] == 1
+    assert res["retries"] > 0
+    assert res["wait_max"] >= 0.05
+    assert sum(res["wait_hist"]) == 4
+    assert sum(res["hold_hist"]) == 2
+    assert len(res["wait_hist"]) == len(splocked.STATS_BUCKETS) + 1
+
+    res = second.stats()
+    assert (res["acquired"], res["failed"], res["retries"]) == (1, 0, 0)
+    assert res["hold_max"] >= 0.06
+    assert res["hold_max"] == res["hold_total"]
+    assert sum(res["hold_hist"][:6]) == 0
+    assert "test_splocked.py" in res["hold_max_site"]
+    assert res["hold_max_site"].endswith(" in test_lock_stats")
+
+    after = splocked.stats()
+    assert after["acquired"] - before["acquired"] == 4
+    assert after["failed"] - before["failed"] == 1
+    assert after["hold_max"] >= res["hold_max"]
+
+
+@utils.with_tempdir
+def test_persistent(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test keeping the file open between the times it is locked."""
+    # pylint: disable=protected-access
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    def open_fds():
+        # type: () -> int
+        """Count the file descriptors open in this process."""
+        return len(os.listdir("/proc/self/fd"))
+
+    jdb = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, persistent=True)
+    other = splocked.SPLockedJSONDB(str(tempf), timeout=0.05)
+    assert jdb.get() == {}
+    pfd = jdb._pfd
+    assert pfd is not None
+    count = open_fds()
+
+    jdb.add(u"a", 1)
+    other.add(u"b", 2)
+    assert jdb.get() == {u"a": 1, u"b": 2}
+    assert jdb._pfd == pfd
+    assert open_fds() == count
+
+    with other.shared():
+        assert jdb.try_lock(shared=True)
+        jdb.release()
+        assert not jdb.try_lock()
+    with jdb:
+        assert not other.try_lock(shared=True)
+
+    # Replace the file; the new one should be opened and locked.
+    newf = tempd / "attach.json.new"
+    newf.write_text(u'{"c": 3}', encoding="UTF-8")
+    os.rename(str(newf), str(tempf))
+    assert jdb.get() == {u"c": 3}
+    assert open_fds() == count
+    with jdb:
+        assert not other.try_lock(shared=True)
+
+    # A child process should not share the parent's lock.
+    with mock.patch("os.getpid", new=lambda: -42):
+        with jdb:
+            assert jdb._pfd_pid == -42
+    with jdb:
+        assert jdb._pfd_pid == os.getpid()
+    assert open_fds() == count
+
+    jdb.close()
+    assert jdb._pfd is None
+    assert open_fds() == count - 1
+    tempf.unlink()
+    with pytest.raises(OSError):
+        jdb.get()
+
+
+@utils.with_tempdir
+def test_persistent_atomic(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test upgrading a lock after the lock file was replaced."""
+    # pylint: disable=protected-access
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    lockf = tempd / "attach.json.lock"
+
+    jdb = splocked.SPLockedJSONDB(
+        str(tempf), timeout=0.05, persistent=True, atomic=True
+    )
+    jdb.add(u"a", 1)
+    pfd = jdb._pfd
+    assert pfd is not None
+
+    for replace in (True, False):
+        if replace:
+            newf = tempd / "attach.json.lock.new"
+            newf.write_text(u"", encoding="UTF-8")
+            os.rename(str(newf), str(lockf))
+        else:
+            lockf.unlink()
+        with jdb.shared():
+            assert jdb.get()[u"a"] == 1
+            jdb.add(u"b", 2)
+            assert jdb._pfd is not None
+            assert os.fstat(jdb._pfd).st_ino == lockf.stat().st_ino
+        jdb.remove(u"b")
+    assert jdb.get() == {u"a": 1}
+    jdb.close()
+
+
+@utils.with_tempdir
+def test_snapshot(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the read-only snapshots of the JSON databases."""
+    # pylint: disable=protected-access
+    tempf = tempd / "attach.json"
+    for factory in (
+        splocked.SPLockedJSONDB,
+        splocked.SPJournalJSONDB,
+        lambda fname: splocked.SPShardedJSONDB(fname, shards=3),
+    ):  # type: Callable[[str], Any]
+        db = factory(str(tempf))
+        tempf.write_text(u"{}", encoding="UTF-8")
+        for idx in range(3):
+            shard_f = tempd / "attach.json.{idx}".format(idx=idx)
+            shard_f.write_text(u"{}", encoding="UTF-8")
+
+        db.add_many({u"a": {u"vol": u"a", u"ids": [1, 2]}, u"b": 2})
+        snap = db.snapshot()
+        assert snap == {u"a": {u"vol": u"a", u"ids": (1, 2)}, u"b": 2}
+        assert db.snapshot() is snap
+        with pytest.raises(TypeError):
+            snap[u"c"] = 3  # type: ignore
+        with pytest.raises(TypeError):
+            snap[u"a"][u"vol"] = u"c"
+        assert splocked.thaw(snap) == db.get()
+
+        # Nothing changed, and nobody else wrote anything.
+        db.update_many({}, [u"missing"])
+        assert db.snapshot() is snap
+
+        db.add(u"c", [3])
+        new = db.snapshot()
+        assert new.generation > snap.generation
+        assert new[u"a"] is snap[u"a"]
+        assert new[u"c"] == (3,)
+        assert u"c" not in snap
+
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.remove(u"a")
+                raise RuntimeError("oops")
+        assert db.snapshot() == new
+
+        # Somebody else modified the file.
+        other = factory(str(tempf))
+        other.remove(u"b")
+        assert sorted(db.snapshot()) == [u"a", u"c"]
+        assert db.snapshot().generation > new.generation
+
+
+@utils.with_tempdir
+def test_decoded_cache(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Make sure the objects for the same file share the snapshots."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u'{"a": {"id": 1}}', encoding="UTF-8")
+    first = splocked.SPLockedJSONDB(str(tempf))
+    second = splocked.SPLockedJSONDB(str(tempf))
+
+    with mock.patch.object(
+        splocked, "DECODED_CACHE", new=splocked.SPDecodedCache(1024)
+    ) as cache:
+        snap = first.snapshot()
+        assert snap == {u"a": {u"id": 1}}
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert second.snapshot() is snap
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # The get() results are not shared...
+        assert second.get() is not first.get()
+        assert second.get()[u"a"] is not first.get()[u"a"]
+
+        # ...so modifying a record in place does not affect anybody else.
+        first.get()[u"a"][u"id"] = 42
+        third = splocked.SPLockedJSONDB(str(tempf))
+        assert third.get() == {u"a": {u"id": 1}}
+        assert third.snapshot() is snap
+        assert (cache.hits, cache.misses) == (2, 1)
+        first.get()[u"a"][u"id"] = 1
+
+        # The writer does not share the snapshot of the data it modified.
+        second.add(u"b", 2)
+        new = second.snapshot()
+        assert new == {u"a": {u"id": 1}, u"b": 2}
+        assert new.generation > snap.generation
+        assert (cache.hits, cache.misses) == (2, 2)
+        assert first.snapshot() == new
+        assert (cache.hits, cache.misses) == (2, 3)
+        assert third.snapshot() is first.snapshot()
+        assert (cache.hits, cache.misses) == (4, 3)
+
+        # Somebody else wrote to the file.
+        tempf.write_text(u'{"c": 3}', encoding="UTF-8")
+        assert first.snapshot() == {u"c": 3}
+        assert second.snapshot() == {u"c": 3}
+        assert (cache.hits, cache.misses) == (5, 4)
+
+        # A disabled cache is not even consulted.
+        cache.max_bytes = 0
+        cache.clear()
+        tempf.write_text(u'{"d": 4}', encoding="UTF-8")
+        assert first.snapshot() == {u"d": 4}
+        assert second.snapshot() == {u"d": 4}
+        assert second.snapshot() is not first.snapshot()
+        assert (cache.hits, cache.misses) == (5, 4)
+
+
+@utils.with_tempdir
+def test_atomic(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the atomic-replace mode and the lock-free readers."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    tempf.chmod(0o640)
+    reader = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, atomic=True)
+    writer = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, atomic=True)
+
+    assert reader.get() == {}
+    assert not (tempd / "attach.json.lock").exists()
+    ino = tempf.stat().st_ino
+    writer.add(u"a", 1)
+    assert tempf.stat().st_ino != ino
+    assert tempf.stat().st_mode & 0o777 == 0o640
+    assert (tempd / "attach.json.lock").stat().st_mode & 0o777 == 0o640
+    assert sorted(path.name for path in tempd.iterdir()) == [
+        "attach.json",
+        "attach.json.lock",
+    ]
+    assert reader.get() == {u"a": 1}
+
+    # The new file and the directory entry are both written out.
+    real_fsync = os.fsync
+    synced = []  # type: List[int]
+
+    def record_fsync(fd):
+        # type: (int) -> None
+        """Note what kind of file is synced."""
+        synced.append(stat.S_IFMT(os.fstat(fd).st_mode))
+        real_fsync(fd)
+
+    with mock.patch("os.fsync", new=record_fsync):
+        writer.add(u"x", 0)
+        writer.remove(u"x")
+    assert synced == [stat.S_IFREG, stat.S_IFDIR] * 2
+
+    # A shared lock keeps the same version of the file.
+    with reader.shared():
+        gen = reader.lock_generation()
+        assert reader.get() == {u"a": 1}
+        writer.add(u"b", 2)
+        assert reader.get() == {u"a": 1}
+
+        # Upgrading the lock brings the latest version in.
+        reader.add(u"c", 3)
+        assert reader.lock_generation() != gen
+    assert writer.get() == {u"a": 1, u"b": 2, u"c": 3}
+
+    # Another process is writing; the readers do not need to wait.
+    fd = os.open(str(tempd / "attach.json.lock"), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        assert reader.get() == {u"a": 1, u"b": 2, u"c": 3}
+        with pytest.raises(splocked.SPLockedFileError):
+            writer.remove(u"a")
+        with pytest.raises(splocked.SPLockedFileError):
+            with reader.shared():
+                reader.add(u"d", 4)
+    finally:
+        os.close(fd)
+    assert splocked.SPLockedJSONDB(str(tempf)).get() == {
+        u"a": 1,
+        u"b": 2,
+        u"c": 3,
+    }
+
+
+@utils.with_tempdir
+def test_atomic_owner(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test that the new versions keep the owner and group of the file."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+    st = tempf.stat()
+    calls = []  # type: List[Any]
+
+    def no_give_away(fd, uid, gid):
+        # type: (int, int, int) -> None
+        """Only let the group be set, like for an unprivileged user."""
+        calls.append(
+            (
+                os.path.basename(
+                    os.readlink("/proc/self/fd/{fd}".format(fd=fd))
+                ),
+                uid,
+                gid,
+            )
+        )
+        if uid != -1:
+            raise OSError(errno.EPERM, "Operation not permitted")
+
+    writer = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, atomic=True)
+    with mock.patch("os.fchown", new=no_give_away):
+        writer.add(u"a", 1)
+    assert [
+        (name.split(".tmp.")[0], uid, gid) for name, uid, gid in calls
+    ] == [
+        ("attach.json.lock", st.st_uid, st.st_gid),
+        ("attach.json.lock", -1, st.st_gid),
+        ("attach.json", st.st_uid, st.st_gid),
+        ("attach.json", -1, st.st_gid),
+    ]
+    assert writer.get() == {u"a": 1}
+
+    # The group must be kept, though.
+    os.unlink(str(tempd / "attach.json.lock"))
+    writer = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, atomic=True)
+    with mock.patch(
+        "os.fchown",
+        side_effect=OSError(errno.EPERM, "Operation not permitted"),
+    ):
+        with pytest.raises(OSError):
+            writer.add(u"b", 2)
+    assert sorted(path.name for path in tempd.iterdir()) == ["attach.json"]
+
+    if os.geteuid() != 0:
+        return
+    os.chown(str(tempf), 4242, 4343)
+    writer = splocked.SPLockedJSONDB(str(tempf), timeout=0.05, atomic=True)
+    writer.add(u"b", 2)
+    for path in (tempf, tempd / "attach.json.lock"):
+        assert (path.stat().st_uid, path.stat().st_gid) == (4242, 4343)
+    assert writer.get() == {u"a": 1, u"b": 2}
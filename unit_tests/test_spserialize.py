@@ -0,0 +1,117 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test the storpool.spopenstack.spserialize module."""
+
+import json
+import sys
+
+import pytest
+
+from . import utils
+from .mock_storpool import spapi, spconfig
+
+sys.modules["storpool.spapi"] = spapi
+sys.modules["storpool.spconfig"] = spconfig
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from storpool.spopenstack import splocked  # noqa: E402
+from storpool.spopenstack import spserialize  # noqa: E402
+
+
+DATA = {
+    u"a": {u"id": u"a", u"volume": u"os--volume-a", u"rights": 2},
+    u"b": {u"id": u"b", u"volsnap": True, u"ids": [1, 2.5, None]},
+    u"\u0444": u"\u0444\n",
+}
+
+
+def test_roundtrip():
+    # type: () -> None
+    """Encode and decode some data using all the available serializers."""
+    assert spserialize.get_serializer("json") is spserialize.JSON
+    assert spserialize.get_serializer("marshal") is spserialize.MARSHAL
+    assert spserialize.get_serializer("auto").is_json
+    with pytest.raises(ValueError):
+        spserialize.get_serializer("pickle")
+
+    for ser in spserialize.SERIALIZERS.values():
+        encoded = ser.dumps(DATA)
+        assert isinstance(encoded, bytes)
+        assert ser.loads(encoded) == DATA
+        assert ser.loads(bytearray(encoded)) == DATA
+        assert spserialize.detect(encoded, spserialize.JSON, [ser]) is (
+            ser if ser.magic else spserialize.JSON
+        )
+        assert spserialize.detect(encoded, ser) is (
+            ser if ser.magic or ser.is_json else spserialize.fastest_json()
+        )
+
+        if ser.is_json:
+            assert b"\n" not in encoded
+            assert json.loads(encoded.decode("UTF-8")) == DATA
+        else:
+            assert encoded.startswith(ser.magic)
+
+    encoded = spserialize.MARSHAL.dumps(DATA)
+    assert spserialize.detect(b"{}", spserialize.MARSHAL).is_json
+
+    # Only the readers that expect it may parse the marshal format.
+    for default in (None, spserialize.JSON, spserialize.fastest_json()):
+        with pytest.raises(ValueError):
+            spserialize.detect(encoded, default)
+        assert (
+            spserialize.detect(encoded, default, [spserialize.MARSHAL])
+            is spserialize.MARSHAL
+        )
+
+
+@utils.with_tempdir
+def test_locked_db(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Switch a database file between formats."""
+    tempf = tempd / "db.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    marshal_db = splocked.SPLockedJSONDB(
+        str(tempf), serializer=spserialize.MARSHAL
+    )
+    json_db = splocked.SPLockedJSONDB(
+        str(tempf), allowed=[spserialize.MARSHAL]
+    )
+
+    marshal_db.add_many(DATA)
+    assert tempf.read_bytes().startswith(spserialize.MARSHAL.magic)
+    with pytest.raises(ValueError):
+        splocked.SPLockedJSONDB(str(tempf)).get()
+    with pytest.raises(ValueError):
+        splocked.SPJournalJSONDB(str(tempf)).get()
+    assert json_db.get() == DATA
+
+    json_db.remove(u"a")
+    assert json.loads(tempf.read_text(encoding="UTF-8")) == {
+        key: value for key, value in DATA.items() if key != u"a"
+    }
+    assert marshal_db.get() == json_db.get()
+
+    with pytest.raises(ValueError):
+        splocked.SPJournalJSONDB(str(tempf), serializer=spserialize.MARSHAL)
+
+    fast_db = splocked.SPJournalJSONDB(
+        str(tempf), serializer=spserialize.fastest_json()
+    )
+    fast_db.add(u"c", 3)
+    assert splocked.SPJournalJSONDB(str(tempf)).get()[u"c"] == 3
@@ -0,0 +1,191 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test the storpool.spopenstack.spsqlitedb module."""
+
+import sqlite3
+import sys
+
+import pytest
+
+from . import utils
+from .mock_storpool import spapi, spconfig
+
+sys.modules["storpool.spapi"] = spapi
+sys.modules["storpool.spconfig"] = spconfig
+
+# pylint: disable=wrong-import-position,wrong-import-order
+if sys.version_info[0] < 3:
+    import mock  # pylint: disable=import-error
+else:
+    from unittest import mock
+
+from storpool.spopenstack import splocked  # noqa: E402
+from storpool.spopenstack import spsqlitedb  # noqa: E402
+
+try:
+    from typing import Any  # noqa: E402
+except ImportError:
+    pass
+
+
+@utils.with_tempdir
+def test_simple(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Store some values, read them back from another connection."""
+    fname = str(tempd / "attach.sqlite")
+    first = spsqlitedb.SPLockedSQLiteDB(fname)
+    second = spsqlitedb.SPLockedSQLiteDB(fname)
+    assert first.get() == {}
+
+    first.add(u"a", {u"volume": u"os--volume-a", u"rights": 2})
+    first.add_many({u"b": [1, 2], u"c": None})
+    assert second.get() == {
+        u"a": {u"volume": u"os--volume-a", u"rights": 2},
+        u"b": [1, 2],
+        u"c": None,
+    }
+    assert second.lookup(u"b") == [1, 2]
+    assert second.lookup(u"d", 42) == 42
+
+    second.remove(u"a")
+    second.remove_keys([u"x", u"y"])
+    second.update_many({u"d": u"\u0444"}, [u"b"])
+    assert sorted(first.get().items()) == [(u"c", None), (u"d", u"\u0444")]
+
+    first.close()
+    second.close()
+
+
+@utils.with_tempdir
+def test_locking(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Readers do not block each other, writers wait for writers."""
+    fname = str(tempd / "attach.sqlite")
+    first = spsqlitedb.SPLockedSQLiteDB(fname, timeout=0.05)
+    second = spsqlitedb.SPLockedSQLiteDB(fname)
+    first.add(u"a", 1)
+
+    with first.shared():
+        gen = first.lock_generation()
+        second.add(u"b", 2)
+        assert first.get() == {u"a": 1}
+
+        with first:
+            assert first.lock_generation() != gen
+            assert first.get() == {u"a": 1, u"b": 2}
+            assert not second.try_lock()
+            assert second.try_lock(shared=True)
+            second.release()
+
+    # Nobody else modified the database while the lock was upgraded.
+    with first.shared():
+        gen = first.lock_generation()
+        with first:
+            assert first.lock_generation() == gen
+
+    with second:
+        with pytest.raises(splocked.SPLockedFileError):
+            first.acquire()
+        with pytest.raises(splocked.SPLockedFileError):
+            with first.shared():
+                with first:
+                    pass
+    assert first.try_lock()
+    first.release()
+
+    res = first.stats()
+    assert res["failed"] == 2
+    assert res["retries"] == 0
+    assert res["wait_max"] >= 0.04
+    assert res["acquired"] + res["failed"] == sum(res["wait_hist"])
+    assert res["hold_max_site"].endswith(" in test_locking")
+
+
+@utils.with_tempdir
+def test_errors(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Only report the database being in use as a lock timeout."""
+    # pylint: disable=protected-access
+    fname = str(tempd / "attach.sqlite")
+    db = spsqlitedb.SPLockedSQLiteDB(fname, timeout=0.05)
+    assert db.get() == {}
+
+    real_conn = db._connect()
+    for (message, expected) in (
+        ("database is locked", splocked.SPLockedFileError),
+        ("disk I/O error", sqlite3.OperationalError),
+        ("attempt to write a readonly database", sqlite3.OperationalError),
+    ):
+        conn = mock.Mock(spec=["execute"])
+
+        def execute(query, message=message):
+            # type: (str, str) -> Any
+            """Fail to start a transaction."""
+            if query.startswith("BEGIN"):
+                raise sqlite3.OperationalError(message)
+            return real_conn.execute(query)
+
+        conn.execute = execute
+        db._conn = conn  # type: ignore
+        with pytest.raises(expected):
+            with db:
+                pass
+        assert db._count == 0
+
+    db._conn = real_conn
+    db.add(u"a", 1)
+    assert db.get() == {u"a": 1}
+
+
+@utils.with_tempdir
+def test_rollback(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """An exception in a transaction discards all its changes."""
+    fname = str(tempd / "attach.sqlite")
+    sdb = spsqlitedb.SPLockedSQLiteDB(fname)
+    sdb.add(u"a", 1)
+
+    with pytest.raises(RuntimeError):
+        with sdb.transaction():
+            sdb.add(u"b", 2)
+            sdb.remove(u"a")
+            assert sdb.get() == {u"b": 2}
+            raise RuntimeError("oops")
+
+    assert sdb.get() == {u"a": 1}
+    assert spsqlitedb.SPLockedSQLiteDB(fname).get() == {u"a": 1}
+
+
+@utils.with_tempdir
+def test_snapshot(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the read-only snapshots of the database."""
+    fname = str(tempd / "attach.sqlite")
+    sdb = spsqlitedb.SPLockedSQLiteDB(fname)
+    sdb.add_many({u"a": {u"ids": [1]}, u"b": 2})
+    snap = sdb.snapshot()
+    assert snap == {u"a": {u"ids": (1,)}, u"b": 2}
+    assert sdb.snapshot() is snap
+
+    sdb.add(u"c", 3)
+    new = sdb.snapshot()
+    assert new.generation > snap.generation
+    assert new[u"a"] is snap[u"a"]
+    assert u"c" not in snap
+
+    spsqlitedb.SPLockedSQLiteDB(fname).remove(u"a")
+    assert sdb.snapshot() == {u"b": 2, u"c": 3}
@@ -0,0 +1,187 @@
+#
+# Copyright (c) 2022  StorPool.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Test the storpool.spopenstack.spwatch module."""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from . import utils
+from .mock_storpool import spapi, spconfig
+
+sys.modules["storpool.spapi"] = spapi
+sys.modules["storpool.spconfig"] = spconfig
+
+# pylint: disable=wrong-import-position,wrong-import-order
+if sys.version_info[0] < 3:
+    import mock  # pylint: disable=import-error
+else:
+    from unittest import mock
+
+from storpool.spopenstack import splocked  # noqa: E402
+from storpool.spopenstack import spwatch  # noqa: E402
+
+
+@utils.with_tempdir
+def test_stat(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the stat(2)-based change detection."""
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    watch = spwatch.watcher(str(tempf))
+    assert isinstance(watch, spwatch.SPStatWatcher)
+    assert watch.changed()
+    watch.mark(False)
+    assert not watch.changed()
+
+    tempf.write_text(u"{ }", encoding="UTF-8")
+    assert watch.changed()
+    watch.mark(False)
+    assert not watch.changed()
+
+    # Same size, maybe within the same clock tick, but in this process.
+    other = spwatch.watcher(str(tempf))
+    tempf.write_text(u"{}  ", encoding="UTF-8")
+    other.mark(True)
+    assert watch.changed()
+
+    tempf.unlink()
+    assert watch.changed()
+    other.mark(False)
+    assert other.changed()
+
+
+@utils.with_tempdir
+def test_inotify(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Test the inotify(7)-based change detection."""
+    inotify = spwatch.get_inotify()
+    if inotify is None:
+        pytest.skip("inotify(7) is not available")
+
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    watch = spwatch.watcher(str(tempf), inotify=True)
+    assert isinstance(watch, spwatch.SPInotifyWatcher)
+    assert watch.changed()
+    watch.mark(False)
+    assert not watch.changed()
+
+    # Same size, no stat(2) involved.
+    tempf.write_text(u"[]", encoding="UTF-8")
+    assert watch.changed()
+    assert watch.changed()
+    watch.mark(False)
+    assert not watch.changed()
+
+    # Replace the file, then modify the new one.
+    newf = tempd / "attach.json.new"
+    newf.write_text(u"{}", encoding="UTF-8")
+    os.rename(str(newf), str(tempf))
+    assert watch.changed()
+    watch.mark(False)
+    assert not watch.changed()
+    tempf.write_text(u"[]", encoding="UTF-8")
+    assert watch.changed()
+    watch.mark(False)
+
+    # After a fork, nothing is known about anything.
+    with mock.patch("os.getpid", new=lambda: -42):
+        assert watch.changed()
+        watch.mark(False)
+        assert not watch.changed()
+    assert watch.changed()
+    watch.mark(False)
+
+    tempf.unlink()
+    assert watch.changed()
+    watch.mark(False)
+    assert watch.changed()
+
+
+@utils.with_tempdir
+def test_dir_watcher(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Wait for something to show up in a directory."""
+    if spwatch.get_inotify() is None:
+        pytest.skip("inotify(7) is not available")
+
+    assert spwatch.dir_watcher(str(tempd / "nonexistent")) is None
+
+    watch = spwatch.dir_watcher(str(tempd))
+    assert watch is not None
+    try:
+        assert not watch.wait(0.01)
+        assert not watch.drain()
+
+        def create():
+            # type: () -> None
+            """Create a file a bit later."""
+            time.sleep(0.05)
+            (tempd / "sp-0").write_text(u"", encoding="UTF-8")
+
+        thr = threading.Thread(target=create)
+        thr.start()
+        try:
+            assert watch.wait(5)
+        finally:
+            thr.join()
+        assert not watch.drain()
+
+        os.rename(str(tempd / "sp-0"), str(tempd / "sp-1"))
+        assert watch.drain()
+    finally:
+        watch.close()
+    assert watch.fileno() == -1
+
+
+@utils.with_tempdir
+def test_locked_db(tempd):
+    # type: (utils.pathlib.Path) -> None
+    """Only look at the file once while holding the lock."""
+    # pylint: disable=protected-access
+    tempf = tempd / "attach.json"
+    tempf.write_text(u"{}", encoding="UTF-8")
+
+    for inotify in (False, True):
+        jdb = splocked.SPLockedJSONDB(str(tempf), inotify=inotify)
+        other = splocked.SPLockedJSONDB(str(tempf), inotify=inotify)
+        assert jdb.get() == {}
+        other.add(u"a", 1)
+        assert jdb.get() == {u"a": 1}
+
+        with mock.patch.object(
+            jdb._watch, "changed", wraps=jdb._watch.changed
+        ) as changed:
+            with jdb.shared():
+                for _ in range(5):
+                    assert jdb.get() == {u"a": 1}
+                with jdb:
+                    jdb.add(u"b", 2)
+                    assert jdb.get() == {u"a": 1, u"b": 2}
+            assert changed.call_count == 2
+
+            assert other.get() == {u"a": 1, u"b": 2}
+            other.remove(u"a")
+            other.remove(u"b")
+            assert jdb.get() == {}
+            assert changed.call_count == 3